@@ -0,0 +1,100 @@
+# numpy array utilities: vectorized normalization and padding kernels shared by data managers and Tools.
+
+import numpy as np
+from scipy import ndimage
+
+
+def sliceNormalizeArray(array, out=None, perSlice=True):
+    """
+    min-max normalize into [0,1] for each slice along axis 0 with broadcasting, instead of a python loop over slices.
+    :param array: 2D or 3D array
+    :param out: float32 output array, which may be array itself for in-place normalization; None allocates a new float32 array.
+    :param perSlice: False normalizes the whole array together, e.g. for a 2D slice.
+    :return: out
+    :Notes: a slice with zero peak-to-peak value uses 1e-6 as its range.
+    """
+    axes = tuple(range(1, array.ndim)) if perSlice else None
+    if out is None:
+        out = np.empty(array.shape, dtype=np.float32)
+    minx = np.min(array, axis=axes, keepdims=True).astype(np.float32)
+    ptp = np.max(array, axis=axes, keepdims=True).astype(np.float32) - minx   # peak to peak
+    ptp[ptp == 0] = 1e-6
+    np.subtract(array, minx, out=out)
+    out *= 1.0 / ptp
+    return out
+
+def sliceStdNormalizeArray(array, out=None):
+    """
+    divide each slice along axis 0 by its std, getting a gaussian distribution with non-zero mean;
+    a slice whose pixels all equal subtracts its mean, as it has no discriminating meaning.
+    :param array: 3D array
+    :param out: float32 output array, which may be array itself for in-place normalization; None allocates a new float32 array.
+    :return: out
+    """
+    if out is None:
+        out = np.empty(array.shape, dtype=np.float32)
+    D = array.shape[0]
+    # np.std of each slice is a centered two-pass std, exact also when std << |mean| as in CT slices,
+    # and faster on a cache-resident slice than one float64 pass over the whole volume.
+    mean = np.array([np.mean(array[i]) for i in range(D)], dtype=np.float64)
+    std = np.array([np.std(array[i]) for i in range(D)], dtype=np.float64)
+    zeroStd = (std == 0)
+    invStd = np.where(zeroStd, 1, 1.0 / np.where(zeroStd, 1, std)).astype(np.float32).reshape((D,) + (1,) * (array.ndim - 1))
+    np.multiply(array, invStd, out=out)
+    for i in np.nonzero(zeroStd)[0]:
+        out[i] -= np.float32(mean[i])
+    return out
+
+def getAssembleRanges(shape, goalSize):
+    """
+    :return: (wallSlices, arraySlices), which assemble array of shape into the center of goalSize, cropping its center if it is bigger.
+    """
+    wallSlices = []
+    arraySlices = []
+    for s, S in zip(shape, goalSize):
+        if s < S:
+            S1 = (S - s) // 2
+            wallSlices.append(slice(S1, S1 + s))
+            arraySlices.append(slice(0, s))
+        else:
+            s1 = (s - S) // 2
+            wallSlices.append(slice(0, S))
+            arraySlices.append(slice(s1, s1 + S))
+    return tuple(wallSlices), tuple(arraySlices)
+
+def assembleInCenter(array, goalSize, dtype=np.float32):
+    """
+    assemble array into the center of a zero-padded array of goalSize.
+    """
+    wallSlices, arraySlices = getAssembleRanges(array.shape, goalSize)
+    wall = np.zeros(goalSize, dtype=dtype)
+    wall[wallSlices] = array[arraySlices]
+    return wall
+
+def getBoundingBox(mask):
+    """
+    :return: tuple of slices of the smallest box including all True elements of mask, or None if mask has no True element.
+    """
+    box = []
+    for axis in range(mask.ndim):
+        nonzeros = np.flatnonzero(np.any(mask, axis=tuple(x for x in range(mask.ndim) if x != axis)))
+        if len(nonzeros) == 0:
+            return None
+        box.append(slice(nonzeros[0], nonzeros[-1] + 1))
+    return tuple(box)
+
+def computeDistanceMaps(foreground):
+    """
+    compute the level sets of distance losses from a binary ground truth.
+    :param foreground: 2D or 3D bool array
+    :return: 2*shape float32 array, where [0] is the distance of each foreground pixel to background,
+             and [1] is the distance of each background pixel to foreground.
+    :Notes: a ground truth without foreground gets 0 foreground distance and 1 background distance everywhere.
+    """
+    distanceMaps = np.zeros((2,) + foreground.shape, dtype=np.float32)
+    if np.count_nonzero(foreground) == 0:
+        distanceMaps[1] = 1
+    else:
+        distanceMaps[0] = ndimage.distance_transform_edt(foreground)
+        distanceMaps[1] = ndimage.distance_transform_edt(~foreground)
+    return distanceMaps
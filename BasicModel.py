@@ -3,6 +3,7 @@ import torch
 import torch.nn.functional as F
 import torch.nn.init as init
 from BuildingBlocks import *
+from CustomizedLoss import mixupLoss
 
 
 class BasicModel(nn.Module):
@@ -13,6 +14,7 @@ class BasicModel(nn.Module):
         self.m_dropout2d = nn.Dropout2d(p=self.m_dropoutProb)
         self.m_dropout1d = nn.Dropout(p=self.m_dropoutProb)
         self.m_optimizer = None
+        self.m_optimizerGroupParams = []
         self.m_lossFuncList = []
         self.m_lossWeightList = []
 
@@ -21,6 +23,40 @@ class BasicModel(nn.Module):
 
     def setOptimizer(self, optimizer):
         self.m_optimizer = optimizer
+        # all parameters of each param group, from which updateOptimizerParams selects the trainable ones.
+        self.m_optimizerGroupParams = [list(group['params']) for group in optimizer.param_groups]
+
+    def updateOptimizerParams(self):
+        """
+        re-group the optimizer in place to cover only parameters with requires_grad, after a freeze or unfreeze,
+        so that step() walks and keeps moment buffers of trainable parameters only.
+        The state of parameters staying trainable carries over; the state of frozen parameters is dropped,
+        and an unfrozen parameter restarts its state. Learning rate schedulers keep working, as the optimizer object is kept.
+        :return: an info string
+        """
+        if self.m_optimizer is None:
+            return "Info: no optimizer to update."
+        nTrainable = 0
+        for group, params in zip(self.m_optimizer.param_groups, self.m_optimizerGroupParams):
+            group['params'] = [param for param in params if param.requires_grad]
+            nTrainable += len(group['params'])
+        for param in list(self.m_optimizer.state.keys()):
+            if not param.requires_grad:
+                del self.m_optimizer.state[param]
+        nAll = sum(len(params) for params in self.m_optimizerGroupParams)
+        return f"Info: optimizer covers {nTrainable} of {nAll} parameter tensors, which are trainable."
+
+    def getTrainableState(self):
+        """
+        :return: dict of parameter name -> requires_grad, which decides the param groups of a saved optimizer state.
+        """
+        return {name: param.requires_grad for name, param in self.named_parameters()}
+
+    def setTrainableState(self, trainableState):
+        for name, param in self.named_parameters():
+            if name in trainableState:
+                param.requires_grad = trainableState[name]
+        return self.updateOptimizerParams()
 
     def appendLossFunc(self, lossFunc, weight = 1.0):
         self.m_lossFuncList.append(lossFunc)
@@ -33,6 +69,13 @@ class BasicModel(nn.Module):
     def lossFunctionsInfo(self):
         return f'Loss Functions List: ' + f'\t'.join(f'{type(loss).__name__} with weight of {weight}; ' for loss, weight in zip(self.m_lossFuncList, self.m_lossWeightList))
 
+    def lossTimingInfo(self):
+        """
+        :return: timing breakdown of the loss functions which report it by getTimingInfo, e.g. BoundaryLoss2, resetting their timing;
+                 or an empty string if no loss function reports timing.
+        """
+        return '\n'.join(loss.getTimingInfo() for loss in self.m_lossFuncList if hasattr(loss, "getTimingInfo"))
+
     def updateLossWeightList(self, weightList):
         self.m_lossWeightList = weightList
 
@@ -58,10 +101,7 @@ class BasicModel(nn.Module):
         for lossFunc, weight in zip(self.m_lossFuncList, self.m_lossWeightList):
             if weight == 0:
                 continue
-            if lambdaInBeta != 0:
-                loss += lossFunc(outputs,labels1)*weight*lambdaInBeta
-            if 1-lambdaInBeta != 0:
-                loss += lossFunc(outputs,labels2)*weight*(1-lambdaInBeta)
+            loss += mixupLoss(lossFunc, outputs, labels1, labels2, lambdaInBeta)*weight
         loss.backward()
         self.m_optimizer.step()
         return outputs, loss.item()
@@ -1,29 +1,176 @@
 import torch.nn.functional as F
+import torch.nn as nn
 from torch.nn.modules.loss import _WeightedLoss, _Loss
 import torch
 from scipy import ndimage
 from scipy.ndimage.morphology import binary_dilation
 import numpy as np
 import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ArrayUtilities import computeDistanceMaps, getBoundingBox
+from TensorUtilities import truncatedDistanceTransform, binaryDilation, jumpFloodDistanceTransform
 
 
+def getLevelSets(target, k, distanceMaps=None):
+    """
+    get the foreground and background level sets of class k for distance losses.
+    :param target: N*d*h*w or N*h*w class labels
+    :param distanceMaps: N*2*d*h*w precomputed distance maps of target, e.g. from OVDataSegSet(withDistanceMaps=True),
+                         which are used directly on device; None computes them from target on CPU.
+    :return: (levelSetFg, levelSetBg) float tensors of target shape on target device
+    """
+    if distanceMaps is not None:
+        assert distanceMaps.shape[0] == target.shape[0] and distanceMaps.shape[2:] == target.shape[1:]
+        distanceMaps = distanceMaps.to(target.device, dtype=torch.float, non_blocking=True)
+        return distanceMaps[:, 0], distanceMaps[:, 1]
+    targetk = (target.cpu().numpy() == k)
+    levelSets = np.stack([computeDistanceMaps(targetk[i,]) for i in range(targetk.shape[0])], axis=1)
+    levelSets = torch.from_numpy(levelSets).to(target.device)
+    return levelSets[0], levelSets[1]
+
+def getTruncatedLevelSets(target, k, truncateDistance):
+    """
+    get the foreground and background level sets of class k truncated at truncateDistance, on target device,
+    which equal the clipped getLevelSets without their CPU distance transforms over the whole volume.
+    :return: (levelSetFg, levelSetBg) float tensors of target shape
+    """
+    targetk = (target == k)
+    levelSetFg = truncatedDistanceTransform(targetk, truncateDistance)
+    levelSetBg = truncatedDistanceTransform(~targetk, truncateDistance)
+    hasFg = targetk.reshape(targetk.shape[0], -1).any(dim=1).view((-1,) + (1,) * (target.ndim - 1))
+    levelSetBg = torch.where(hasFg, levelSetBg, torch.ones_like(levelSetBg))  # a sample without foreground
+    return levelSetFg, levelSetBg
+
+
+
+def mixLevelSets(getLevelSetsFun, weightedTargets, k):
+    """
+    :param getLevelSetsFun: getLevelSetsFun(target, k, distanceMaps) returns (levelSetFg, levelSetBg)
+    :param weightedTargets: list of (target, distanceMaps, lambda)
+    :return: lambda-weighted sums of levelSetFg and levelSetBg
+    """
+    levelSetFg, levelSetBg = 0, 0
+    for target, distanceMaps, lambdaInBeta in weightedTargets:
+        if lambdaInBeta == 0:
+            continue
+        fg, bg = getLevelSetsFun(target, k, distanceMaps)
+        levelSetFg = levelSetFg + (fg if lambdaInBeta == 1 else fg * lambdaInBeta)
+        levelSetBg = levelSetBg + (bg if lambdaInBeta == 1 else bg * lambdaInBeta)
+    return levelSetFg, levelSetBg
+
+def mixupLoss(lossFunc, outputs, target1, target2, lambdaInBeta):
+    """
+    mixup loss lambdaInBeta*lossFunc(outputs, target1) + (1-lambdaInBeta)*lossFunc(outputs, target2).
+    Losses with a mixupForward method (FocalCELoss, BoundaryLoss1, BoundaryLoss3, DistanceCrossEntropyLoss) and
+    nn.CrossEntropyLoss evaluate (log_)softmax of outputs once in one autograd graph; other losses are called for each target.
+    A target with zero weight is skipped.
+    """
+    if lambdaInBeta == 1:
+        return lossFunc(outputs, target1)
+    if lambdaInBeta == 0:
+        return lossFunc(outputs, target2)
+    if hasattr(lossFunc, "mixupForward"):
+        return lossFunc.mixupForward(outputs, target1, target2, lambdaInBeta)
+    if isinstance(lossFunc, nn.CrossEntropyLoss):
+        logP = F.log_softmax(outputs, 1)
+        return F.nll_loss(logP, target1, lossFunc.weight, None, lossFunc.ignore_index, None, lossFunc.reduction) * lambdaInBeta \
+             + F.nll_loss(logP, target2, lossFunc.weight, None, lossFunc.ignore_index, None, lossFunc.reduction) * (1 - lambdaInBeta)
+    return lossFunc(outputs, target1) * lambdaInBeta + lossFunc(outputs, target2) * (1 - lambdaInBeta)
+
+def focalElementLoss(logP, target, weight, gamma, ignore_index):
+    """
+    :param logP: log_softmax of input along dim 1
+    :return: (loss of each element, weight of each element), where ignored elements have 0 weight and loss;
+             they only have the size of target, as log(p_t) is gathered before the focal factor.
+    """
+    valid = (target != ignore_index)
+    target = torch.where(valid, target, torch.zeros_like(target))
+    logPt = logP.gather(1, target.unsqueeze(1)).squeeze(1)
+    weightT = valid.to(logP.dtype) if weight is None else weight.to(logP.device, logP.dtype)[target] * valid
+    loss = -weightT * (1 - logPt.exp()).clamp(min=0) ** gamma * logPt
+    return loss, weightT
+
+class FusedFocalCE(torch.autograd.Function):
+    """
+    focal cross entropy in one autograd node, which keeps only log_softmax of input for backward,
+    instead of softmax, log_softmax, focal factor and their product of the composed formulation.
+    loss of an element = -weight[t] * (1-p_t)^gamma * log(p_t), where t is its target class.
+    gradient to input_j = weight[t] * dLoss/dlog(p_t) * (delta_tj - p_j),
+         where dLoss/dlog(p_t) = -(1-p_t)^gamma + gamma*(1-p_t)^(gamma-1)*p_t*log(p_t).
+    """
+    @staticmethod
+    def forward(ctx, inputx, target, weight, gamma, ignore_index, reduction):
+        logP = F.log_softmax(inputx, 1)
+        loss, weightT = focalElementLoss(logP, target, weight, gamma, ignore_index)
+        target = torch.where(target != ignore_index, target, torch.zeros_like(target))
+
+        ctx.gamma = gamma
+        ctx.reduction = reduction
+        ctx.save_for_backward(logP, target, weightT)
+        if reduction == 'mean':
+            return loss.sum() / weightT.sum()
+        elif reduction == 'sum':
+            return loss.sum()
+        else:
+            return loss
+
+    @staticmethod
+    def backward(ctx, gradOutput):
+        logP, target, weightT = ctx.saved_tensors
+        gamma = ctx.gamma
+        logPt = logP.gather(1, target.unsqueeze(1)).squeeze(1)
+        pt = logPt.exp()
+        oneMinusPt = (1 - pt).clamp(min=0)
+        dLossdLogPt = -oneMinusPt ** gamma
+        if gamma != 0:
+            # (1-p_t)^(gamma-1) may be inf at p_t = 1, where log(p_t) = 0.
+            dLossdLogPt += torch.where(oneMinusPt > 0, gamma * oneMinusPt ** (gamma - 1) * pt * logPt, torch.zeros_like(pt))
+        coeff = weightT * dLossdLogPt
+        if ctx.reduction == 'mean':
+            coeff *= gradOutput / weightT.sum()
+        else:
+            coeff *= gradOutput  # a scalar for 'sum', or per element for 'none'
+        coeff = coeff.unsqueeze(1)
+        gradInput = logP.exp().mul_(-coeff)
+        gradInput.scatter_add_(1, target.unsqueeze(1), coeff)
+        return gradInput, None, None, None, None, None
+
 
 class FocalCELoss(_WeightedLoss):
     """
     Focal Loss, please refer paper: "Focal Loss for Dense Object Detection" in link: https://arxiv.org/abs/1708.02002
+    fused: True uses FusedFocalCE with less activation memory; False uses the composed formulation of softmax and nll_loss.
     """
     __constants__ = ['weight', 'ignore_index', 'reduction']
 
-    def __init__(self, weight=None, gamma =2.0, size_average=None, ignore_index=-100, reduce=None, reduction='mean'):
+    def __init__(self, weight=None, gamma =2.0, size_average=None, ignore_index=-100, reduce=None, reduction='mean', fused=True):
         super().__init__(weight, size_average, reduce, reduction)
         self.gamma = gamma
         self.ignore_index = ignore_index
+        self.fused = fused
 
 
     def forward(self, inputx, target):
+        if self.fused:
+            return FusedFocalCE.apply(inputx, target, self.weight, self.gamma, self.ignore_index, self.reduction)
         focalFactor = (1 - F.softmax(inputx, 1)) ** self.gamma
         return F.nll_loss(focalFactor * F.log_softmax(inputx, 1), target, self.weight, None, self.ignore_index, None, self.reduction)
 
+    def mixupForward(self, inputx, target1, target2, lambdaInBeta):
+        """
+        lambdaInBeta*loss(target1) + (1-lambdaInBeta)*loss(target2) with one log_softmax of inputx,
+        where the two targets only add per-element terms in one reduction.
+        """
+        logP = F.log_softmax(inputx, 1)
+        loss1, weight1 = focalElementLoss(logP, target1, self.weight, self.gamma, self.ignore_index)
+        loss2, weight2 = focalElementLoss(logP, target2, self.weight, self.gamma, self.ignore_index)
+        if self.reduction == 'mean':
+            return torch.sum(loss1 * (lambdaInBeta / weight1.sum()) + loss2 * ((1 - lambdaInBeta) / weight2.sum()))
+        loss = loss1 * lambdaInBeta + loss2 * (1 - lambdaInBeta)
+        return torch.sum(loss) if self.reduction == 'sum' else loss
+
     def setGamma(self,gamma):
         self.gamma = gamma
 
@@ -36,10 +183,13 @@ class BoundaryLoss1(_Loss):
     inside  boundary of ground truth, it is negative distance, a reward to reduce loss;
     Support K classes classification.
     support 2D and 3D images.
+    distanceMethod: "jumpFlood" extracts boundary with max-pool dilation and approximates its distance with jump flooding,
+                    all on the loss device without host sync;
+                    "scipy", the default, computes exact level sets with scipy on CPU.
     """
     __constants__ = ['reduction']
 
-    def __init__(self, lambdaCoeff=1, k=2, weight=None, size_average=None, reduce=None, reduction='mean'):
+    def __init__(self, lambdaCoeff=1, k=2, weight=None, size_average=None, reduce=None, reduction='mean', distanceMethod="scipy"):
         super().__init__(size_average, reduce, reduction)
         self.m_lambda=lambdaCoeff # weight coefficient of whole loss function
         self.m_k = k              # k classes classification, m_k=2 is for binary classification, etc
@@ -47,39 +197,83 @@ class BoundaryLoss1(_Loss):
         if len(self.m_weight) != self.m_k:
             print(f"Error: the number of classes does not match weight in the Boundary Loss init method")
             sys.exit(-5)
+        if distanceMethod not in ("jumpFlood", "scipy"):
+            print(f"Error: distanceMethod of Boundary Loss should be jumpFlood or scipy")
+            sys.exit(-5)
+        self.m_distanceMethod = distanceMethod
+
+    def getDeviceLevelSet(self, target, k):
+        """
+        signed distance to the boundary of class k: positive outside, negative inside, and 1 for a sample without class k.
+        """
+        targetk = (target == k)
+        targetkNot = ~targetk
+        boundary = binaryDilation(targetkNot) & targetk
+        inside = targetk ^ boundary  # xor operator
+        signMatrix = targetkNot.float() - inside.float()
+        levelSet = jumpFloodDistanceTransform(boundary) * signMatrix  # 0 on boundary
+        hasFg = targetk.reshape(targetk.shape[0], -1).any(dim=1).view((-1,) + (1,) * (target.ndim - 1))
+        return torch.where(hasFg, levelSet, torch.ones_like(levelSet))
+
+    def getScipyLevelSet(self, target, k):
+        """
+        exact signed distance of getDeviceLevelSet computed with scipy on CPU.
+        """
+        targetNumpy = target.cpu().numpy().astype(int)
+        shape = targetNumpy.shape
+        ndim = targetNumpy.ndim
+        N = shape[0]     # batch Size
+        dilateFilter = np.ones((3,)*(ndim-1), dtype=int)  # dilation filter for for 4-connected boundary in 2D, 8 connected boundary in 3D
+
+        targetk = (targetNumpy == k)
+        targetkNot = (targetNumpy != k)
+        levelSet = np.zeros(shape)
+
+        for i in range(N):
+            if np.count_nonzero(targetk[i]) == 0:
+                levelSet[i].fill(1)
+            else:
+                boundary = binary_dilation(targetkNot[i],dilateFilter) & targetk[i]
+                inside = targetk[i] ^ boundary  # xor operator
+                signMatrix = inside*(-1)+ targetkNot[i]
+                levelSet[i] = ndimage.distance_transform_edt(boundary==0)*signMatrix
+        return torch.from_numpy(levelSet).float()
+
+    def getLevelSet(self, target, k, device):
+        if self.m_distanceMethod == "jumpFlood":
+            return self.getDeviceLevelSet(target.to(device), k)
+        else:
+            return self.getScipyLevelSet(target, k).to(device)
 
     def forward(self, inputx, target):
+        return self.weightedTargetsForward(inputx, [(target, 1)])
+
+    def mixupForward(self, inputx, target1, target2, lambdaInBeta):
+        return self.weightedTargetsForward(inputx, [(target1, lambdaInBeta), (target2, 1 - lambdaInBeta)])
+
+    def weightedTargetsForward(self, inputx, weightedTargets):
+        """
+        :param weightedTargets: list of (target, lambda); as loss is linear in level set,
+                                their lambda-weighted level sets are summed into one reduction with one softmax.
+        """
         inputxMaxDim1, _= torch.max(inputx, dim=1, keepdim=True)
         inputxMaxDim1 = inputxMaxDim1.expand_as(inputx)
         softmaxInput = F.softmax(inputx-inputxMaxDim1, 1)  #use inputMaxDim1 is to avoid overflow.
 
-        targetNumpy = target.cpu().numpy().astype(int)
-        shape = targetNumpy.shape
-        ndim = targetNumpy.ndim
-        N = shape[0]     # batch Size
-        dilateFilter = np.ones((3,)*(ndim-1), dtype=int)  # dilation filter for for 4-connected boundary in 2D, 8 connected boundary in 3D
+        target = weightedTargets[0][0]
+        ndim = target.ndim
+        N = target.shape[0]     # batch Size
         ret = torch.zeros(N).to(inputx.device)
 
         for k in range(1,self.m_k):  # ignore background with k starting with 1
             segProb = torch.narrow(softmaxInput,1, k,1)
             segProb = torch.squeeze(segProb, 1)
 
-            targetk = (targetNumpy == k)
-            targetkNot = (targetNumpy != k)
-            levelSet = np.zeros(shape)
-
-            for i in range(N):
-                if np.count_nonzero(targetk[i]) == 0:
-                    levelSet[i].fill(1)
-                else:
-                    boundary = binary_dilation(targetkNot[i],dilateFilter) & targetk[i]
-                    inside = targetk[i] ^ boundary  # xor operator
-                    signMatrix = inside*(-1)+ targetkNot[i]
-                    levelSet[i] = ndimage.distance_transform_edt(boundary==0)*signMatrix
-
-            levelSetTensor = torch.from_numpy(levelSet).float().to(inputx.device)
+            levelSetTensor = 0
+            for targetj, lambdaInBeta in weightedTargets:
+                if lambdaInBeta != 0:
+                    levelSetTensor = levelSetTensor + self.getLevelSet(targetj, k, inputx.device) * lambdaInBeta
             x = torch.mean(segProb * levelSetTensor, dim=tuple([i for i in range(1,ndim)]))
-            x = torch.squeeze(x)
             ret += x*self.m_weight[k]
 
         if self.reduction != 'none':
@@ -117,7 +311,7 @@ class BoundaryLoss2(_Loss):
     """
     __constants__ = ['reduction']
 
-    def __init__(self, lambdaCoeff=1, k=2, weight=None, size_average=None, reduce=None, reduction='mean'):
+    def __init__(self, lambdaCoeff=1, k=2, weight=None, size_average=None, reduce=None, reduction='mean', numWorkers=4):
         super().__init__(size_average, reduce, reduction)
         self.m_lambda=lambdaCoeff # weight coefficient of whole loss function
         self.m_k = k              # k classes classification, m_k=2 is for binary classification, etc
@@ -125,8 +319,77 @@ class BoundaryLoss2(_Loss):
         if len(self.weight) != self.m_k:
             print(f"Error: the number of classes does not match weight in the Boundary Loss init method")
             sys.exit(-5)
+        self.m_numWorkers = numWorkers
+        self.m_executor = None  # created at first forward, builds level sets of samples in parallel, as scipy EDT releases GIL
+        self.m_buffers = threading.local()  # reused float32 N*shape level set buffers of each calling thread, e.g. DataParallel replicas
+        self.m_timing = {"transfer": 0.0, "levelSet": 0.0, "loss": 0.0, "calls": 0}
+
+    def __getstate__(self):
+        # executor and thread-local buffers can not be pickled or deep copied; a copy creates its own at first forward.
+        state = self.__dict__.copy()
+        state["m_executor"] = None
+        del state["m_buffers"]
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.m_buffers = threading.local()
+
+    def getExecutor(self):
+        if self.m_executor is None:
+            self.m_executor = ThreadPoolExecutor(max_workers=self.m_numWorkers)
+        return self.m_executor
+
+    def getTimingInfo(self, reset=True):
+        """
+        :return: a string of average milliseconds per forward in each phase: device-to-host transfer of prediction and target,
+                 level set construction, and loss computation with host-to-device transfer of level sets.
+        """
+        calls = max(self.m_timing["calls"], 1)
+        info = f"{type(self).__name__} average time per forward: " + ", ".join(f"{key} {value*1000/calls:.1f} ms"
+                                                                     for key, value in self.m_timing.items() if key != "calls")
+        if reset:
+            self.m_timing = dict.fromkeys(self.m_timing, 0.0)
+            self.m_timing["calls"] = 0
+        return info
+
+    @staticmethod
+    def computeLevelSets(targetk, predictionk, levelSetA, levelSetB):
+        """
+        build the level sets of one sample into zeroed float32 levelSetA and levelSetB, restricting distance transforms
+        to the bounding box of A, B and C, which includes all zeros of the transforms, so distances keep exact.
+        :return: size of A and B
+        """
+        box = getBoundingBox(targetk | predictionk)  # A+B+C
+        if box is None:
+            return 0  # case5: Null (there is no prediction 1 and groundtruth 1, so no loss at all)
+        C = targetk[box] & predictionk[box]
+        A = targetk[box] ^ C
+        B = predictionk[box] ^ C
+        countA = np.count_nonzero(A)
+        countB = np.count_nonzero(B)
 
+        # case1: ACB (this is the frequent case; and in some case, A \subset C,  or B \subset C, and C is not Null.
+        if np.count_nonzero(C) != 0:
+            levelSetC = ndimage.distance_transform_edt(np.invert(C))
+            np.multiply(A, levelSetC, out=levelSetA[box], casting='same_kind')  # distance AC is bigger than distance AB, as C \subset B.
+            np.multiply(B, levelSetC, out=levelSetB[box], casting='same_kind')
 
+        # case2: AB (there is no overlap between ground truth 1 and prediction 1; in other words, C=Null.)
+        elif countA > 0 and countB > 0:
+            # when no-overlapping A is farther from B, we hope to get bigger gradient on pixels of A.
+            np.multiply(A, ndimage.distance_transform_edt(np.invert(B)), out=levelSetA[box], casting='same_kind')
+            np.multiply(B, ndimage.distance_transform_edt(np.invert(A)), out=levelSetB[box], casting='same_kind')
+
+        # Case3: A (there is only ground truth 1, but no prediciton 1, and C=Null)
+        #        in this case, boundary loss degrades into general cross entropy loss .
+        elif countA > 0:
+            levelSetA[box] = A
+
+        # case4: B (there is only prediction 1, but no groundtruth 1, and C=Null)
+        else:
+            levelSetB[box] = B
+        return countA + countB
 
     def forward(self, inputx, target):
         # case1: ACB (this is the frequent case; and in some case, A \subset C,  or B \subset C, and C is not Null.
@@ -134,7 +397,7 @@ class BoundaryLoss2(_Loss):
         # Case3: A (there is only ground truth 1, but no prediciton 1, and C=Null)
         # case4: B (there is only prediction 1, but no groundtruth 1, and C=Null)
         # case5: Null (there is no prediction 1 and groundtruth 1, so no loss at all)
-
+        startTime = time.perf_counter()
         prediction = torch.argmax(inputx, dim=1).cpu().numpy()
 
         # softmax(x) = softmax(x+c) where c is scalar. subtracting max(x) avoids overflow of exponential explosion.
@@ -142,15 +405,18 @@ class BoundaryLoss2(_Loss):
         assert self.m_k == 2
         logsoftmax = F.log_softmax(inputx, dim=1)  # use logsoftmax to avoid overflow and underflow.
 
-
-        targetNumpy = target.cpu().numpy().astype(int)
+        targetNumpy = target.cpu().numpy()
         shape = targetNumpy.shape
         ndim = targetNumpy.ndim
         N = shape[0]     # batch Size
         ret = torch.zeros(N).to(inputx.device)
-
+        if getattr(self.m_buffers, "levelSetA", None) is None or self.m_buffers.levelSetA.shape != shape:
+            self.m_buffers.levelSetA = np.zeros(shape, dtype=np.float32)
+            self.m_buffers.levelSetB = np.zeros(shape, dtype=np.float32)
+        self.m_timing["transfer"] += time.perf_counter() - startTime
 
         for k in range(1,self.m_k):  # ignore background with k starting with 1
+            startTime = time.perf_counter()
             logP = torch.narrow(logsoftmax,1, k,1)
             log1_P = torch.narrow(logsoftmax,1, 0,1)
 
@@ -160,54 +426,27 @@ class BoundaryLoss2(_Loss):
             targetk = (targetNumpy == k)
             predictionk = (prediction == k)
 
-            levelSetA = np.zeros(shape)  # default Loss = 0 for A and B
-            levelSetB = np.zeros(shape)
-
-            ABSize = torch.zeros(N, requires_grad=False,device=inputx.device)
+            levelSetA = self.m_buffers.levelSetA  # default Loss = 0 for A and B
+            levelSetB = self.m_buffers.levelSetB
+            levelSetA.fill(0)
+            levelSetB.fill(0)
 
             # for the A,B,C, they are needed in the context of each sample
-            for i in range(N):
-                # if np.count_nonzero(targetk[i,]) == 0:
-                #     continueA
-                C = targetk[i,] * predictionk[i,]
-                A = targetk[i,] ^ C
-                B = predictionk[i,] ^ C
-                ABSize[i] = np.count_nonzero(A) + np.count_nonzero(B)
-
-                # case1: ACB (this is the frequent case; and in some case, A \subset C,  or B \subset C, and C is not Null.
-                if np.count_nonzero(C) != 0:
-                    CNot = np.invert(C)
-                    levelSetC = ndimage.distance_transform_edt(CNot)
-                    levelSetA[i,] = A*levelSetC  # distance AC is bigger than distance AB, as C \subset B.
-                    levelSetB[i,] = B*levelSetC
-
-                # case2: AB (there is no overlap between ground truth 1 and prediction 1; in other words, C=Null.)
-                elif np.count_nonzero(A) >0 and np.count_nonzero(B) >0:
-                    # when no-overlapping A is farther from B, we hope to get bigger gradient on pixels of A.
-                    levelSetA[i,] = A * ndimage.distance_transform_edt(np.invert(B))
-                    levelSetB[i,] = B * ndimage.distance_transform_edt(np.invert(A))
-
-                 # Case3: A (there is only ground truth 1, but no prediciton 1, and C=Null)
-                 #        in this case, boundary loss degrades into general cross entropy loss .
-                elif np.count_nonzero(A) >0:
-                    levelSetA[i,] = A
-
-                # case4: B (there is only prediction 1, but no groundtruth 1, and C=Null)
-                elif np.count_nonzero(B) >0:
-                    levelSetB[i,] = B
-
-                # case5: Null (there is no prediction 1 and groundtruth 1, so no loss at all)
-                else:
-                    continue
-
-
-            levelSetATensor = torch.from_numpy(levelSetA).float().to(inputx.device)
-            levelSetBTensor = torch.from_numpy(levelSetB).float().to(inputx.device)
+            ABSize = list(self.getExecutor().map(BoundaryLoss2.computeLevelSets, targetk, predictionk, levelSetA, levelSetB))
+            ABSize = torch.tensor(ABSize, dtype=torch.float, device=inputx.device)
+            self.m_timing["levelSet"] += time.perf_counter() - startTime
+
+            startTime = time.perf_counter()
+            # copy, as autograd keeps level sets until backward, while buffers are refilled in next forward.
+            levelSetATensor = torch.from_numpy(levelSetA).to(inputx.device, copy=True)
+            levelSetBTensor = torch.from_numpy(levelSetB).to(inputx.device, copy=True)
             x = torch.sum(-log1_P * levelSetBTensor - logP*self.weight[k]*levelSetATensor, dim=tuple([i for i in range(1,ndim)]))
             x = torch.squeeze(x)
             x /= ABSize +1e-8    #default 1e-8 is to avoid divided by 0.
             ret += x
+            self.m_timing["loss"] += time.perf_counter() - startTime
 
+        self.m_timing["calls"] += 1
         if self.reduction != 'none':
             ret = torch.mean(ret) if self.reduction == 'mean' else torch.sum(ret)
         return ret*self.m_lambda
@@ -248,14 +487,26 @@ class BoundaryLoss3(_Loss):
 
 
 
-    def forward(self, inputx, target):
+    def forward(self, inputx, target, distanceMaps=None):
+        """
+        :param distanceMaps: optional N*2*d*h*w precomputed distance maps of target, see getLevelSets.
+        """
+        return self.weightedTargetsForward(inputx, [(target, distanceMaps, 1)])
+
+    def mixupForward(self, inputx, target1, target2, lambdaInBeta, distanceMaps1=None, distanceMaps2=None):
+        return self.weightedTargetsForward(inputx, [(target1, distanceMaps1, lambdaInBeta), (target2, distanceMaps2, 1 - lambdaInBeta)])
+
+    def weightedTargetsForward(self, inputx, weightedTargets):
+        """
+        :param weightedTargets: list of (target, distanceMaps, lambda); as loss is linear in level sets,
+                                their lambda-weighted level sets are summed into one reduction with one log_softmax.
+        """
         assert self.m_k == 2
         logsoftmax = F.log_softmax(inputx, dim=1)  # use logsoftmax to avoid overflow and underflow.
+        target = weightedTargets[0][0]
 
-        targetNumpy = target.cpu().numpy().astype(int)
-        shape = targetNumpy.shape
-        ndim = targetNumpy.ndim
-        N = shape[0]     # batch Size
+        ndim = target.ndim
+        N = target.shape[0]     # batch Size
         ret = torch.zeros(N).to(inputx.device)
 
         for k in range(1,self.m_k):  # ignore background with k starting with 1
@@ -265,22 +516,7 @@ class BoundaryLoss3(_Loss):
             logP = torch.squeeze(logP, 1)
             log1_P = torch.squeeze(log1_P,1)
 
-            targetk = (targetNumpy == k)
-
-            levelSetFg = np.zeros(shape)
-            levelSetBg = np.zeros(shape)
-
-            for i in range(N):
-                if np.count_nonzero(targetk[i,]) == 0:
-                    levelSetBg[i,].fill_(1)
-                else:
-                    Fg = targetk[i,]
-                    Bg = ~Fg
-                    levelSetFg[i,] = ndimage.distance_transform_edt(Fg)
-                    levelSetBg[i,] = ndimage.distance_transform_edt(Bg)
-
-            levelSetFgTensor = torch.from_numpy(levelSetFg).float().to(inputx.device)
-            levelSetBgTensor = torch.from_numpy(levelSetBg).float().to(inputx.device)
+            levelSetFgTensor, levelSetBgTensor = mixLevelSets(getLevelSets, weightedTargets, k)
             # x = torch.mean(-logP *self.weight[k]* levelSetFgTensor - log1_P*levelSetBgTensor, dim=tuple([i for i in range(1,ndim)]))
             x = torch.mean(-(logP*self.weight[k]-log1_P) * (levelSetFgTensor - levelSetBgTensor), dim=tuple([i for i in range(1, ndim)]))
             x = torch.squeeze(x)
@@ -349,14 +585,34 @@ class DistanceCrossEntropyLoss(_Loss):
             sys.exit(-5)
         self.m_trancateDistance = trancateDistance
 
-    def forward(self, inputx, target):
+    def forward(self, inputx, target, distanceMaps=None):
+        """
+        :param distanceMaps: optional N*2*d*h*w precomputed distance maps of target, see getLevelSets;
+                             None computes truncated level sets on target device in the narrow band of boundary.
+        """
+        return self.weightedTargetsForward(inputx, [(target, distanceMaps, 1)])
+
+    def mixupForward(self, inputx, target1, target2, lambdaInBeta, distanceMaps1=None, distanceMaps2=None):
+        return self.weightedTargetsForward(inputx, [(target1, distanceMaps1, lambdaInBeta), (target2, distanceMaps2, 1 - lambdaInBeta)])
+
+    def getClampedLevelSets(self, target, k, distanceMaps):
+        if distanceMaps is not None:
+            levelSetFg, levelSetBg = getLevelSets(target, k, distanceMaps)
+            return torch.clamp(levelSetFg, 0, self.m_trancateDistance), torch.clamp(levelSetBg, 0, self.m_trancateDistance)
+        else:
+            return getTruncatedLevelSets(target, k, self.m_trancateDistance)
+
+    def weightedTargetsForward(self, inputx, weightedTargets):
+        """
+        :param weightedTargets: list of (target, distanceMaps, lambda); as loss is linear in level sets,
+                                their lambda-weighted level sets are summed into one reduction with one log_softmax.
+        """
         assert self.m_k == 2
         logsoftmax = F.log_softmax(inputx, dim=1)  # use logsoftmax to avoid overflow and underflow.
+        target = weightedTargets[0][0]
 
-        targetNumpy = target.cpu().numpy().astype(int)
-        shape = targetNumpy.shape
-        ndim = targetNumpy.ndim
-        N = shape[0]  # batch Size
+        ndim = target.ndim
+        N = target.shape[0]  # batch Size
         ret = torch.zeros(N).to(inputx.device)
 
         for k in range(1, self.m_k):  # ignore background with k starting with 1
@@ -366,24 +622,7 @@ class DistanceCrossEntropyLoss(_Loss):
             logP = torch.squeeze(logP, 1)
             log1_P = torch.squeeze(log1_P, 1)
 
-            targetk = (targetNumpy == k)
-
-            levelSetFg = np.zeros(shape)
-            levelSetBg = np.zeros(shape)
-
-            for i in range(N):
-                if np.count_nonzero(targetk[i,]) == 0:
-                    levelSetBg[i,].fill_(1)
-                else:
-                    Fg = targetk[i,]
-                    Bg = ~Fg
-                    levelSetFg[i,] = ndimage.distance_transform_edt(Fg)
-                    levelSetBg[i,] = ndimage.distance_transform_edt(Bg)
-                    levelSetFg[i,] = np.clip(levelSetFg[i,], 0, self.m_trancateDistance)
-                    levelSetBg[i,] = np.clip(levelSetBg[i,], 0, self.m_trancateDistance)
-
-            levelSetFgTensor = torch.from_numpy(levelSetFg).float().to(inputx.device)
-            levelSetBgTensor = torch.from_numpy(levelSetBg).float().to(inputx.device)
+            levelSetFgTensor, levelSetBgTensor = mixLevelSets(self.getClampedLevelSets, weightedTargets, k)
             x = torch.mean(-logP * self.weight[k] *levelSetFgTensor - log1_P *levelSetBgTensor,  dim=tuple([i for i in range(1, ndim)]))
             x = torch.squeeze(x)
             ret += x
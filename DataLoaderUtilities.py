@@ -0,0 +1,49 @@
+# multi-process DataLoader support for OVDataSet and OVDataSegSet
+
+import argparse
+import random
+import numpy as np
+import torch
+from torch.utils import data
+
+
+def getDataLoaderArgsUsage():
+    return "[--numWorkers N] [--prefetchFactor F] [--pinMemory 0|1]"
+
+def parseDataLoaderArgs(argv):
+    """
+    parse the optional data loading arguments following the positional arguments of a Train/Test script.
+    :param argv: the optional part of sys.argv
+    :return: argparse namespace with numWorkers, prefetchFactor, pinMemory
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--numWorkers", type=int, default=0, help="number of DataLoader worker processes; 0 loads data in main process")
+    parser.add_argument("--prefetchFactor", type=int, default=2, help="number of batches loaded in advance by each worker")
+    parser.add_argument("--pinMemory", type=int, default=1, help="1: collate batches into page-locked memory for faster transfer to GPU")
+    return parser.parse_args(argv)
+
+def seedDataWorker(workerID):
+    """
+    worker_init_fn of DataLoader: seed python random, numpy and the dataset's transform in each worker process with
+    the worker's own torch seed, which differs among workers, so that workers do not repeat same augmentations.
+    """
+    seed = torch.initial_seed() % 2**32
+    random.seed(seed)
+    np.random.seed(seed)
+    dataset = data.get_worker_info().dataset
+    if hasattr(dataset, "setRandomSeed"):
+        dataset.setRandomSeed(seed)
+
+def createDataLoader(dataset, batchSize, shuffle, loaderArgs):
+    """
+    create a DataLoader once before the epoch loop, whose workers persist across epochs when numWorkers > 0.
+    :param loaderArgs: the result of parseDataLoaderArgs
+    """
+    if loaderArgs.numWorkers > 0:
+        return data.DataLoader(dataset, batch_size=batchSize, shuffle=shuffle, num_workers=loaderArgs.numWorkers,
+                               pin_memory=loaderArgs.pinMemory > 0 and torch.cuda.is_available(),
+                               worker_init_fn=seedDataWorker, persistent_workers=True,
+                               prefetch_factor=loaderArgs.prefetchFactor)
+    else:
+        return data.DataLoader(dataset, batch_size=batchSize, shuffle=shuffle, num_workers=0,
+                               pin_memory=loaderArgs.pinMemory > 0 and torch.cuda.is_available())
@@ -4,10 +4,31 @@ import matplotlib.pyplot as plt
 import numpy as np
 import random
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from FilesUtilities import *
+from ArrayUtilities import *
+from VolumeCache import VolumeCache
+from DataPrefetcher import PrefetchGenerator, readAhead
+
+
+def readImageHeader(filename):
+    """
+    read image attributes from the file header only, without decoding voxel data.
+    It is a module-level function so that it can run in a process pool.
+    :param filename:
+    :return: a dict {"mtime":, "size":, "attr": [origin, size, spacing, direction]}, where attr is in ITK axis order
+    """
+    stat = os.stat(filename)
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(filename)
+    reader.ReadImageInformation()
+    return {"mtime": stat.st_mtime, "size": stat.st_size,
+            "attr": [reader.GetOrigin(), reader.GetSize(), reader.GetSpacing(), reader.GetDirection()]}
 
 
 class DataMgr:
+    m_volumeCache = VolumeCache(0)  # decoded volumes shared by all readImageFile callers; 0 bytes budget disables it.
+
     def __init__(self, inputsDir, labelsDir, inputSuffix, K_fold, k, logInfoFun=print):
         self.m_logInfo = logInfoFun
         self.m_oneSampleTraining = False
@@ -32,10 +53,17 @@ class DataMgr:
         self.m_noiseProb = 0  # noise probability
         self.m_noiseMean = 0
         self.m_noiseStd = 0
+        self.m_rng = np.random.default_rng()  # generator for noise augmentation, seeded by setRandomSeed
+
+        self.m_dtype = np.float32  # dtype of yielded samples: np.float32, or np.float16 to halve memory bandwidth
 
         self.m_rot90sProb = 0  # support 90, 180, 270 degree rotation
         self.m_flipProb = 0
 
+        self.m_prefetchDepth = 0  # number of batches buffered by prefetch(); 0 disables background prefetching
+        self.m_readPool = None    # threads reading files ahead inside generators
+        self.m_readAheadDepth = 0
+
         self.m_trainingSetIndices = []
         self.m_validationSetIndices = []
 
@@ -77,24 +105,118 @@ class DataMgr:
             lambdaInBeta = 1.0
         return  lambdaInBeta
 
+    def mixupGenerator(self, generator, mixup=True):
+        """
+        mix up samples within each batch of generator, instead of zipping two generators which load every sample twice.
+        Each sample is mixed with another sample of the batch chosen by a random derangement, using one lambda from getLambdaInBeta per batch.
+        :param generator: a batch generator of this DataMgr yielding (inputs, labels, ...) numpy arrays
+        :param mixup: False yields lambdaInBeta = 1, which keeps inputs unmixed, e.g. in epochs measuring segmentation.
+        :return: a generator of (mixedInputs, labels1, ..., labels2, ..., lambdaInBeta),
+                 where labels1 belong to original samples, and labels2 belong to their permuted partners.
+        """
+        for inputs, *labels1 in generator:
+            lambdaInBeta = self.getLambdaInBeta() if mixup else 1.0
+            permutation = self.getDerangement(len(inputs))
+            if lambdaInBeta != 1:
+                inputs = (inputs * lambdaInBeta + inputs[permutation] * (1 - lambdaInBeta)).astype(inputs.dtype, copy=False)
+            labels2 = [labels[permutation] for labels in labels1]
+            yield (inputs, *labels1, *labels2, lambdaInBeta)
+
+    def getDerangement(self, n):
+        """
+        :return: a random permutation of range(n) without fixed points, so no sample is mixed with itself; identity for n = 1.
+                 It shuffles range(n) and maps each element to the one a random nonzero offset after it in the shuffled order.
+        """
+        order = self.m_rng.permutation(n)
+        permutation = np.empty_like(order)
+        permutation[order] = np.roll(order, -int(self.m_rng.integers(1, n))) if n > 1 else order
+        return permutation
+
     def setAddedNoise(self, prob, mean, std):
         self.m_noiseProb = prob
         self.m_noiseMean = mean
         self.m_noiseStd = std
 
+    def setRandomSeed(self, seed):
+        self.m_rng = np.random.default_rng(seed)
+
+    def setDtype(self, dtype):
+        """
+        set the dtype of yielded samples; all intermediate stages keep float32.
+        :param dtype: np.float32 or np.float16
+        """
+        dtype = np.dtype(dtype).type
+        if dtype not in (np.float32, np.float16):
+            self.m_logInfo(f"Error: DataMgr only supports float32 or float16 samples, but got {dtype}.")
+            sys.exit(-1)
+        self.m_dtype = dtype
+        self.m_logInfo(f"Info: program yields samples in {np.dtype(self.m_dtype).name}.")
+
     def setRot90sProb(self, prob):
         self.m_rot90sProb = prob
 
     def setFlipProb(self, prob):
         self.m_flipProb = prob
 
+    def setPrefetch(self, depth, readWorkers=0):
+        """
+        :param depth: number of batches that prefetch() prepares ahead in a background thread; 0 disables it.
+        :param readWorkers: number of threads concurrently reading files inside generators; 0 reads each file on demand.
+                            Threads are enough as file decoding and numpy copies release the GIL.
+        """
+        self.m_prefetchDepth = depth
+        if self.m_readPool is not None:
+            self.m_readPool.shutdown(wait=False)
+        self.m_readPool = ThreadPoolExecutor(max_workers=readWorkers) if readWorkers > 0 else None
+        self.m_readAheadDepth = 2 * readWorkers
+        self.m_logInfo(f"Info: program prefetches {depth} batches with {readWorkers} file reading threads.")
+
+    def prefetch(self, generator):
+        """
+        wrap a batch generator of this DataMgr to run in a background thread with a bounded queue, keeping its yield contract.
+        """
+        if self.m_prefetchDepth > 0:
+            return PrefetchGenerator(generator, self.m_prefetchDepth)
+        else:
+            return generator
+
+    def readAhead(self, items, readFun):
+        """
+        :return: a generator of (item, readFun(item)), whose reads run ahead in the read pool when it is set.
+        """
+        if self.m_readPool is not None:
+            return readAhead(items, readFun, self.m_readPool, self.m_readAheadDepth)
+        else:
+            return ((item, readFun(item)) for item in items)
+
     def expandInputsDir(self, imagesDir, suffix):
         self.m_inputFilesList += getFilesList(imagesDir, suffix)
         self.m_logInfo(f'Expanding inputs dir: {imagesDir}')
         self.m_logInfo(f'Now dataMgr has {len(self.m_inputFilesList)} input files.')
 
+    @staticmethod
+    def setVolumeCacheSize(maxBytes):
+        """
+        :param maxBytes: memory budget of the decoded volume cache shared by readImageFile callers; 0 disables cache.
+        :return:
+        """
+        DataMgr.m_volumeCache.setMaxBytes(maxBytes)
+
+    @staticmethod
+    def getVolumeCacheInfo():
+        return DataMgr.m_volumeCache.getInfo()
+
     @staticmethod
     def readImageFile(filename):
+        """
+        :param filename:
+        :return: float32 numpy array. When volume cache is enabled, the returned array is read-only and shared,
+                 so caller needs to copy it before modifying it.
+        """
+        return DataMgr.m_volumeCache.get(filename, DataMgr.decodeImageFile)
+
+    @staticmethod
+    def decodeImageFile(filename):
         image = sitk.ReadImage(filename)
         dataArray = sitk.GetArrayFromImage(image).astype(np.float32)   # numpy axis order is a reverse of ITK axis order
         return dataArray
@@ -105,13 +227,29 @@ class DataMgr:
         :param filename:
         :return: a tuple including (origin, size, spacing, direction) in ITK axis order
         """
-        image = sitk.ReadImage(filename)
-        # these attributes are in ITK axis order
-        origin = image.GetOrigin()
-        size = image.GetSize()
-        spacing = image.GetSpacing()
-        direction = image.GetDirection()
-        return origin, size, spacing, direction
+        # these attributes are in ITK axis order, and are read from file header only.
+        attr = readImageHeader(filename)["attr"]
+        return tuple(tuple(x) for x in attr)
+
+    def getImageAttrDict(self, filesList, indexPath, nProcesses=None):
+        """
+        get image attributes of files from a header index persisted at indexPath, keyed by file path, mtime and size.
+        Only new or changed files read their headers, in a process pool.
+        :param filesList:
+        :param indexPath: json index file
+        :param nProcesses: number of processes to read headers; None means the number of CPUs.
+        :return: a dict {filename: (origin, size, spacing, direction)} in ITK axis order
+        """
+        filesList = [os.path.abspath(x) for x in filesList]
+        index = loadJsonIndex(indexPath)
+        staleFiles = [x for x in filesList if not isIndexEntryValid(index.get(x), x)]
+        if 0 != len(staleFiles):
+            self.m_logInfo(f'Reading image headers of {len(staleFiles)} new or changed files, please waiting......')
+            with ProcessPoolExecutor(max_workers=nProcesses) as pool:
+                for filename, entry in zip(staleFiles, pool.map(readImageHeader, staleFiles)):
+                    index[filename] = entry
+            saveJsonIndex(index, indexPath)
+        return {x: tuple(tuple(y) for y in index[x]["attr"]) for x in filesList}
 
     @staticmethod
     def saveImage(imageAttr, numpyArray, indexOffset, filename):
@@ -271,29 +409,29 @@ class DataMgr:
         return hc,wc
 
     @staticmethod
-    def segmentation2OneHotArray(segmentationArray, k)-> np.ndarray:
+    def segmentation2OneHotArray(segmentationArray, k, dtype=np.float32)-> np.ndarray:
         """
         Convert segmentation volume to one Hot array used as ground truth in neural network
         :param segmentationArray:
         :param k:  number of classification including background 0
-        :return:
+        :param dtype: dtype of the one hot array
+        :return: k*shape array, where a negative (ignored) label gets all-zero channels.
         """
-        shape = (k,)+segmentationArray.shape
-        oneHotArray = np.zeros(shape)
-        it = np.nditer(segmentationArray, flags=['multi_index'])
-        while not it.finished:
-            oneHotArray[(it[0],) + it.multi_index] = 1
-            it.iternext()
-        return oneHotArray
+        if segmentationArray.size > 0 and segmentationArray.max() >= k:
+            raise ValueError(f"labels of one hot array should be less than {k}, but got label {segmentationArray.max()}.")
+        rows = np.eye(k + 1, k, dtype=dtype)  # identity rows of labels 0..k-1, and a last zero row for negative labels
+        labels = segmentationArray.astype(np.intp)
+        labels[labels < 0] = k
+        oneHotArray = rows[labels]
+        return np.ascontiguousarray(np.moveaxis(oneHotArray, -1, 0))
 
     def checkOrientConsistent(self, imagesDir, suffix):
         self.m_logInfo(f'Program is checking image directions. Please waiting......')
-        imagesList = self.getFilesList(imagesDir, suffix)
+        imagesList = getFilesList(imagesDir, suffix)
+        attrDict = self.getImageAttrDict(imagesList, getSiblingIndexPath(imagesDir, "imageAttrIndex"))
         inconsistenNum = 0
         for filename in imagesList:
-            image = sitk.ReadImage(filename)
-            origin = image.GetOrigin()
-            direction = image.GetDirection()
+            (origin, _, _, direction) = attrDict[os.path.abspath(filename)]
             Dims = len(origin)
             fullDirection = [direction[i]for i in range(Dims*Dims)]
             diagDirection = [direction[i * Dims + i]for i in range(Dims)]
@@ -305,26 +443,18 @@ class DataMgr:
 
 
 
-    def sliceNormalize(self, array):
+    def sliceNormalize(self, array, inPlace=False):
+        """
+        min-max normalize each slice into [0,1] in float32.
+        :param array: 2D or 3D array
+        :param inPlace: True writes result into array when array is float32.
+        :return:
+        """
+        out = array if inPlace and array.dtype == np.float32 else None
         if 3 == array.ndim:
-            axesTuple = tuple([x for x in range(1, array.ndim)])
-            minx = np.min(array, axesTuple)
-            result = np.zeros(array.shape)
-            for i in range(len(minx)):
-                result[i,:] = array[i,:] - minx[i]
-            ptp = list(np.ptp(array, axesTuple)) # peak to peak
-            for i,x in enumerate(ptp):
-                if x ==0:
-                    ptp[i] = 1e-6
-            for i in range(len(ptp)):
-                result[i, :] /= ptp[i]
-            return result
+            return sliceNormalizeArray(array, out=out)
         elif 2 == array.ndim:
-            minx = np.min(array)
-            maxx = np.max(array)
-            ptp = maxx-minx if maxx-minx != 0 else 1e-6
-            result = (array - minx)/ptp
-            return result
+            return sliceNormalizeArray(array, out=out, perSlice=False)
         else:
             self.m_logInfo("Error: the input to sliceNormalize has abnormal dimension.")
             sys.exit(0)
@@ -387,14 +517,16 @@ class DataMgr:
         return diceSumList, diceCountList, TPRSumList, TPRCountList
 
     def preprocessData(self, array):
-        data = array.clip(-300,300)    # adjust window level, also erase abnormal value
-        data = self.sliceNormalize(data)
-        return data
+        data = array.astype(np.float32, copy=False).clip(-300,300)    # adjust window level, also erase abnormal value
+        data = self.sliceNormalize(data, inPlace=True)  # data is a new array from clip
+        return data.astype(self.m_dtype, copy=False)
 
     def addGaussianNoise(self, data):
         if self.m_noiseProb >0 and random.uniform(0,1) <= self.m_noiseProb:
-            noise = np.random.normal(self.m_noiseMean, self.m_noiseStd, data.shape)
-            data += noise
+            noise = self.m_rng.standard_normal(data.shape, dtype=np.float32)
+            noise *= self.m_noiseStd
+            noise += self.m_noiseMean
+            data += noise   # data is the sample's own array from preprocessData, keeping its dtype
         return data
 
     def rotate90s(self, data, label):
@@ -0,0 +1,87 @@
+# background prefetching for DataMgr generators: overlap file reading, cropping and augmentation with network compute.
+
+from collections import deque
+import queue
+import threading
+
+
+class PrefetchGenerator:
+    """
+    run a generator in a background thread, buffering at most depth items in a bounded queue.
+    It yields the same items in the same order as the wrapped generator, and re-raises its exception in the consumer.
+    """
+    def __init__(self, generator, depth=2):
+        self.m_queue = queue.Queue(maxsize=max(depth, 1))
+        self.m_stop = threading.Event()
+        self.m_finished = False
+        # the thread does not reference self, so that an abandoned PrefetchGenerator is collected and closes its thread.
+        self.m_thread = threading.Thread(target=PrefetchGenerator.produce, args=(generator, self.m_queue, self.m_stop), daemon=True)
+        self.m_thread.start()
+
+    @staticmethod
+    def produce(generator, itemQueue, stop):
+        try:
+            for item in generator:
+                if not PrefetchGenerator.put(itemQueue, stop, (False, item)):
+                    break  # consumer closed
+            else:
+                PrefetchGenerator.put(itemQueue, stop, (True, None))
+        except BaseException as e:
+            PrefetchGenerator.put(itemQueue, stop, (True, e))
+        finally:
+            generator.close()
+
+    @staticmethod
+    def put(itemQueue, stop, item):
+        # wait for a free slot, but give up when consumer closes, so that an abandoned producer does not block forever.
+        while not stop.is_set():
+            try:
+                itemQueue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.m_finished:
+            raise StopIteration
+        done, item = self.m_queue.get()
+        if done:
+            self.m_finished = True
+            self.m_thread.join()
+            if item is not None:
+                raise item
+            raise StopIteration
+        return item
+
+    def close(self):
+        self.m_finished = True
+        self.m_stop.set()
+        self.m_thread.join()
+
+    def __del__(self):
+        if not self.m_finished:
+            self.close()
+
+
+def readAhead(items, readFun, executor, depth):
+    """
+    apply readFun to items in an executor, keeping at most depth reads in flight ahead of the consumer.
+    :param items: an iterable, which is consumed in the caller's thread, so it may draw random numbers in order.
+    :param readFun: readFun(item) reads and returns the data of item; it runs in the executor's workers.
+    :param executor: a concurrent.futures executor
+    :param depth: number of reads submitted ahead
+    :return: a generator of (item, readFun(item)) in the order of items
+    """
+    pending = deque()
+    for item in items:
+        pending.append((item, executor.submit(readFun, item)))
+        if len(pending) > depth:
+            item, future = pending.popleft()
+            yield item, future.result()
+    while len(pending) > 0:
+        item, future = pending.popleft()
+        yield item, future.result()
@@ -0,0 +1,67 @@
+# bounded in-RAM bank of features from a frozen encoder, for training a head without re-running the encoder
+
+import numpy as np
+
+
+class FeatureBank:
+    """
+    keep features computed once by a frozen encoder with their labels, as a ring buffer of fixed capacity:
+    when the bank is full, a new feature replaces the oldest one.
+    Each stored feature is one (sample, augmentation draw), so several draws of a sample are kept as different entries.
+    """
+    def __init__(self, maxBytes, dtype=np.float32):
+        self.m_maxBytes = maxBytes
+        self.m_dtype = dtype  # np.float16 halves memory of the bank
+        self.m_features = None  # capacity*featureShape array, allocated at first add
+        self.m_labels = None
+        self.m_capacity = 0
+        self.m_size = 0
+        self.m_next = 0        # ring buffer position of next add
+        self.m_rng = np.random.default_rng()
+
+    def setRandomSeed(self, seed):
+        self.m_rng = np.random.default_rng(seed)
+
+    def add(self, features, labels):
+        """
+        :param features: B*featureShape numpy array, or tensor which is copied to cpu
+        :param labels: B numpy array of labels
+        """
+        if hasattr(features, "cpu"):
+            features = features.detach().cpu().numpy()
+        if self.m_features is None:
+            featureBytes = int(np.prod(features.shape[1:])) * np.dtype(self.m_dtype).itemsize
+            self.m_capacity = max(self.m_maxBytes // featureBytes, 1)
+            self.m_features = np.empty((self.m_capacity,) + features.shape[1:], dtype=self.m_dtype)
+            self.m_labels = np.empty((self.m_capacity,) + labels.shape[1:], dtype=labels.dtype)
+        for feature, label in zip(features, labels):
+            self.m_features[self.m_next] = feature
+            self.m_labels[self.m_next] = label
+            self.m_next = (self.m_next + 1) % self.m_capacity
+            self.m_size = min(self.m_size + 1, self.m_capacity)
+
+    def __len__(self):
+        return self.m_size
+
+    def clear(self):
+        self.m_size = 0
+        self.m_next = 0
+
+    def batchGenerator(self, batchSize, shuffle=True, numEntries=None):
+        """
+        :param numEntries: number of entries drawn without replacement in this pass, e.g. the size of one pass of training set,
+                           so that an epoch keeps the same number of steps when the bank holds several augmentation draws;
+                           None yields all stored entries.
+        :return: a generator of (features, labels) batches, in float32,
+                 with the same yield contract as DataMgr generators, e.g. for DataMgr.mixupGenerator.
+        """
+        indices = self.m_rng.permutation(self.m_size) if shuffle else np.arange(self.m_size)
+        if numEntries is not None:
+            indices = indices[:numEntries]
+        for start in range(0, len(indices), batchSize):
+            batchIndices = indices[start:start + batchSize]
+            yield self.m_features[batchIndices].astype(np.float32), self.m_labels[batchIndices]
+
+    def getInfo(self):
+        usedBytes = 0 if self.m_features is None else self.m_size * self.m_features[0].nbytes
+        return f"Feature bank: {self.m_size} of {self.m_capacity} features, {usedBytes / 2**20:.1f} of {self.m_maxBytes / 2**20:.1f} MB used"
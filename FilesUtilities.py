@@ -1,6 +1,8 @@
 # define some files utilities method
 
 import os
+import json
+import numpy as np
 
 def getFilesList(filesDir, suffix):
     originalCwd = os.getcwd()
@@ -39,3 +41,85 @@ def getListFromLine(line):
     line = line.replace('\t\t', '\t')
     row = line.split('\t')
     return row
+
+def loadNpyVolume(filename, mmapMode=None, dtype=np.float32):
+    """
+    load a numpy .npy volume.
+    :param filename:
+    :param mmapMode: None reads the whole file into memory;
+                     'r' or 'c' (copy-on-write) memory-maps the file, so only the pages touched by later crop/transform
+                     are read from disk, and the page cache is shared among processes reading the same file.
+    :param dtype: the wanted dtype. When the stored dtype already matches, no extra copy is made.
+    :return: numpy array or numpy memmap
+    """
+    array = np.load(filename, mmap_mode=mmapMode)
+    if array.dtype != dtype:
+        array = array.astype(dtype)
+    return array
+
+def getSiblingIndexPath(filesDir, indexName):
+    """
+    :return: the path of a json index file beside filesDir, e.g. /data/trainLabels -> /data/trainLabels_sliceIndex.json
+    """
+    filesDir = os.path.normpath(filesDir)
+    return os.path.join(os.path.dirname(filesDir), os.path.basename(filesDir) + f"_{indexName}.json")
+
+def loadJsonIndex(indexPath):
+    if os.path.isfile(indexPath):
+        with open(indexPath) as f:
+            return json.load(f)
+    else:
+        return {}
+
+def saveJsonIndex(index, indexPath):
+    tempPath = indexPath + f".{os.getpid()}.tmp"
+    with open(tempPath, "w") as f:
+        json.dump(index, f)
+    os.replace(tempPath, indexPath)  # atomic, so concurrent programs never read a half-written index.
+
+def getDistanceMapFile(labelFile):
+    """
+    :return: the precomputed distance maps file of labelFile in a sibling directory,
+             e.g. /data/labels_npy/01.npy -> /data/labels_npy_distance/01.npy
+    """
+    labelDir, name = os.path.split(os.path.abspath(labelFile))
+    return os.path.join(labelDir + "_distance", os.path.splitext(name)[0] + ".npy")
+
+def isIndexEntryValid(entry, filename):
+    """
+    :param entry: a dict including "mtime" and "size" of filename when the entry was built.
+    :return: True if filename has not changed since entry was built.
+    """
+    if entry is None:
+        return False
+    stat = os.stat(filename)
+    return entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size
+
+def savePrediction(labelMap, filename, bitPacked=False):
+    """
+    save a predicted class map in uint8.
+    :param labelMap: numpy array of class labels in [0, 256)
+    :param filename: a .npy file; when bitPacked, it is replaced with a .npz file.
+    :param bitPacked: pack a binary mask into bits with its shape, which is 8 times smaller than uint8.
+    :return: the saved filename
+    """
+    labelMap = np.asarray(labelMap, dtype=np.uint8)
+    if bitPacked:
+        assert labelMap.max(initial=0) <= 1, "only binary mask can be bit-packed"
+        filename = os.path.splitext(filename)[0] + ".npz"
+        np.savez(filename, packed=np.packbits(labelMap, axis=None), shape=np.array(labelMap.shape))
+    else:
+        np.save(filename, labelMap)
+    return filename
+
+def loadPrediction(filename):
+    """
+    load a class map saved by savePrediction.
+    :return: uint8 numpy array
+    """
+    if filename.endswith(".npz"):
+        with np.load(filename) as f:
+            shape = tuple(f["shape"])
+            return np.unpackbits(f["packed"], count=int(np.prod(shape))).reshape(shape)
+    else:
+        return np.load(filename).astype(np.uint8, copy=False)
@@ -25,6 +25,49 @@ class Image3dResponseDataMgr(ResponseDataMgr):
            self.m_logInfo(f"Error: program can not load {filePath}")
            sys.exit(-5)
 
+    def getRoiCenter(self, i, dataAugment):
+        """
+        :return: (z, x, y) ROI center of file i, randomized around a random labeled slice's mass center when dataAugment.
+        """
+        imageFileStem = self.getStemName(self.m_inputFilesList[i], self.m_inputSuffix)
+        massCenterList = self.m_massCenterDict[imageFileStem]
+        if dataAugment:
+            massCenter = random.choice(massCenterList)
+        else:
+            massCenter = massCenterList[len(massCenterList) // 2]  # non dataAugment, choose the center labeled slice
+
+        # randomize ROI to generate the center of ROI
+        z, x, y = massCenter
+        if dataAugment:
+            z = random.randrange(z - 6, z + 7, 1)  # the depth of image ROI is 145mm, max offset 20% = 29mm
+            x = random.randrange(x - 28, x + 29, 1)  # the height of image ROI is 280mm, max offset 20% = 56mm
+            y = random.randrange(y - 28, y + 29, 1)  # the width of image ROI is  280mm, max offset 20% = 56mm
+        return z, x, y
+
+    def readImageRoi(self, roiCenter):
+        """
+        :param roiCenter: (i, (z, x, y))
+        :return: image ROI of size (m_depth, m_height, m_width), e.g. (29, 140, 140)
+        """
+        i, (z, x, y) = roiCenter
+        image3d = np.load(self.m_inputFilesList[i], mmap_mode="r")  # memory-mapped: the ROI crop only reads its own pages
+        return self.cropVolumeCopyWithDstSize(image3d, z, x, y, self.m_depth // 2, self.m_height, self.m_width)
+
+    def readImageSegRoi(self, roiCenter):
+        """
+        :param roiCenter: (i, (z, x, y))
+        :return: (image ROI, segmentation ROI of size (23, 127, 127))
+        """
+        i, (z, x, y) = roiCenter
+        # for inputSize 147*281*281, and segmentation size of 127*255*255
+        # labelFile = imageFile.replace("Images_ROI_29_140_140", "Labels_ROI_23_127_127")
+        # labelFile = imageFile.replace("images_augmt_29_140_140", "labels_augmt_23_127_127")
+        labelFile = self.m_inputFilesList[i].replace("/images_npy/", "/labels_npy/")  # the image and label are original various size
+        labelGoalSize = (23, 127, 127)
+        seg3d = np.load(labelFile, mmap_mode="r")
+        roiSeg3d = self.cropVolumeCopyWithDstSize(seg3d, z, x, y, labelGoalSize[0] // 2, labelGoalSize[1], labelGoalSize[2])
+        return self.readImageRoi(roiCenter), roiSeg3d
+
     def dataResponseGenerator(self, inputFileIndices, shuffle=True, dataAugment=True, reSample=True):
         """
         yield (3DImage  - treatment Response) Tuple
@@ -40,30 +83,8 @@ class Image3dResponseDataMgr(ResponseDataMgr):
         dataList=[]  # for yield
         responseList= []
 
-        # for crop ROIs
-        imageGoalSize = (self.m_depth, self.m_height, self.m_width)  # (29, 140, 140)
-        imageRadius = imageGoalSize[0] // 2
-
-        for i in shuffledList:
-            imageFile = self.m_inputFilesList[i]
-            imageFileStem = self.getStemName(imageFile, self.m_inputSuffix)
-            massCenterList = self.m_massCenterDict[imageFileStem]
-            if dataAugment:
-                massCenter = random.choice(massCenterList)
-            else:
-                massCenter = massCenterList[len(massCenterList) // 2]  # non dataAugment, choose the center labeled slice
-
-            image3d = np.load(imageFile)
-
-            # randomize ROI to generate the center of ROI
-            z, x, y = massCenter
-            if dataAugment:
-                z = random.randrange(z - 6, z + 7, 1)  # the depth of image ROI is 145mm, max offset 20% = 29mm
-                x = random.randrange(x - 28, x + 29, 1)  # the height of image ROI is 280mm, max offset 20% = 56mm
-                y = random.randrange(y - 28, y + 29, 1)  # the width of image ROI is  280mm, max offset 20% = 56mm
-
-            roiImage3d = self.cropVolumeCopyWithDstSize(image3d, z, x, y, imageRadius, imageGoalSize[1],  imageGoalSize[2])
-
+        roiCenters = ((i, self.getRoiCenter(i, dataAugment)) for i in shuffledList)  # drawn in order, before reads ahead
+        for (i, _), roiImage3d in self.readAhead(roiCenters, self.readImageRoi):
             response = self.m_responseList[i]
 
             roiImage3d = self.preprocessData(roiImage3d)  # window level, and normalization.
@@ -112,38 +133,8 @@ class Image3dResponseDataMgr(ResponseDataMgr):
         segList = []
         responseList = []
 
-        # for crop ROIs
-        imageGoalSize = (self.m_depth, self.m_height, self.m_width)  #(29, 140, 140)
-        labelGoalSize = (23, 127, 127)
-        imageRadius = imageGoalSize[0] // 2
-        labelRadius = labelGoalSize[0] // 2
-
-        for i in shuffledList:
-            imageFile = self.m_inputFilesList[i]
-            imageFileStem = self.getStemName(imageFile, self.m_inputSuffix)
-            massCenterList = self.m_massCenterDict[imageFileStem]
-            if dataAugment:
-                massCenter = random.choice(massCenterList)
-            else:
-                massCenter = massCenterList[len(massCenterList)//2]  # non dataAugment, choose the center labeled slice
-
-            # for inputSize 147*281*281, and segmentation size of 127*255*255
-            # labelFile = imageFile.replace("Images_ROI_29_140_140", "Labels_ROI_23_127_127")
-            # labelFile = imageFile.replace("images_augmt_29_140_140", "labels_augmt_23_127_127")
-            labelFile = imageFile.replace("/images_npy/", "/labels_npy/")  # the image and label are original various size
-
-            image3d = np.load(imageFile)
-            seg3d   = np.load(labelFile)
-
-            # randomize ROI to generate the center of ROI
-            z, x, y = massCenter
-            if dataAugment:
-                z = random.randrange(z-6, z+7, 1)   # the depth of image ROI is 145mm, max offset 20% = 29mm
-                x = random.randrange(x-28, x+29, 1)   # the height of image ROI is 280mm, max offset 20% = 56mm
-                y = random.randrange(y-28, y+29, 1)   # the width of image ROI is  280mm, max offset 20% = 56mm
-
-            roiImage3d = self.cropVolumeCopyWithDstSize(image3d, z, x, y,  imageRadius, imageGoalSize[1], imageGoalSize[2])
-            roiSeg3d = self.cropVolumeCopyWithDstSize(seg3d, z, x, y,  labelRadius, labelGoalSize[1], labelGoalSize[2])
+        roiCenters = ((i, self.getRoiCenter(i, dataAugment)) for i in shuffledList)  # drawn in order, before reads ahead
+        for (i, _), (roiImage3d, roiSeg3d) in self.readAhead(roiCenters, self.readImageSegRoi):
             roi3 = roiSeg3d >= 3
             roiSeg3d[np.nonzero(roi3)] = 0  # erase label 3(lymph node)
 
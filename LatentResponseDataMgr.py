@@ -28,10 +28,8 @@ class LatentResponseDataMgr(ResponseDataMgr):
         dataList=[]  # for yield
         responseList= []
 
-        for i in shuffledList:
-            latentFile = self.m_inputFilesList[i]
+        for i, latent in self.readAhead(shuffledList, lambda i: np.load(self.m_inputFilesList[i])):
             label = self.m_responseList[i]
-            latent = np.load(latentFile)
 
             dataList.append(latent)
             responseList.append(label)
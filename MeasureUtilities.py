@@ -148,3 +148,86 @@ def getTPRSumList(predicts, labels, K):
             TPRCountList[j] += count
 
     return TPRSumList, TPRCountList
+
+
+class SegMeasureAccumulator:
+    """
+    stream Dice, TPR and TNR of segmentations over batches, keeping per-class sums on the device of the predictions,
+    so that there is no host synchronization until the lists are read back at epoch end.
+    As getDiceSumList and getTPRSumList, element 0 of the lists is for all nonzero labels as foreground,
+    element j is for label j, a sample is counted only when its label has the class, and labels <0 are ignored.
+    """
+    def __init__(self, K):
+        self.m_K = K
+        self.reset()
+
+    def reset(self):
+        self.m_sums = None  # 4*K tensor of diceSum, diceCount, TPRSum, TPRCount
+        self.m_TNRSums = None  # tensor of TNRSum, TNRCount for background
+
+    def update(self, predicts, labels):
+        """
+        :param predicts: N*... predicted label tensor, e.g. argmax of network outputs along class dim
+        :param labels: N*... ground truth tensor on the same device, where label <0 is ignored
+        """
+        K = self.m_K
+        N = labels.shape[0]
+        predicts = predicts.reshape(N, -1).long()
+        labels = labels.reshape(N, -1).long()
+        valid = labels >= 0
+        sampleIndex = torch.arange(N, device=labels.device).view(N, 1).expand_as(labels)
+        index = ((sampleIndex * K + labels) * K + predicts)[valid]
+        confusion = torch.bincount(index, minlength=N*K*K).view(N, K, K).double()  # [sample, label, predict]
+
+        TP = torch.diagonal(confusion, dim1=1, dim2=2).clone()
+        nPredict = confusion.sum(dim=1)
+        nLabel = confusion.sum(dim=2)
+        TN = confusion[:, 0, 0]
+        nNegative = nLabel[:, 0].clone()
+        TP[:, 0] = confusion[:, 1:, 1:].sum(dim=(1, 2))   # element 0 is for all nonzero labels
+        nPredict[:, 0] = nPredict[:, 1:].sum(dim=1)
+        nLabel[:, 0] = nLabel[:, 1:].sum(dim=1)
+
+        counted = (nLabel > 0).double()
+        dice = 2.0 * TP / (nPredict + nLabel).clamp(min=1) * counted
+        TPR = TP / nLabel.clamp(min=1) * counted
+        sums = torch.stack([dice.sum(dim=0), counted.sum(dim=0), TPR.sum(dim=0), counted.sum(dim=0)])
+        negativeCounted = (nNegative > 0).double()
+        TNRSums = torch.stack([(TN / nNegative.clamp(min=1) * negativeCounted).sum(), negativeCounted.sum()])
+
+        if self.m_sums is None:
+            self.m_sums, self.m_TNRSums = sums, TNRSums
+        else:
+            self.m_sums += sums
+            self.m_TNRSums += TNRSums
+
+    def updateWithOutputs(self, outputs, labels):
+        """
+        :param outputs: N*K*... network outputs, reduced by argmax along dim 1 on their device
+        :param labels: N*... ground truth tensor
+        """
+        self.update(torch.argmax(outputs, dim=1), labels)
+
+    def getDiceTPRSumLists(self):
+        """
+        read back sums with one host transfer.
+        :return: (diceSumList, diceCountList, TPRSumList, TPRCountList)
+        """
+        if self.m_sums is None:
+            return [[0 for _ in range(self.m_K)] for _ in range(4)]
+        return self.m_sums.cpu().tolist()
+
+    def getDiceTPRAvgLists(self):
+        """
+        :return: (diceAvgList, TPRAvgList), where an average without any counted sample is 0.
+        """
+        diceSumList, diceCountList, TPRSumList, TPRCountList = self.getDiceTPRSumLists()
+        diceAvgList = [x / y if y > 0 else 0 for x, y in zip(diceSumList, diceCountList)]
+        TPRAvgList = [x / y if y > 0 else 0 for x, y in zip(TPRSumList, TPRCountList)]
+        return diceAvgList, TPRAvgList
+
+    def getTNRAvg(self):
+        if self.m_TNRSums is None:
+            return 0
+        TNRSum, TNRCount = self.m_TNRSums.cpu().tolist()
+        return TNRSum / TNRCount if TNRCount > 0 else 0
@@ -1,4 +1,5 @@
 import os
+import json
 import torch
 import numpy as np
 
@@ -18,12 +19,20 @@ class NetMgr:
         netPath = self.m_netPath if netPath is None else netPath
         torch.save(self.m_net.state_dict(), os.path.join(netPath, "Net.pt"))
         torch.save(self.m_net.m_optimizer.state_dict(), os.path.join(netPath, "Optimizer.pt"))
+        # trainable flags decide which parameters the saved optimizer state covers, see BasicModel.updateOptimizerParams
+        # json, not .pt, as scripts detect a checkpoint by counting its 2 .pt files
+        with open(os.path.join(netPath, "Trainable.json"), "w") as f:
+            json.dump(self.m_net.getTrainableState(), f)
 
     def loadNet(self, mode):
         # Save on GPU, Load on GPU
         self.m_net.load_state_dict(torch.load(os.path.join(self.m_netPath, "Net.pt"), map_location=self.m_device))
         if mode == "train":
             # Moves all model parameters and buffers to the GPU.So it should be called before constructing optimizer if the module will live on GPU while being optimized.
+            trainableFile = os.path.join(self.m_netPath, "Trainable.json")
+            if os.path.isfile(trainableFile):  # re-group optimizer as saved before loading its state
+                with open(trainableFile) as f:
+                    self.m_net.setTrainableState(json.load(f))
             self.m_net.m_optimizer.load_state_dict(torch.load(os.path.join(self.m_netPath, "Optimizer.pt")))
             self.m_net.train()
         elif mode == "test":   # eval
@@ -51,6 +60,15 @@ class NetMgr:
                 bestTestPerf = 0
         return bestTestPerf
 
+    def saveTestResult(self, testResult, netPath=None):
+        """
+        record the test set result of the net saved in netPath, by default the best net chosen by validation.
+        :param testResult: dict of epoch, test loss and measures
+        """
+        netPath = self.m_netBestPath if netPath is None else netPath
+        with open(os.path.join(netPath, "testResult.json"), "w") as f:
+            json.dump(testResult, f, indent=4, default=float)  # default converts numpy scalars
+
     def saveBest(self, testPerf, netPath=None):
         netPath = self.m_netBestPath if netPath is None else netPath
         self.save(testPerf, netPath)
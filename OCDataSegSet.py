@@ -4,6 +4,7 @@
 import sys
 import random
 from FilesUtilities import *
+from ArrayUtilities import computeDistanceMaps
 import numpy as np
 import math
 import json
@@ -65,8 +66,8 @@ class OVDataSegPartition():
         for index in self.m_partitions["training"]:
             filename = self.m_inputFilesList[index]
             patientID = getStemName(filename, self.m_inputSuffix)
-            labelFile = os.path.join(self.m_inputLabelDir,patientID + self.m_inputSuffix)
-            label = np.load(labelFile)
+            labelFile = self.getLabelFile(patientID)
+            label = np.load(labelFile, mmap_mode='r')
             count1 += np.sum((label > 0).astype(int))
             countAll += label.size
         count0 = countAll - count1
@@ -77,26 +78,64 @@ class OVDataSegPartition():
         self.m_logInfo(f"loss weight = {lossWeight}")
         return lossWeight
 
+    def getLabelFile(self, patientID):
+        return os.path.join(self.m_inputLabelDir, patientID + self.m_inputSuffix)
+
+    def prepareDistanceMaps(self):
+        """
+        precompute the foreground/background distance maps of all label files once, saving them beside the labels dir,
+        so that distance losses read them with labels instead of running distance transforms in each training step.
+        A distance maps file older than its label file is recomputed.
+        """
+        count = 0
+        for filename in self.m_inputFilesList:
+            patientID = getStemName(filename, self.m_inputSuffix)
+            labelFile = self.getLabelFile(patientID)
+            distanceFile = getDistanceMapFile(labelFile)
+            if os.path.isfile(distanceFile) and os.path.getmtime(distanceFile) >= os.path.getmtime(labelFile):
+                continue
+            label = np.load(labelFile, mmap_mode='r')
+            os.makedirs(os.path.dirname(distanceFile), exist_ok=True)
+            tempFile = distanceFile + f".{os.getpid()}.tmp.npy"
+            np.save(tempFile, computeDistanceMaps(label > 0))
+            os.replace(tempFile, distanceFile)  # atomic, so concurrent programs never read a half-written file.
+            count += 1
+        self.m_logInfo(f"Info: computed distance maps of {count} new or changed label files beside {self.m_inputLabelDir}")
+
 class OVDataSegSet(data.Dataset):
-    def __init__(self, name, dataPartitions, transform=None, logInfoFun=print):
+    def __init__(self, name, dataPartitions, transform=None, logInfoFun=print, mmapMode=None, withDistanceMaps=False):
         self.m_dataPartitions = dataPartitions
         self.m_dataIDs = self.m_dataPartitions.m_partitions[name]
         self.m_transform = transform
+        self.m_mmapMode = mmapMode  # None, 'r' or 'c'; 'c' (copy-on-write) is recommended for memory-mapped loading.
+        self.m_withDistanceMaps = withDistanceMaps  # also return the 2*d*h*w distance maps from dataPartitions.prepareDistanceMaps()
         self.m_logInfo = logInfoFun
         self.m_logInfo(f"\n{name} dataset: total {len(self.m_dataIDs)} image files.")
 
+    def setRandomSeed(self, seed):
+        if self.m_transform and hasattr(self.m_transform, "setRandomSeed"):
+            self.m_transform.setRandomSeed(seed)
+
     def __len__(self):
         return len(self.m_dataIDs)
 
     def __getitem__(self, index):
         ID = self.m_dataIDs[index]
         filename = self.m_dataPartitions.m_inputFilesList[ID]
-        data = np.load(filename).astype(np.float32)
+        data = loadNpyVolume(filename, self.m_mmapMode)
 
         patientID = getStemName(filename, self.m_dataPartitions.m_inputSuffix)
         if self.m_dataPartitions.m_inputLabelDir is not None:
-            labelFile = os.path.join(self.m_dataPartitions.m_inputLabelDir, patientID+self.m_dataPartitions.m_inputSuffix)
-            label = np.load(labelFile).astype(np.float32)
+            labelFile = self.m_dataPartitions.getLabelFile(patientID)
+            label = loadNpyVolume(labelFile, self.m_mmapMode)
+
+            if self.m_withDistanceMaps:
+                distances = loadNpyVolume(getDistanceMapFile(labelFile), self.m_mmapMode)
+                if self.m_transform:
+                    data, label, distances = self.m_transform(data, label, distances)
+                else:
+                    data, label, distances = torch.from_numpy(data), torch.from_numpy(label), torch.from_numpy(distances)
+                return data.unsqueeze(dim=0), label, distances, patientID
 
             if self.m_transform:
                 data, label = self.m_transform(data, label)
@@ -90,10 +90,11 @@ class OVDataPartition():
 
 
 class OVDataSet(data.Dataset):
-    def __init__(self, name, dataPartitions, transform=None, logInfoFun=print):
+    def __init__(self, name, dataPartitions, transform=None, logInfoFun=print, mmapMode=None):
         self.m_dataPartitions = dataPartitions
         self.m_dataIDs = self.m_dataPartitions.m_partitions[name]
         self.m_transform = transform
+        self.m_mmapMode = mmapMode  # None, 'r' or 'c'; 'c' (copy-on-write) is recommended for memory-mapped loading.
         self.m_logInfo = logInfoFun
         self.m_labels = self.getLabels(self.m_dataIDs)
         if isinstance(self.m_labels[0], float):
@@ -107,6 +108,10 @@ class OVDataSet(data.Dataset):
         else:
             self.m_logInfo(f"something wrong in OVDataSet init function")
 
+    def setRandomSeed(self, seed):
+        if self.m_transform and hasattr(self.m_transform, "setRandomSeed"):
+            self.m_transform.setRandomSeed(seed)
+
     def __len__(self):
         return len(self.m_labels)
 
@@ -115,7 +120,7 @@ class OVDataSet(data.Dataset):
         filename = self.m_dataPartitions.m_inputFilesList[ID]
         patientID = getStemName(filename, self.m_dataPartitions.m_inputSuffix)
 
-        data = np.load(filename).astype(np.float32)
+        data = loadNpyVolume(filename, self.m_mmapMode)
         label = self.m_labels[index]
         if isinstance(label, list):
             label = torch.tensor(label).t()
@@ -1,28 +1,92 @@
 # data transform for Ovarian Cancer
 
-import torchvision.transforms.functional as TF
 import random
-import PIL
 import torch
+import torch.nn.functional as F
 import math
 
 # notes: from nrrd to numpy, the patient data have performed window level shreshold, [0,1] normalization with non-zero mean, and 0-padding to [231,251,251]
 
+def getAffineTheta(angle, translate, scale, shear, h, w):
+    """
+    get the normalized theta for F.affine_grid(align_corners=True) of the in-plane affine transform, which is the
+    same inverse mapping from output pixel to input pixel as TF.affine(img, angle, translate, scale, shear) on a PIL image.
+    :param angle: degree
+    :param translate: (tx, ty) in pixels along width and height
+    :param scale:
+    :param shear: degree
+    :param h: height of image
+    :param w: width of image
+    :return: 2*3 float32 tensor
+    """
+    angle = math.radians(angle)
+    shear = math.radians(shear)
+    d = math.cos(angle + shear) * math.cos(angle) + math.sin(angle + shear) * math.sin(angle)
+    # inverse matrix of rotation, scale and shear in pixel coordinates, as in TF._get_inverse_affine_matrix
+    m = [math.cos(angle + shear), math.sin(angle + shear), -math.sin(angle), math.cos(angle)]
+    m = [x / (scale * d) for x in m]
+    ax, ay = (w - 1) * 0.5, (h - 1) * 0.5  # normalized coordinate x_n = (x - ax)/ax
+    dx, dy = -0.5, -0.5   # ax - center, where PIL rotates around pixel index (w/2, h/2)
+    tx, ty = translate
+    # input pixel = M * (output pixel - center - translate) + center, converted into normalized coordinates.
+    theta = torch.tensor([[m[0], m[1] * ay / ax, (m[0] * (dx - tx) + m[1] * (dy - ty) - dx) / ax],
+                          [m[2] * ax / ay, m[3], (m[2] * (dx - tx) + m[3] * (dy - ty) - dy) / ay]], dtype=torch.float32)
+    return theta
+
+def affineSlices(volumes, thetas, mode, paddingMode='zeros'):
+    """
+    apply a same in-plane affine transform to all slices of each volume in one grid_sample call, treating slices as channels.
+    :param volumes: B*d*h*w float tensor
+    :param thetas: B*2*3 tensor from getAffineTheta
+    :param mode: 'bilinear' for data, or 'nearest' for labels
+    :param paddingMode: 'zeros' fills 0 outside of input; 'border' repeats the border values of input.
+    :return: B*d*h*w tensor
+    """
+    thetas = thetas.to(device=volumes.device, dtype=volumes.dtype)
+    grid = F.affine_grid(thetas, list(volumes.shape), align_corners=True)
+    return F.grid_sample(volumes, grid, mode=mode, padding_mode=paddingMode, align_corners=True)
+
+def affineDistanceMaps(distances, thetas, labels, scales):
+    """
+    apply the affine transform of labels to their foreground/background distance maps.
+    :param distances: B*2*d*h*w float tensor from ArrayUtilities.computeDistanceMaps
+    :param thetas: B*2*3 tensor, same with labels
+    :param labels: B*d*h*w transformed labels
+    :param scales: B scales of the affine transforms from getRandomParameters, which multiply the interpolated distances.
+    :return: B*2*d*h*w tensor, whose foreground distance is 0 on transformed background, and vice versa;
+             a sample whose foreground moves out of view gets 0 foreground and 1 background distance, as computeDistanceMaps.
+    :Notes: the scaled distance ignores the anisotropy of shear and the unscaled z axis, so it approximates the exact distance.
+    """
+    B, C, d, h, w = distances.shape
+    distances = affineSlices(distances.reshape(B, C*d, h, w), thetas, 'bilinear', 'border').reshape(B, C, d, h, w)
+    distances *= torch.as_tensor(scales, dtype=distances.dtype, device=distances.device).view(B, 1, 1, 1, 1)
+    foreground = (labels > 0).to(distances.dtype)
+    distances[:, 0] *= foreground
+    distances[:, 1] *= 1 - foreground
+    emptyForeground = (foreground.reshape(B, -1).sum(dim=1) == 0)
+    distances[emptyForeground, 1] = 1
+    return distances
+
+
 class OCDataTransform(object):
     def __init__(self, prob =0):
         self.m_prob = prob
+        self.m_random = random.Random()  # own generator, reseeded in each DataLoader worker by setRandomSeed
 
-    def __call__(self, data):
-        d,h,w = data.shape
+    def setRandomSeed(self, seed):
+        self.m_random.seed(seed)
 
-        # specific parameters of affine transform for each slice
+    def getRandomParameters(self):
+        """
+        :return: (affine, angle, translate, scale, shear) of a random in-plane affine transform
+        """
         while True:
-            if random.uniform(0, 1) < self.m_prob:
+            if self.m_random.uniform(0, 1) < self.m_prob:
                 affine = True
-                angle = random.randrange(-180, 180, 10)
-                translate = random.randrange(-38, 39, 3), random.randrange(-38, 39, 3)  # 15% of maxsize of Y, X
-                scale = random.uniform(0.6, 1.25)
-                shear = random.randrange(-30, 31, 10)  #90 degree is too big, which almost compresses image into a line.
+                angle = self.m_random.randrange(-180, 180, 10)
+                translate = self.m_random.randrange(-38, 39, 3), self.m_random.randrange(-38, 39, 3)  # 15% of maxsize of Y, X
+                scale = self.m_random.uniform(0.6, 1.25)
+                shear = self.m_random.randrange(-30, 31, 10)  #90 degree is too big, which almost compresses image into a line.
             else:
                 affine = False
                 angle = 0
@@ -35,19 +99,15 @@ class OCDataTransform(object):
             dInAffine = math.cos(angle1 + shear1) * math.cos(angle1) + math.sin(angle1 + shear1) * math.sin(angle1)
             if  0 != dInAffine:
                 break
+        return affine, angle, translate, scale, shear
 
-        # create output tensor
-        outputTensor = torch.zeros((d,h,w), dtype=torch.float32)
-
-        for z in range(d):
-            slice = data[z,]  # normalized array
-            # affine transform
-            if affine:
-                # to PIL image
-                slice = TF.to_pil_image(slice)
-                slice = TF.affine(slice, angle, translate, scale, shear, resample=PIL.Image.BILINEAR, fillcolor=0)
-            # to tensor
-            outputTensor[z,] = TF.to_tensor(slice)
+    def __call__(self, data):
+        outputTensor = torch.as_tensor(data, dtype=torch.float32)  # normalized array
+        affine, angle, translate, scale, shear = self.getRandomParameters()
+        if affine:
+            d,h,w = outputTensor.shape
+            theta = getAffineTheta(angle, translate, scale, shear, h, w)
+            outputTensor = affineSlices(outputTensor.unsqueeze(0), theta.unsqueeze(0), 'bilinear').squeeze(0)
         return outputTensor
 
     def __repr__(self):
@@ -56,21 +116,24 @@ class OCDataTransform(object):
 class OCDataLabelTransform(object):
     def __init__(self, prob =0):
         self.m_prob = prob
+        self.m_random = random.Random()  # own generator, reseeded in each DataLoader worker by setRandomSeed
 
-    def __call__(self, data, label):
-        assert data.shape == label.shape
-        d,h,w = data.shape
+    def setRandomSeed(self, seed):
+        self.m_random.seed(seed)
 
-        # specific parameters of affine transform for each slice.
+    def getRandomParameters(self):
+        """
+        :return: (affine, angle, translate, scale, shear, zShift) of a random in-plane affine transform and z roll
+        """
         # todo: think to use gaussion to replace randrange int the future
         while True:
-            if random.uniform(0, 1) < self.m_prob:
+            if self.m_random.uniform(0, 1) < self.m_prob:
                 affine = True
-                angle = random.randrange(-180, 180, 10)
-                translate = random.randrange(-25, 26, 3), random.randrange(-25, 26, 3)  # 15% of maxsize of Y, X
-                scale = random.uniform(0.6, 1.25)
-                shear = random.randrange(-20, 21, 5)  #90 degree is too big, which almost compresses image into a line.
-                zShift = random.randrange(-7, 8, 3)  # 15% of maxSize of Z
+                angle = self.m_random.randrange(-180, 180, 10)
+                translate = self.m_random.randrange(-25, 26, 3), self.m_random.randrange(-25, 26, 3)  # 15% of maxsize of Y, X
+                scale = self.m_random.uniform(0.6, 1.25)
+                shear = self.m_random.randrange(-20, 21, 5)  #90 degree is too big, which almost compresses image into a line.
+                zShift = self.m_random.randrange(-7, 8, 3)  # 15% of maxSize of Z
             else:
                 affine = False
                 angle = 0
@@ -84,33 +147,36 @@ class OCDataLabelTransform(object):
             dInAffine = math.cos(angle1 + shear1) * math.cos(angle1) + math.sin(angle1 + shear1) * math.sin(angle1)
             if  0 != dInAffine:
                 break
+        return affine, angle, translate, scale, shear, zShift
 
-        # create output data and label
-        outputData = torch.zeros((d,h,w), dtype=torch.float32)
-        outputLabel = torch.zeros((d, h, w), dtype=torch.float32)
-        
-        for z in range(d):
-            dataSlice = data[z,]  # normalized array
-            labelSlice = label[z,]
-            # affine transform
-            if affine:
-                # to PIL image
-                dataSlice = TF.to_pil_image(dataSlice)
-                dataSlice = TF.affine(dataSlice, angle, translate, scale, shear, resample=PIL.Image.BILINEAR, fillcolor=0)
-
-                labelSlice = TF.to_pil_image(labelSlice)
-                labelSlice = TF.affine(labelSlice, angle, translate, scale, shear, resample=PIL.Image.NEAREST, fillcolor=0)
-                
-            # to tensor
-            outputData[z,] = TF.to_tensor(dataSlice)
-            outputLabel[z,] = TF.to_tensor(labelSlice)
-
-        # roll along z direction
-        if affine and zShift != 0:
-            outputData = torch.roll(outputData, zShift, dims=0)
-            outputLabel = torch.roll(outputLabel, zShift, dims=0)
-
-        return outputData, outputLabel
+    def __call__(self, data, label, distances=None):
+        """
+        :param distances: optional 2*d*h*w foreground/background distance maps of label, transformed with the same affine.
+        :return: (data, label), or (data, label, distances) when distances is given.
+        """
+        assert data.shape == label.shape
+        outputData = torch.as_tensor(data, dtype=torch.float32)  # normalized array
+        outputLabel = torch.as_tensor(label, dtype=torch.float32)
+        outputDistances = None if distances is None else torch.as_tensor(distances, dtype=torch.float32)
+        affine, angle, translate, scale, shear, zShift = self.getRandomParameters()
+        if affine:
+            d,h,w = outputData.shape
+            theta = getAffineTheta(angle, translate, scale, shear, h, w).unsqueeze(0)
+            outputData = affineSlices(outputData.unsqueeze(0), theta, 'bilinear').squeeze(0)
+            outputLabel = affineSlices(outputLabel.unsqueeze(0), theta, 'nearest').squeeze(0)
+            if outputDistances is not None:
+                outputDistances = affineDistanceMaps(outputDistances.unsqueeze(0), theta, outputLabel.unsqueeze(0), [scale]).squeeze(0)
+
+            # roll along z direction
+            if zShift != 0:
+                outputData = torch.roll(outputData, zShift, dims=0)
+                outputLabel = torch.roll(outputLabel, zShift, dims=0)
+                if outputDistances is not None:
+                    outputDistances = torch.roll(outputDistances, zShift, dims=1)
+
+        if outputDistances is None:
+            return outputData, outputLabel
+        return outputData, outputLabel, outputDistances
 
     def __repr__(self):
         return self.__class__.__name__
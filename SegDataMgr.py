@@ -2,8 +2,28 @@ import os
 import numpy as np
 import random
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from scipy.misc import imsave
 from DataMgr import DataMgr
+from FilesUtilities import *
+
+
+def buildSliceIndexEntry(labelFile):
+    """
+    compute the label counts of each labeled slice in a label file, with the file stat as the key of validity.
+    It is a module-level function so that it can run in a process pool.
+    :param labelFile:
+    :return: a dict {"mtime":, "size":, "sliceCounts": [[sliceID, [count of label 0, count of label 1, ...]], ...]},
+             where only slices with nonzero labels are recorded.
+    """
+    stat = os.stat(labelFile)
+    labelArray = DataMgr.decodeImageFile(labelFile).astype(np.int64)
+    nLabels = max(int(labelArray.max()) + 1, 1)
+    counts = SegDataMgr.batchLabelCounts(labelArray, nLabels)
+    labeledSlices = np.nonzero(counts[:, 1:].sum(axis=1))[0]
+    return {"mtime": stat.st_mtime, "size": stat.st_size,
+            "sliceCounts": [[int(j), counts[j].tolist()] for j in labeledSlices]}
+
 
 class SegDataMgr(DataMgr):
     def __init__(self, inputsDir, labelsDir, inputSuffix, logInfoFun=print):
@@ -18,6 +38,7 @@ class SegDataMgr(DataMgr):
 
         self.m_segDir = None
         self.m_segSliceTupleList = []
+        self.m_sliceLabelCountsList = []  # for each input file, a dict {sliceID: [count of label 0, count of label 1, ...]}
         self.m_imageAttrList = []
 
         self.m_binaryLabel = False
@@ -83,17 +104,31 @@ class SegDataMgr(DataMgr):
                 del result[result.index(x)]
         return result
 
-    def buildSegSliceTupleList(self):
+    def buildSegSliceTupleList(self, nProcesses=None):
         """
         build segmented slice tuple list, in each tuple (fileID, segmentedSliceID)
+        The per-slice label counts of each label file are persisted beside the labels directory, keyed by file path, mtime and size,
+        so only new or changed label files are read again, in a process pool.
+        :param nProcesses: number of processes to read label files; None means the number of CPUs.
         :return:
         """
-        self.m_logInfo(f'Building the Segmented Slice Tuple list, which may need 8 mins, please waiting......')
+        labelFiles = [os.path.abspath(self.getLabelFile(image)) for image in self.m_inputFilesList]
+        indexPath = getSiblingIndexPath(self.m_labelsDir, "sliceIndex")
+        index = loadJsonIndex(indexPath)
+        staleFiles = [label for label in labelFiles if not isIndexEntryValid(index.get(label), label)]
+        if 0 != len(staleFiles):
+            self.m_logInfo(f'Indexing labeled slices of {len(staleFiles)} new or changed label files in {self.m_labelsDir}, please waiting......')
+            with ProcessPoolExecutor(max_workers=nProcesses) as pool:
+                for label, entry in zip(staleFiles, pool.map(buildSliceIndexEntry, staleFiles)):
+                    index[label] = entry
+            saveJsonIndex(index, indexPath)
+
         self.m_segSliceTupleList = []
-        for i, image in enumerate(self.m_inputFilesList):
-            label = self.getLabelFile(image)
-            labelArray = self.readImageFile(label)
-            sliceList = self.getLabeledSliceIndex(labelArray)
+        self.m_sliceLabelCountsList = []
+        for i, label in enumerate(labelFiles):
+            sliceCounts = {j: counts for j, counts in index[label]["sliceCounts"]}
+            self.m_sliceLabelCountsList.append(sliceCounts)
+            sliceList = self.getLabeledSliceIndexFromCounts(sliceCounts)
             for j in sliceList:
                 self.m_segSliceTupleList.append((i, j))
 
@@ -103,21 +138,37 @@ class SegDataMgr(DataMgr):
 
     def buildImageAttrList(self):
         """
-        build a list of tuples including (origin, size, spacing, direction) in ITK axis order
+        build a list of tuples including (origin, size, spacing, direction) in ITK axis order, from the persisted header index.
         :return: void
         """
-        self.m_logInfo(f"Building image attributes list, please waiting......")
-        self.m_imageAttrList = []
-        for image in self.m_inputFilesList:
-            attr = self.getImageAttributes(image)
-            self.m_imageAttrList.append(attr)
+        attrDict = self.getImageAttrDict(self.m_inputFilesList, getSiblingIndexPath(self.m_inputsDir, "imageAttrIndex"))
+        self.m_imageAttrList = [attrDict[os.path.abspath(image)] for image in self.m_inputFilesList]
 
 
 
     def getLabeledSliceIndex(self,labelArray):
         labelArray = self.suppressedLabels(labelArray, binarize=False)
         nonzeroSlices = labelArray.sum((1, 2)).nonzero() # a tuple of arrays
-        nonzeroSlices = nonzeroSlices[0]
+        return self.getSliceRunCenters(nonzeroSlices[0])
+
+    def getLabeledSliceIndexFromCounts(self, sliceCounts):
+        """
+        :param sliceCounts: a dict {sliceID: [count of label 0, count of label 1, ...]}
+        :return: the same result with getLabeledSliceIndex on the label array.
+        """
+        nonzeroSlices = []
+        for j in sorted(sliceCounts.keys()):
+            counts = sliceCounts[j]
+            if any(counts[x] > 0 for x in range(1, len(counts)) if x not in self.m_suppressedLabels):
+                nonzeroSlices.append(j)
+        return self.getSliceRunCenters(nonzeroSlices)
+
+    @staticmethod
+    def getSliceRunCenters(nonzeroSlices):
+        """
+        :param nonzeroSlices: ascending slice indices with nonzero labels
+        :return: the center slice of each run of continuous slices
+        """
         result = []
         if 0 == len(nonzeroSlices):
             return result
@@ -133,6 +184,13 @@ class SegDataMgr(DataMgr):
         result.append((previous + start) / 2)
         return [int(round(x, 0)) for x in result]
 
+    def getSliceLabelCounts(self, fileIndex):
+        """
+        :param fileIndex: index in m_inputFilesList
+        :return: a dict {sliceID: [count of label 0, count of label 1, ...]} of labeled slices, built in buildSegSliceTupleList
+        """
+        return self.m_sliceLabelCountsList[fileIndex]
+
 
 
 
@@ -154,40 +212,68 @@ class SegDataMgr(DataMgr):
             wc += random.randrange(-self.m_maxShift, self.m_maxShift+1)
         return hc, wc
 
-    def dataLabelGenerator(self, inputFileIndices, shuffle=True):
+    def shuffleGroupedByFile(self, sliceTupleIndices, filesPerWindow):
+        """
+        shuffle the order of files, then shuffle the slices of each window of filesPerWindow consecutive files together,
+        so that a batch mixes slices of different volumes, while the volume cache only needs to hold the files of one window.
+        :param sliceTupleIndices: indices into m_segSliceTupleList
+        :param filesPerWindow: number of files whose slices interleave; at least batch size keeps batches mixed across volumes.
+        :return: a new shuffled list
+        """
+        fileGroups = {}
+        for n in sliceTupleIndices:
+            fileGroups.setdefault(self.m_segSliceTupleList[n][0], []).append(n)
+        groupList = list(fileGroups.values())
+        random.shuffle(groupList)
+        result = []
+        for start in range(0, len(groupList), filesPerWindow):
+            window = [n for group in groupList[start:start + filesPerWindow] for n in group]
+            random.shuffle(window)
+            result += window
+        return result
+
+    def readSliceTupleFiles(self, n):
+        """
+        :return: (imageArray, labelArray) of the file of the n-th slice tuple.
+        """
+        imageFile = self.m_inputFilesList[self.m_segSliceTupleList[n][0]]
+        return self.readImageFile(imageFile), self.readImageFile(self.getLabelFile(imageFile))
+
+    def dataLabelGenerator(self, inputFileIndices, shuffle=True, groupByFile=False):
         """
         support 2D or 3D data shuffle
         :param shuffle: True or False
+        :param groupByFile: when shuffle, interleave slices of a window of files at a time to make use of volume cache,
+                            where the window has max(4*batchSize, 16) files, so batches still mix volumes.
         :return:
         """
         shuffledList = inputFileIndices.copy()
         if shuffle:
-            random.shuffle(shuffledList)
+            if groupByFile:
+                shuffledList = self.shuffleGroupedByFile(shuffledList, max(4 * self.m_batchSize, 16))
+            else:
+                random.shuffle(shuffledList)
 
         batch = 0
         dataList=[]  # for yield
         labelList= []
         radius = int((self.m_depth-1)/2)
 
-        for n in shuffledList:
+        for n, (imageArray, labelArray) in self.readAhead(shuffledList, self.readSliceTupleFiles):
             (i,j) = self.m_segSliceTupleList[n]  # i is the imageID, j is the segmented slice index in image i.
-            imageFile = self.m_inputFilesList[i]
-            labelFile = self.getLabelFile(imageFile)
-            labelArray = self.readImageFile(labelFile)
             labelArrayJ = np.copy(labelArray[j])
 
             labelArrayJ = self.suppressedLabels(labelArrayJ, binarize=True)   # always erase label 3 as it only has 5 slices in dataset
             if 0 == np.count_nonzero(labelArrayJ):
                  continue
 
-            imageArray = self.readImageFile(imageFile)
             imageArray, labelArrayJ = self.rotate90s(imageArray, labelArrayJ)  # rotation data augmentation
 
             (hc,wc) =  self.getLabelHWCenter(labelArrayJ) # hc: height center, wc: width center
             (hc,wc) = self.randomTranslation(hc, wc) # translation data augmentation
 
             if batch >= self.m_batchSize:
-                yield np.stack(dataList, axis=0), np.stack(labelList, axis=0)
+                yield self.batchJitterNoise(np.stack(dataList, axis=0)), np.stack(labelList, axis=0)
                 batch = 0
                 dataList.clear()
                 labelList.clear()
@@ -213,7 +299,7 @@ class SegDataMgr(DataMgr):
             batch +=1
 
         if 0 != len(dataList) and 0 != len(labelList): # PyTorch supports dynamic batchSize.
-            yield np.stack(dataList, axis=0), np.stack(labelList, axis=0)
+            yield self.batchJitterNoise(np.stack(dataList, axis=0)), np.stack(labelList, axis=0)
 
         # clean field
         dataList.clear()
@@ -227,31 +313,51 @@ class SegDataMgr(DataMgr):
 
 
     def jitterNoise(self, data):
+        """
+        replace each voxel with a random neighbor within jitterRadius along every axis, clipped at the border.
+        """
         if self.m_jitterProb > 0 and self.m_jitterRadius >0  and  random.uniform(0, 1) <= self.m_jitterProb:
-            ret = np.zeros(data.shape)
-            dataIt = np.nditer(data, flags=['multi_index'])
-            shape = data.shape
-            while not dataIt.finished:
-                index = dataIt.multi_index
-                indexNew = self.indexDrift(index, shape, self.m_jitterRadius)
-                ret[index] = data[indexNew]
-                dataIt.iternext()
-            return ret
+            flatIndex = self.getJitterFlatIndex(data.shape, self.m_jitterRadius, self.m_rng, 1)
+            return data.reshape(-1)[flatIndex[0]].reshape(data.shape)
         else:
             return data
 
+    def batchJitterNoise(self, batchData):
+        """
+        jitter the spatial axes of each sample in a N*C*... batch with probability jitterProb, using an independent
+        random displacement field for each chosen sample and a same field for all channels of a sample.
+        :return: a new batch array, or batchData itself when no sample is chosen.
+        """
+        if self.m_jitterProb <= 0 or self.m_jitterRadius <= 0:
+            return batchData
+        N, C = batchData.shape[0:2]
+        chosen = np.nonzero(self.m_rng.uniform(0, 1, N) <= self.m_jitterProb)[0]
+        if 0 == len(chosen):
+            return batchData
+        spatialShape = batchData.shape[2:]
+        flatIndex = self.getJitterFlatIndex(spatialShape, self.m_jitterRadius, self.m_rng, len(chosen))
+        flatData = batchData[chosen].reshape(len(chosen), C, -1)
+        ret = batchData.copy()
+        ret[chosen] = np.take_along_axis(flatData, flatIndex[:, np.newaxis, :], axis=2).reshape((len(chosen), C) + spatialShape)
+        return ret
+
     @staticmethod
-    def indexDrift(index, shape, radius):
-        ndim = len(shape)
-        retIndex = ()
-        for i in range(ndim):
-            newIndex = index[i]+ random.randrange(-radius, radius+1, 1)
-            if newIndex >= shape[i]:
-                newIndex = shape[i]-1
-            if newIndex <0:
-                newIndex = 0
-            retIndex +=(newIndex,)
-        return retIndex
+    def getJitterFlatIndex(shape, radius, rng, n):
+        """
+        draw n random integer displacement fields in [-radius, radius] for every axis of shape, and clip the drifted
+        coordinates into the array.
+        :return: n*prod(shape) array of flat indices into an array of shape.
+        """
+        flatIndex = np.zeros((n,) + tuple(shape), dtype=np.intp)
+        for axis, size in enumerate(shape):
+            coordShape = [1]*(len(shape)+1)
+            coordShape[axis+1] = size
+            coord = np.arange(size, dtype=np.intp).reshape(coordShape)
+            drifted = coord + rng.integers(-radius, radius+1, size=flatIndex.shape, dtype=np.intp)
+            np.clip(drifted, 0, size-1, out=drifted)
+            flatIndex *= size   # row-major flat index accumulation
+            flatIndex += drifted
+        return flatIndex.reshape(n, -1)
 
     def saveInputsSegmentations2Images(self, inputs, labels, segmentations, n):
         """
@@ -296,23 +402,38 @@ class SegDataMgr(DataMgr):
 
 
 
+    @staticmethod
+    def checkLabelRange(labelArray, k):
+        """
+        raise ValueError if labelArray has a label out of [0, k), which bincount would count in a wrong bin.
+        """
+        if labelArray.size > 0 and (labelArray.min() < 0 or labelArray.max() >= k):
+            raise ValueError(f"labels should be in [0, {k}), but got labels in [{labelArray.min()}, {labelArray.max()}].")
+
     @staticmethod
     def labelStatistic(labelArray, k):
-        statisList = [0]*k
-        for x in np.nditer(labelArray):
-            statisList[x] +=1
-        return statisList
+        """
+        :return: a list of pixel counts of label 0, 1, ..., k-1 in labelArray.
+        """
+        SegDataMgr.checkLabelRange(labelArray, k)
+        return np.bincount(labelArray.astype(np.intp, copy=False).ravel(), minlength=k).tolist()
 
-    def batchLabelStatistic(self, batchLabelArray, k):
+    @staticmethod
+    def batchLabelCounts(batchLabelArray, k):
+        """
+        count labels of each sample in a batch with one bincount, by offsetting the labels of sample i with i*k.
+        :param batchLabelArray: N*... integral label array with labels in [0, k)
+        :return: N*k numpy array of counts
+        """
+        SegDataMgr.checkLabelRange(batchLabelArray, k)
         N = batchLabelArray.shape[0]
-        labelStatisSum = [0]*k
-        sliceStatisSum = [0]*k
-        for i in range(N):
-            labelStatis = self.labelStatistic(batchLabelArray[i], k)
-            for index, x in enumerate(labelStatis):
-                if 0 !=x:
-                    sliceStatisSum[index] +=1
-            labelStatisSum = [x+y for x,y in zip(labelStatisSum, labelStatis)]
+        offsetLabels = batchLabelArray.reshape(N, -1).astype(np.intp) + np.arange(N, dtype=np.intp).reshape(N, 1) * k
+        return np.bincount(offsetLabels.ravel(), minlength=N * k).reshape(N, k)
+
+    def batchLabelStatistic(self, batchLabelArray, k):
+        counts = self.batchLabelCounts(batchLabelArray, k)
+        labelStatisSum = counts.sum(axis=0).tolist()
+        sliceStatisSum = np.count_nonzero(counts, axis=0).tolist()
         return labelStatisSum, sliceStatisSum
 
 
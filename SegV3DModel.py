@@ -4,6 +4,7 @@ import torch.nn.functional as F
 
 from BasicModel import BasicModel
 from ConvBlocks import *
+from CustomizedLoss import BoundaryLoss3, DistanceCrossEntropyLoss
 
 
 #  3D model
@@ -161,7 +162,7 @@ class SegV3DModel(BasicModel):
             nn.Conv3d(32, 2, kernel_size=3, stride=1, padding=1)
         )  # output size:2*51*171*171
 
-    def forward(self, x, gts):
+    def forward(self, x, gts, distanceMaps=None):
         # compute outputs
         x0 = self.m_down0(x)
 
@@ -205,6 +206,9 @@ class SegV3DModel(BasicModel):
             if weight == 0:
                 continue
             lossFunc.to(x.device)
-            loss += lossFunc(outputs, gts) * weight
+            if distanceMaps is not None and isinstance(lossFunc, (BoundaryLoss3, DistanceCrossEntropyLoss)):
+                loss += lossFunc(outputs, gts, distanceMaps) * weight  # precomputed distance maps of gts
+            else:
+                loss += lossFunc(outputs, gts) * weight
 
         return outputs, loss
@@ -40,15 +40,34 @@ class SkyWatcherModel(BasicModel):
         return xup
 
 
-    def forward(self, inputx, bPurePrediction=False):
-        x = self.encoderForward(inputx)
-        xr = self.responseForward(x)
+    def forward(self, inputx, bPurePrediction=False, activeHeads=None):
+        """
+        :param bPurePrediction: True computes and returns only the response output xr.
+        :param activeHeads: None computes both heads; or a set of "response" and "segmentation", where an inactive head
+                            is not computed and returns None.
+        :return: xr, or (xr, xup)
+        A submodule whose parameters are all frozen runs under no_grad, so it records no autograd history.
+        """
+        if bPurePrediction:
+            activeHeads = {"response"}
+        elif activeHeads is None:
+            activeHeads = {"response", "segmentation"}
+        x = self.frozenAwareForward(self.encoderForward, [self.m_input, self.m_downList], inputx)
+        xr = self.frozenAwareForward(self.responseForward, [self.m_11Conv, self.m_fc11], x) if "response" in activeHeads else None
         if bPurePrediction:
             return xr
         else:
-            xup = self.decoderForward(x)
+            xup = self.frozenAwareForward(self.decoderForward, [self.m_upList, self.m_upOutput], x) if "segmentation" in activeHeads else None
             return xr, xup
 
+    @staticmethod
+    def isFrozen(moduleList):
+        return all(not param.requires_grad for module in moduleList for param in module.parameters())
+
+    def frozenAwareForward(self, forwardFun, moduleList, x):
+        with torch.set_grad_enabled(torch.is_grad_enabled() and not self.isFrozen(moduleList)):
+            return forwardFun(x)
+
     @staticmethod
     def freezeModuleList(moduleList, requires_grad=False):
         for module in moduleList:
@@ -58,15 +77,18 @@ class SkyWatcherModel(BasicModel):
     def freezeResponseBranch(self, requires_grad=False):
         moduleList = [self.m_11Conv, self.m_fc11]
         self.freezeModuleList(moduleList, requires_grad= requires_grad)
+        return self.updateOptimizerParams()  # optimizer only covers trainable parameters
 
     def freezeSegmentationBranch(self, requires_grad=False):
         self.freezeEncoder(requires_grad=requires_grad)
-        self.freezeDecoder(requires_grad=requires_grad)
+        return self.freezeDecoder(requires_grad=requires_grad)
 
     def freezeEncoder(self, requires_grad=False):
         moduleList = [self.m_input, self.m_downList]
         self.freezeModuleList(moduleList, requires_grad=requires_grad)
+        return self.updateOptimizerParams()  # optimizer only covers trainable parameters
 
     def freezeDecoder(self, requires_grad=False):
         moduleList = [self.m_upList, self.m_upOutput]
         self.freezeModuleList(moduleList, requires_grad=requires_grad)
+        return self.updateOptimizerParams()  # optimizer only covers trainable parameters
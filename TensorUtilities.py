@@ -1,5 +1,8 @@
 
+import math
+import itertools
 import torch
+import torch.nn.functional as F
 
 def zeroMeanNormalize(x, dim=1):
     m = torch.mean(x, dim=dim).clone()
@@ -13,3 +16,85 @@ def zeroMeanNormalize(x, dim=1):
     return xout
 
 
+
+def outputs2LabelMap(outputs, dim=1):
+    """
+    reduce network outputs to a class map by argmax on their own device, before any host transfer.
+    :param outputs: tensor with classes along dim, K <= 256
+    :return: uint8 tensor without dim, on the same device
+    """
+    assert outputs.shape[dim] <= 256
+    return torch.argmax(outputs, dim=dim).to(torch.uint8)
+
+def truncatedDistanceTransform(mask, truncateDistance):
+    """
+    Euclidean distance of each True element to its nearest False element, truncated at truncateDistance,
+    computed on the mask's own device only within the narrow band of the boundary.
+    It equals np.clip(ndimage.distance_transform_edt(mask[i]), 0, truncateDistance) for each sample i.
+    :param mask: N*d*h*w or N*h*w bool tensor, with samples along dim 0
+    :param truncateDistance: the clip radius
+    :return: float tensor of mask shape
+    :Notes: squared distance is separable along axes, and a distance within the radius only comes from offsets within
+            the radius on each axis, so each axis takes the min over 2*radius+1 shifts, capping values beyond radius.
+    """
+    radius = int(math.floor(truncateDistance))
+    cap = truncateDistance ** 2 + 1
+    squareDistance = torch.where(mask, torch.tensor(cap, device=mask.device), torch.tensor(0.0, device=mask.device))
+    for dim in range(1, mask.ndim):
+        L = mask.shape[dim]
+        padShape = list(squareDistance.shape)
+        padShape[dim] = radius
+        pad = torch.full(padShape, cap, device=mask.device)
+        padded = torch.cat([pad, squareDistance, pad], dim=dim)  # outside of volume is not a False element, as in scipy
+        result = squareDistance
+        for offset in range(1, radius + 1):
+            for start in (radius + offset, radius - offset):
+                result = torch.min(result, padded.narrow(dim, start, L) + offset * offset)
+        squareDistance = torch.clamp(result, max=cap)
+    return torch.clamp(torch.sqrt(squareDistance), max=truncateDistance)
+
+def binaryDilation(mask):
+    """
+    dilate a binary mask by a 3*3 (2D) or 3*3*3 (3D) cube on the mask's device with max pooling,
+    which equals scipy binary_dilation with np.ones((3,)*ndim) and border_value=0 on each sample.
+    :param mask: N*d*h*w or N*h*w bool tensor
+    :return: bool tensor of mask shape
+    """
+    maxPool = F.max_pool3d if mask.ndim == 4 else F.max_pool2d
+    return maxPool(mask.unsqueeze(1).float(), kernel_size=3, stride=1, padding=1).squeeze(1) > 0
+
+def jumpFloodDistanceTransform(seeds):
+    """
+    approximate Euclidean distance of each element to its nearest seed on the seeds' device with jump flooding:
+    each element keeps its nearest seed coordinate found so far, and updates it from the neighbors at steps
+    of n/2, n/4, ..., 1, so it needs log2(n) passes instead of a propagation over the whole volume.
+    It approximates ndimage.distance_transform_edt(seeds[i] == 0), with rare small errors for far elements.
+    :param seeds: N*d*h*w or N*h*w bool tensor
+    :return: float tensor of seeds shape; a sample without seed gets inf.
+    """
+    spatialShape = seeds.shape[1:]
+    dim = len(spatialShape)
+    device = seeds.device
+    inf = torch.tensor(float('inf'), device=device)
+    # meshgrid without indexing keyword, which torch < 1.10 lacks; its default is 'ij' indexing.
+    coordinates = torch.stack(torch.meshgrid(*[torch.arange(s, device=device, dtype=torch.float) for s in spatialShape]),
+                              dim=0).unsqueeze(0)  # 1*dim*spatialShape
+    nearest = torch.where(seeds.unsqueeze(1), coordinates, inf)  # N*dim*spatialShape
+    squareDistance = torch.where(seeds, torch.tensor(0.0, device=device), inf)
+    step = 2 ** max(math.ceil(math.log2(max(spatialShape))) - 1, 0)
+    while step >= 1:
+        padded = F.pad(nearest, (step, step) * dim, value=float('inf'))
+        newNearest = nearest
+        for offset in itertools.product((-step, 0, step), repeat=dim):
+            if not any(offset):
+                continue
+            neighbor = padded
+            for i, (o, s) in enumerate(zip(offset, spatialShape)):
+                neighbor = neighbor.narrow(2 + i, step + o, s)  # the nearest seed of element at +offset
+            candidate = torch.sum((neighbor - coordinates) ** 2, dim=1)
+            better = candidate < squareDistance
+            squareDistance = torch.where(better, candidate, squareDistance)
+            newNearest = torch.where(better.unsqueeze(1), neighbor, newNearest)
+        nearest = newNearest
+        step //= 2
+    return torch.sqrt(squareDistance)
@@ -0,0 +1,50 @@
+# benchmark fused FocalCELoss against the composed softmax/nll_loss formulation on SkyWatcher output shapes:
+# peak memory and time of forward+backward, and agreement of loss and gradient.
+
+import sys
+import time
+import torch
+sys.path.append("..")
+from CustomizedLoss import FocalCELoss
+
+
+def run(lossFunc, logits, target, device, repeats):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(device)
+    baseMemory = torch.cuda.memory_allocated(device) if device.type == "cuda" else 0
+    start = time.perf_counter()
+    for _ in range(repeats):
+        inputx = logits.clone().requires_grad_(True)
+        loss = lossFunc(inputx, target)
+        loss.backward()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / repeats
+    peakMemory = torch.cuda.max_memory_allocated(device) - baseMemory if device.type == "cuda" else 0
+    return elapsed, peakMemory, loss.item(), inputx.grad
+
+
+def main():
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    repeats = 10
+    # (batch, K, D, H, W) segmentation outputs of SkyWatcherModel2 with 29*140*140 input; (batch, K) response outputs.
+    for shape in [(9, 2, 29, 140, 140), (9, 3, 29, 140, 140), (9, 2)]:
+        logits = torch.randn(shape, device=device) * 3
+        target = torch.randint(0, shape[1], (shape[0],) + shape[2:], device=device)
+        if len(shape) > 2:
+            target[:, 0] = -100  # ignored slices
+        weight = torch.rand(shape[1], device=device) + 0.5
+        for reduction in ['mean', 'sum']:
+            composed = FocalCELoss(weight=weight, reduction=reduction, fused=False)
+            fused = FocalCELoss(weight=weight, reduction=reduction, fused=True)
+            composedTime, composedMemory, composedLoss, composedGrad = run(composed, logits, target, device, repeats)
+            fusedTime, fusedMemory, fusedLoss, fusedGrad = run(fused, logits, target, device, repeats)
+            assert abs(composedLoss - fusedLoss) <= 1e-4 * max(1.0, abs(composedLoss))
+            assert torch.allclose(composedGrad, fusedGrad, rtol=1e-3, atol=1e-7)
+            print(f"{shape} {reduction}: composed {composedTime*1000:.1f} ms, {composedMemory/2**20:.1f} MB; "
+                  f"fused {fusedTime*1000:.1f} ms, {fusedMemory/2**20:.1f} MB")
+    print("Fused FocalCELoss matches the composed loss and gradient.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# benchmark vectorized slice normalization kernels in ArrayUtilities against the previous per-slice python loops.
+
+import sys
+import time
+import numpy as np
+sys.path.append("..")
+from ArrayUtilities import *
+
+
+def loopSliceNormalize(array):  # previous DataMgr.sliceNormalize for 3D array
+    axesTuple = tuple([x for x in range(1, array.ndim)])
+    minx = np.min(array, axesTuple)
+    result = np.zeros(array.shape)
+    for i in range(len(minx)):
+        result[i,:] = array[i,:] - minx[i]
+    ptp = list(np.ptp(array, axesTuple)) # peak to peak
+    for i,x in enumerate(ptp):
+        if x ==0:
+            ptp[i] = 1e-6
+    for i in range(len(ptp)):
+        result[i, :] /= ptp[i]
+    return result
+
+def loopSliceStdNormalize(image3d):  # previous Tools/convertNrrdData2Npy.py normalization
+    shape = image3d.shape
+    for i in range(shape[0]):
+        slice = image3d[i,]
+        mean = np.mean(slice)
+        std  = np.std(slice)
+        if 0 != std:
+            slice = slice / std
+        else:
+            slice = slice -mean
+        image3d[i,] = slice
+    return image3d
+
+def timeIt(fun, array, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = fun(array.copy())
+    return (time.perf_counter() - start) / repeats, result
+
+
+def main():
+    repeats = 10
+    for shape in [(29, 140, 140), (51, 171, 171), (231, 251, 251)]:
+        array = np.random.uniform(-300, 300, shape).astype(np.float32)
+        array[0] = 5.0  # a constant slice
+
+        loopTime, loopResult = timeIt(loopSliceNormalize, array, repeats)
+        vecTime, vecResult = timeIt(lambda x: sliceNormalizeArray(x, out=x), array, repeats)
+        assert np.allclose(loopResult, vecResult, atol=1e-5)
+        print(f"sliceNormalize    {shape}: loop {loopTime*1000:.1f} ms, vectorized in-place {vecTime*1000:.1f} ms, speedup {loopTime/vecTime:.1f}x")
+
+        loopTime, loopResult = timeIt(loopSliceStdNormalize, array, repeats)
+        vecTime, vecResult = timeIt(lambda x: sliceStdNormalizeArray(x, out=x), array, repeats)
+        assert np.allclose(loopResult, vecResult, rtol=1e-4, atol=1e-4)
+        print(f"sliceStdNormalize {shape}: loop {loopTime*1000:.1f} ms, vectorized in-place {vecTime*1000:.1f} ms, speedup {loopTime/vecTime:.1f}x")
+
+    # CT-like slices with nonzero mean and low std, where E[x^2]-E[x]^2 would lose precision
+    array = np.random.normal(250, 5, (51, 171, 171)).astype(np.float32)
+    loopTime, loopResult = timeIt(loopSliceStdNormalize, array, repeats)
+    vecTime, vecResult = timeIt(lambda x: sliceStdNormalizeArray(x, out=x), array, repeats)
+    assert np.allclose(loopResult, vecResult, rtol=1e-5, atol=0)
+    print(f"sliceStdNormalize low std {array.shape}: loop {loopTime*1000:.1f} ms, vectorized in-place {vecTime*1000:.1f} ms, speedup {loopTime/vecTime:.1f}x")
+
+    array2d = np.random.uniform(-300, 300, (281, 281)).astype(np.float32)
+    minx, maxx = array2d.min(), array2d.max()
+    assert np.allclose((array2d - minx) / (maxx - minx), sliceNormalizeArray(array2d, perSlice=False), atol=1e-6)
+    print("All vectorized results match the loop results.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# compare device-side BoundaryLoss1 (max-pool boundary and jump flooding distance) with its exact scipy path.
+
+import sys
+import time
+import numpy as np
+from scipy import ndimage
+import torch
+sys.path.append("..")
+from TensorUtilities import binaryDilation, jumpFloodDistanceTransform
+from CustomizedLoss import BoundaryLoss1
+
+
+def randomBlobs(shape, rate, iterations):
+    mask = np.zeros(shape, dtype=bool)
+    for i in range(shape[0]):
+        mask[i] = ndimage.binary_dilation(np.random.rand(*shape[1:]) < rate, iterations=iterations)
+    return mask
+
+def timeIt(fun, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    result = fun()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return time.perf_counter() - start, result
+
+def main():
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    for shape in [(2, 51, 171, 171), (4, 281, 281)]:
+        mask = randomBlobs(shape, 2e-4, 8)
+        ndim = len(shape) - 1
+
+        dilated = binaryDilation(torch.from_numpy(mask).to(device)).cpu().numpy()
+        expected = np.stack([ndimage.binary_dilation(mask[i], np.ones((3,) * ndim)) for i in range(shape[0])])
+        assert (dilated == expected).all()
+
+        seeds = torch.from_numpy(mask).to(device)
+        jumpFloodTime, distance = timeIt(lambda: jumpFloodDistanceTransform(seeds), device)
+        start = time.perf_counter()
+        expected = np.stack([ndimage.distance_transform_edt(~mask[i]) for i in range(shape[0])])
+        scipyTime = time.perf_counter() - start
+        error = np.abs(distance.cpu().numpy() - expected)
+        print(f"{shape}: scipy EDT {scipyTime*1000:.1f} ms, jump flooding on {device} {jumpFloodTime*1000:.1f} ms, "
+              f"max error {error.max():.3f}, mean error {error.mean():.2e}, inexact rate {np.mean(error > 1e-4):.2e}")
+
+        target = torch.from_numpy(mask.astype(np.int64)).to(device)
+        inputx = torch.randn((shape[0], 2) + shape[1:], device=device)
+        deviceTime, deviceLoss = timeIt(lambda: BoundaryLoss1(distanceMethod="jumpFlood")(inputx, target), device)
+        scipyTime, scipyLoss = timeIt(lambda: BoundaryLoss1(distanceMethod="scipy")(inputx, target), device)
+        print(f"{shape}: BoundaryLoss1 jumpFlood {deviceLoss.item():.6f} in {deviceTime*1000:.1f} ms, "
+              f"scipy {scipyLoss.item():.6f} in {scipyTime*1000:.1f} ms")
+
+if __name__ == "__main__":
+    main()
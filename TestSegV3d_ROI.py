@@ -13,7 +13,9 @@ from FilesUtilities import *
 from MeasureUtilities import *
 from SegV3DModel import SegV3DModel
 from OCDataTransform import *
+from DataLoaderUtilities import *
 from NetMgr import NetMgr
+from TensorUtilities import outputs2LabelMap
 
 logNotes = r'''
 Major program changes: 
@@ -42,15 +44,17 @@ def printUsage(argv):
     print("============Test Seg 3D VNet for ROI around primary Cancer =============")
     print("Usage:")
     print(argv[0],
-          "<netSavedPath> <predictOutputDir> <fullPathOfData>  <fullPathOfLabel> <k>  <GPUID_List>")
+          "<netSavedPath> <predictOutputDir> <fullPathOfData>  <fullPathOfLabel> <k>  <GPUID_List>", getDataLoaderArgsUsage())
     print("where: \n"
           "       netSavedPath must be specific network directory.\n"
           "       k=[0, K), the k-th fold in the K-fold cross validation.\n"
-          "       GPUIDList: 0,1,2,3, the specific GPU ID List, separated by comma\n")
+          "       GPUIDList: 0,1,2,3, the specific GPU ID List, separated by comma\n"
+          "       numWorkers: number of DataLoader worker processes, default 0; prefetchFactor: batches loaded ahead by each worker, default 2;\n"
+          "       pinMemory: 1 collates batches into page-locked memory, default 1.\n")
 
 
 def main():
-    if len(sys.argv) != 7:
+    if len(sys.argv) < 7:
         print("Error: input parameters error.")
         printUsage(sys.argv)
         return -1
@@ -62,9 +66,11 @@ def main():
     k = int(sys.argv[5])
     GPUIDList = sys.argv[6].split(',')  # choices: 0,1,2,3 for lab server.
     GPUIDList = [int(x) for x in GPUIDList]
+    loaderArgs = parseDataLoaderArgs(sys.argv[7:])
 
     # ===========debug==================
     useDataParallel = True if len(GPUIDList) > 1 else False  # for debug
+    bitPackPrediction = False  # True saves binary predictions bit-packed in .npz, instead of uint8 .npy
     # ===========debug==================
 
     print(f'Program ID:  {os.getpid()}\n')
@@ -75,7 +81,6 @@ def main():
     K_fold = 6
     batchSize = 2 * len(GPUIDList)-1
     print(f"batchSize = {batchSize}")
-    numWorkers = 0
 
     device = torch.device(f"cuda:{GPUIDList[0]}" if torch.cuda.is_available() else "cpu")
 
@@ -91,8 +96,8 @@ def main():
     validationTransform = OCDataLabelTransform(0)
     testTransform = OCDataLabelTransform(0)
 
-    validationData = OVDataSegSet('validation', dataPartitions, transform=validationTransform)
-    testData = OVDataSegSet('test', dataPartitions, transform=testTransform)
+    validationData = OVDataSegSet('validation', dataPartitions, transform=validationTransform, mmapMode="c")
+    testData = OVDataSegSet('test', dataPartitions, transform=testTransform, mmapMode="c")
 
     net = SegV3DModel()
     # Important:
@@ -117,47 +122,50 @@ def main():
     logging.info(f"ID" + f"\t\tDice")  # logging.info output head
 
 
+    validationLoader = createDataLoader(validationData, batchSize, shuffle=False, loaderArgs=loaderArgs)
+    testLoader = createDataLoader(testData, batchSize, shuffle=False, loaderArgs=loaderArgs)
+
     # ================Validation===============
     net.eval()
 
     with torch.no_grad():
-        for inputs, labels, patientIDs in data.DataLoader(validationData, batch_size=batchSize, shuffle=False,
-                                                          num_workers=numWorkers):
-            inputs = inputs.to(device, dtype=torch.float)
+        for inputs, labels, patientIDs in validationLoader:
+            inputs = inputs.to(device, dtype=torch.float, non_blocking=True)
             gts = labels.to(device, dtype=torch.float)  # return a copy
             gts = (gts > 0).long()  # not discriminate all non-zero labels.
 
             outputs, _ = net.forward(inputs, gts)
 
             # compute dice
+            predicts = outputs2LabelMap(outputs)  # uint8 class map on device
+            predictsCpu = predicts.cpu().numpy()
             gtsShape = gts.shape
             for i in range(gtsShape[0]):
-                output = torch.argmax(outputs[i,], dim=0)
                 gt = gts[i,]
-                dice = tensorDice(output, gt)
+                dice = tensorDice(predicts[i,], gt)
                 filename = os.path.join(predictOutputDir, patientIDs[i]+".npy")
-                np.save(filename, output.cpu().numpy())
+                savePrediction(predictsCpu[i,], filename, bitPacked=bitPackPrediction)
                 logging.info(patientIDs[i] +f"\t{dice:.5f}")
 
     # ================Independent Test===============
     net.eval()
     with torch.no_grad():
-        for inputs, labels, patientIDs in data.DataLoader(testData, batch_size=batchSize, shuffle=False,
-                                                          num_workers=numWorkers):
-            inputs = inputs.to(device, dtype=torch.float)
+        for inputs, labels, patientIDs in testLoader:
+            inputs = inputs.to(device, dtype=torch.float, non_blocking=True)
             gts = labels.to(device, dtype=torch.float)  # return a copy
             gts = (gts > 0).long()  # not discriminate all non-zero labels.
 
             outputs, _ = net.forward(inputs, gts)
 
             # compute dice
+            predicts = outputs2LabelMap(outputs)  # uint8 class map on device
+            predictsCpu = predicts.cpu().numpy()
             gtsShape = gts.shape
             for i in range(gtsShape[0]):
-                output = torch.argmax(outputs[i,], dim=0)
                 gt = gts[i,]
-                dice = tensorDice(output, gt)
+                dice = tensorDice(predicts[i,], gt)
                 filename = os.path.join(predictOutputDir, patientIDs[i] + ".npy")
-                np.save(filename, output.cpu().numpy())
+                savePrediction(predictsCpu[i,], filename, bitPacked=bitPackPrediction)
                 logging.info(patientIDs[i] + f"\t{dice:.5f}")
 
     torch.cuda.empty_cache()
@@ -0,0 +1,267 @@
+
+# parallel and incremental conversion engine from nrrd image/label to numpy array, shared by Tools/convert*.py
+# Each patient is converted in a process pool; a manifest in the output directory records the inputs' mtime/size and
+# the conversion parameters of each output, so that an unchanged patient is skipped in the next run.
+# Outputs are written to a temporary file and then renamed, so an interrupted run never leaves a half-written npy file.
+#
+# Usage example:
+#   python3 NrrdNpyConverter.py std  --inputDir /home/hxie1/data/OvarianCancerCT/pixelSize223/nrrd --outputDir /home/hxie1/data/OvarianCancerCT/pixelSize223/numpy
+#   python3 NrrdNpyConverter.py zoom --inputDir .../primaryROI/nrrd --labelDir .../primaryROI/labels --outputDir .../nrrd_npy --outputLabelDir .../labels_npy
+
+import sys
+import os
+import time
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import SimpleITK as sitk
+from scipy import ndimage
+import numpy as np
+sys.path.append("..")
+from FilesUtilities import *
+from ArrayUtilities import *
+from DataMgr import DataMgr
+
+manifestName = "convertManifest.json"
+
+
+def readNrrd(filename):
+    return sitk.GetArrayFromImage(sitk.ReadImage(filename))
+
+def saveNpyAtomically(array, filename):
+    tempFile = filename + f".{os.getpid()}.tmp.npy"
+    np.save(tempFile, array)
+    os.replace(tempFile, filename)
+
+def getIntMassCenter(array3d):
+    massCenterFloat = ndimage.measurements.center_of_mass(array3d)
+    return [int(x) for x in massCenterFloat]
+
+
+# ================ converters: each converts one patient described by a job dict ================
+
+def convertStd(job):
+    """
+    clip image into window, normalize each slice with its std, and assemble into fixed goalSize.
+    """
+    params = job["params"]
+    image3d = readNrrd(job["inputs"][0])
+    image3d = np.clip(image3d, *params["window"])
+    image3d = image3d.astype(np.float32)   # this is very important, otherwise, normalization will be meaningless.
+    image3d = sliceStdNormalizeArray(image3d, out=image3d)
+    saveNpyAtomically(assembleInCenter(image3d, params["goalSize"]), job["outputs"][0])
+    return ""
+
+def convertStdLabel(job):
+    """
+    same with convertStd, and synchronize label's assemble together with image.
+    """
+    params = job["params"]
+    imageFile, labelFile = job["inputs"]
+    image3d = readNrrd(imageFile)
+    image3d = np.clip(image3d, *params["window"])
+    image3d = image3d.astype(np.float32)   # this is very important, otherwise, normalization will be meaningless.
+    label3d = readNrrd(labelFile).astype(np.float32)
+    if image3d.shape != label3d.shape:
+        raise ValueError(f"imageFile: {imageFile} and labelFile: {labelFile} have different shapes.")
+
+    image3d = sliceStdNormalizeArray(image3d, out=image3d)
+    saveNpyAtomically(assembleInCenter(image3d, params["goalSize"]), job["outputs"][0])
+    saveNpyAtomically(assembleInCenter(label3d, params["goalSize"]), job["outputs"][1])
+    return ""
+
+def convertZoom(job):
+    """
+    clip image into window, zoom image and label into goalSize, normalize image volume, and flip to keep RAS direction with nrrd.
+    """
+    params = job["params"]
+    imageFile, labelFile = job["inputs"]
+    flipAxis = tuple(params["flipAxis"])
+    goalSize = params["goalSize"]
+
+    image3d = readNrrd(imageFile)
+    image3d = np.clip(image3d, *params["window"])  # window level
+    image3d = image3d.astype(np.float32)  # this is very important, otherwise, normalization will be meaningless.
+    imageShape = image3d.shape
+    label3d = readNrrd(labelFile).astype(np.float32)
+    if label3d.shape != imageShape:
+        raise ValueError(f"images shape != label shape for {imageFile} and {labelFile}")
+
+    zoomFactor = [goalSize[i] / imageShape[i] for i in range(3)]
+    image3d = ndimage.zoom(image3d, zoomFactor, order=3)
+    # normalize image for whole volume
+    mean = np.mean(image3d)
+    std  = np.std(image3d)
+    image3d = (image3d-mean)/std
+    image3d = np.flip(image3d, flipAxis)  # keep numpy image has same RAS direction with Nrrd image.
+    saveNpyAtomically(image3d, job["outputs"][0])
+
+    label3d = ndimage.zoom(label3d, zoomFactor, order=0)  # nearest neighbor interpolation
+    label3d = np.flip(label3d, flipAxis)
+    saveNpyAtomically(label3d, job["outputs"][1])
+    return ""
+
+def convertRoi(job):
+    """
+    crop ROI of goalSize around the mass center of all nonzero labels.
+    """
+    params = job["params"]
+    imageFile, labelFile = job["inputs"]
+    goalSize = params["goalSize"]
+    label3d = readNrrd(labelFile) > 0
+    if np.count_nonzero(label3d) == 0:
+        return f"{imageFile} has no available labels"
+    massCenter = getIntMassCenter(label3d)
+    image3d = readNrrd(imageFile)
+    roi = DataMgr.cropVolumeCopyWithDstSize(image3d, massCenter[0], massCenter[1], massCenter[2], goalSize[0]//2, goalSize[1], goalSize[2])
+    saveNpyAtomically(roi, job["outputs"][0])
+    return ""
+
+converters = {"std": convertStd, "stdLabel": convertStdLabel, "zoom": convertZoom, "roi": convertRoi}
+
+
+# ================ incremental and parallel running ================
+
+def getFilesStat(filesList):
+    result = {}
+    for filename in filesList:
+        stat = os.stat(filename)
+        result[filename] = [stat.st_mtime, stat.st_size]
+    return result
+
+def makeJob(mode, patientID, inputs, outputs, params):
+    inputs = [os.path.abspath(x) for x in inputs]
+    outputs = [os.path.abspath(x) for x in outputs]
+    params = json.loads(json.dumps(params))  # normalize tuple into list, the same form as read back from manifest.
+    return {"mode": mode, "patientID": patientID, "inputs": inputs, "outputs": outputs, "params": params}
+
+def isJobUpToDate(job, entry):
+    if entry is None or entry["mode"] != job["mode"] or entry["params"] != job["params"]:
+        return False
+    if not all(os.path.isfile(x) for x in job["outputs"]):
+        return False
+    return entry["inputsStat"] == getFilesStat(job["inputs"])
+
+def runJob(job):
+    """
+    :return: (job, seconds, note, error), running in a worker process.
+    """
+    startTime = time.perf_counter()
+    try:
+        note = converters[job["mode"]](job)
+        error = ""
+    except Exception as e:
+        note = ""
+        error = f"{type(e).__name__}: {e}"
+    return job, time.perf_counter() - startTime, note, error
+
+def convertAll(jobs, manifestPath, nProcesses=None, force=False, logInfo=print):
+    """
+    :param jobs: a list of job dict made by makeJob.
+    :param manifestPath: a json file recording the converted outputs.
+    :param nProcesses: None means the number of CPUs.
+    :param force: True re-converts all jobs.
+    :return: a list of notes and errors.
+    """
+    manifest = loadJsonIndex(manifestPath)
+    pendingJobs = [job for job in jobs if force or not isJobUpToDate(job, manifest.get(job["outputs"][0]))]
+    logInfo(f"{len(jobs)} patients, in which {len(jobs)-len(pendingJobs)} are up to date, and {len(pendingJobs)} need converting.")
+
+    messages = []
+    totalStart = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=nProcesses) as pool:
+        futures = [pool.submit(runJob, job) for job in pendingJobs]
+        for n, future in enumerate(as_completed(futures)):
+            job, seconds, note, error = future.result()
+            if "" != error:
+                messages.append(f"{job['patientID']}: Error: {error}")
+            else:
+                if "" != note:
+                    messages.append(f"{job['patientID']}: {note}")
+                manifest[job["outputs"][0]] = {"mode": job["mode"], "params": job["params"],
+                                               "inputsStat": getFilesStat(job["inputs"])}
+                saveJsonIndex(manifest, manifestPath)  # save each time, so an interrupted run keeps its finished work.
+            logInfo(f"[{n+1}/{len(pendingJobs)}] {job['patientID']}: {seconds:.2f} seconds. {note}{error}")
+    logInfo(f"Converting {len(pendingJobs)} patients took {time.perf_counter()-totalStart:.1f} seconds.")
+    return messages
+
+
+# ================ job lists of each conversion mode ================
+
+def buildStdJobs(inputDir, outputDir, suffix="_CT.nrrd", window=(0, 300), goalSize=(231, 251, 251)):
+    jobs = []
+    for file in getFilesList(inputDir, suffix):
+        patientID = getStemName(file, suffix)
+        jobs.append(makeJob("std", patientID, [file], [os.path.join(outputDir, patientID + ".npy")],
+                            {"window": window, "goalSize": goalSize}))
+    return jobs
+
+def buildStdLabelJobs(patientIDList, inputDataDir, inputLabelDir, outputDataDir, outputLabelDir, window=(0, 300), goalSize=(231, 251, 251)):
+    jobs = []
+    for patientID in patientIDList:
+        inputs = [os.path.join(inputDataDir, patientID + "_CT.nrrd"), os.path.join(inputLabelDir, patientID + "_Seg.nrrd")]
+        outputs = [os.path.join(outputDataDir, patientID + ".npy"), os.path.join(outputLabelDir, patientID + ".npy")]
+        jobs.append(makeJob("stdLabel", patientID, inputs, outputs, {"window": window, "goalSize": goalSize}))
+    return jobs
+
+def buildZoomJobs(inputImageDir, inputLabelDir, outputImageDir, outputLabelDir, suffix="_pri.nrrd", labelSuffix="_pri_seg.nrrd",
+                  window=(-100, 250), goalSize=(51, 171, 171), flipAxis=(1, 2)):
+    jobs = []
+    for file in getFilesList(inputImageDir, suffix):
+        patientID = getStemName(file, suffix)
+        inputs = [file, os.path.join(inputLabelDir, patientID + labelSuffix)]
+        outputs = [os.path.join(outputImageDir, patientID + ".npy"), os.path.join(outputLabelDir, patientID + ".npy")]
+        jobs.append(makeJob("zoom", patientID, inputs, outputs, {"window": window, "goalSize": goalSize, "flipAxis": flipAxis}))
+    return jobs
+
+def buildRoiJobs(inputDir, outputDir, suffix="_CT.nrrd", goalSize=(29, 140, 140)):
+    jobs = []
+    for file in getFilesList(inputDir, suffix):
+        patientID = getStemName(file, suffix)
+        label = file.replace("_CT.nrrd", "_Seg.nrrd").replace("images/", "labels/")
+        jobs.append(makeJob("roi", patientID, [file, label], [os.path.join(outputDir, patientID + "_roi.npy")], {"goalSize": goalSize}))
+    return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel and incremental conversion from nrrd to numpy for Ovarian Cancer data.")
+    parser.add_argument("mode", choices=list(converters.keys()), help="std | stdLabel | zoom | roi")
+    parser.add_argument("--inputDir", required=True, help="nrrd image directory")
+    parser.add_argument("--outputDir", required=True, help="numpy image output directory")
+    parser.add_argument("--labelDir", default=None, help="nrrd label directory, for stdLabel and zoom mode")
+    parser.add_argument("--outputLabelDir", default=None, help="numpy label output directory, for stdLabel and zoom mode")
+    parser.add_argument("--patientIDList", default=None, help="json file of patient ID list, for stdLabel mode")
+    parser.add_argument("--suffix", default=None, help="suffix of image files")
+    parser.add_argument("--window", type=float, nargs=2, default=None, help="window level: low high")
+    parser.add_argument("--goalSize", type=int, nargs=3, default=None, help="output size: Z Y X")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes, default: number of CPUs")
+    parser.add_argument("--force", action="store_true", help="re-convert all files ignoring the manifest")
+    args = parser.parse_args()
+
+    options = {}
+    if args.window is not None:
+        options["window"] = tuple(args.window)
+    if args.goalSize is not None:
+        options["goalSize"] = tuple(args.goalSize)
+    if args.suffix is not None and args.mode != "stdLabel":
+        options["suffix"] = args.suffix
+
+    if args.mode == "std":
+        jobs = buildStdJobs(args.inputDir, args.outputDir, **options)
+    elif args.mode == "stdLabel":
+        with open(args.patientIDList) as f:
+            patientIDList = json.load(f)
+        jobs = buildStdLabelJobs(patientIDList, args.inputDir, args.labelDir, args.outputDir, args.outputLabelDir, **options)
+    elif args.mode == "zoom":
+        jobs = buildZoomJobs(args.inputDir, args.labelDir, args.outputDir, args.outputLabelDir, **options)
+    else:
+        options.pop("window", None)
+        jobs = buildRoiJobs(args.inputDir, args.outputDir, **options)
+
+    messages = convertAll(jobs, os.path.join(args.outputDir, manifestName), nProcesses=args.processes, force=args.force)
+    for message in messages:
+        print(message)
+    print(f"===End of {args.mode} conversion from nrrd to npy=======")
+
+if __name__ == "__main__":
+    main()
@@ -5,19 +5,22 @@ imagePath = "/home/hxie1/data/OvarianCancerCT/Extract_uniform/trainImages"
 labelPath = "/home/hxie1/data/OvarianCancerCT/Extract_uniform/trainLabels"
 
 trainDataMgr = SegDataMgr(imagePath, labelPath, "_CT.nrrd")
-trainDataMgr.setDataSize(64, 21,281,281,"TrainData")  #batchSize, depth, height, width
-trainDataMgr.setMaxShift(25)                #translation data augmentation
-trainDataMgr.setFlipProb(0.3)               #flip data augmentation
+trainDataMgr.buildSegSliceTupleList()       # reuses the persisted per-slice label counts beside the labels directory
 
 pixelStatis = [0, 0, 0, 0]  # the number of pixels labeled as 0, 1,2,3
 sliceStatis = [0, 0, 0, 0]  # the number of slices having label 0, 1, 2, 3
 
 print("Start to statistics the label data, please waiting......")
 
-for _, labelsCpu in trainDataMgr.dataLabelGenerator(False):
-    (pixelList, sliceList) = trainDataMgr.batchLabelStatistic(labelsCpu, 4)
-    pixelStatis = [x + y for x, y in zip(pixelStatis, pixelList)]
-    sliceStatis = [x+y for x, y in zip(sliceStatis,sliceList)]
+# sum the persisted label counts of segmented slices, instead of decoding and cropping every slice;
+# counts are over whole slices, and suppressed labels are counted as label 0, as suppressedLabels does.
+for fileIndex, sliceIndex in trainDataMgr.m_segSliceTupleList:
+    counts = trainDataMgr.getSliceLabelCounts(fileIndex)[sliceIndex]
+    sliceCounts = [0] * len(pixelStatis)
+    for label, count in enumerate(counts[:len(pixelStatis)]):
+        sliceCounts[0 if label in trainDataMgr.m_suppressedLabels else label] += count
+    pixelStatis = [x + y for x, y in zip(pixelStatis, sliceCounts)]
+    sliceStatis = [x + (y > 0) for x, y in zip(sliceStatis, sliceCounts)]
 
 print("in below statistic list,  positions indicate label 0, 1, 2 ,3")
 
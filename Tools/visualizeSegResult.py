@@ -16,7 +16,7 @@ def main():
     suffix = ".npy"
     originalCwd = os.getcwd()
     os.chdir(predictDir)
-    filesList = [os.path.abspath(x) for x in os.listdir(predictDir) if suffix in x]
+    filesList = [os.path.abspath(x) for x in os.listdir(predictDir) if x.endswith(suffix) or x.endswith(".npz")]  # .npz is bit-packed prediction
     os.chdir(originalCwd)
 
     # read dice data
@@ -36,14 +36,14 @@ def main():
     sliceIndices = [12,18, 25, 31, 37]
     nFigs = 0
     for file in filesList:
-        patientID = getStemName(file, suffix)
+        patientID = getStemName(file, os.path.splitext(file)[1])
         rawFilename = os.path.join(imageDir, patientID+suffix)
         gtFilename  = os.path.join(groundTruthDir, patientID+suffix)
         predictFilename = file
 
         rawImage = np.load(rawFilename).astype(np.float32)
         gtImage = np.load(gtFilename).astype(np.float32)
-        predictImage = np.load(predictFilename).astype(np.float32)
+        predictImage = loadPrediction(predictFilename).astype(np.float32)
 
         for s in sliceIndices:
             nFigs +=1
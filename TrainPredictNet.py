@@ -14,7 +14,7 @@ from Image3dResponseDataMgr import Image3dResponseDataMgr
 from LatentPredictModel import LatentPredictModel
 from Image3dPredictModel import Image3dPredictModel
 from NetMgr import NetMgr
-from CustomizedLoss import FocalCELoss
+from CustomizedLoss import FocalCELoss, mixupLoss
 
 # you may need to change the file name and log Notes below for every training.
 trainLogFile = r'''/home/hxie1/Projects/OvarianCancer/trainLog/image3dZoomPredictLog_20190603.txt'''
@@ -147,6 +147,9 @@ def main():
     trainDataMgr.setOneSampleTraining(False)  # for debug
     if not mergeTrainTestData:
         testDataMgr.setOneSampleTraining(False)  # for debug
+    trainDataMgr.setPrefetch(depth=4, readWorkers=4)  # prepare batches in background while network computes
+    if not mergeTrainTestData:
+        testDataMgr.setPrefetch(depth=4, readWorkers=4)
     useDataParallel = True  # for debug
     # ===========debug==================
 
@@ -249,10 +252,7 @@ def main():
         else:
             lossWeightList = torch.Tensor(net.m_lossWeightList).to(device)
 
-        for (inputs1, labels1Cpu), (inputs2, labels2Cpu) in zip(trainDataMgr.dataResponseGenerator(True),
-                                                                trainDataMgr.dataResponseGenerator(True)):
-            lambdaInBeta = trainDataMgr.getLambdaInBeta()
-            inputs = inputs1 * lambdaInBeta + inputs2 * (1 - lambdaInBeta)
+        for inputs, labels1Cpu, labels2Cpu, lambdaInBeta in trainDataMgr.prefetch(trainDataMgr.mixupGenerator(trainDataMgr.dataResponseGenerator(True))):
             inputs = torch.from_numpy(inputs).to(device, dtype=torch.float)
             labels1 = torch.from_numpy(labels1Cpu).to(device, dtype=torch.long)
             labels2 = torch.from_numpy(labels2Cpu).to(device, dtype=torch.long)
@@ -264,10 +264,7 @@ def main():
                 for lossFunc, weight in zip(net.module.m_lossFuncList, lossWeightList):
                     if weight == 0:
                         continue
-                    if lambdaInBeta != 0:
-                        loss += lossFunc(outputs, labels1) * weight * lambdaInBeta
-                    if 1 - lambdaInBeta != 0:
-                        loss += lossFunc(outputs, labels2) * weight * (1 - lambdaInBeta)
+                    loss += mixupLoss(lossFunc, outputs, labels1, labels2, lambdaInBeta) * weight  # log-probabilities of outputs evaluated once
                 loss.backward()
                 optimizer.step()
                 batchLoss = loss.item()
@@ -301,7 +298,7 @@ def main():
         if not mergeTrainTestData:
             net.eval()
             with torch.no_grad():
-                for inputs, labelsCpu in testDataMgr.dataResponseGenerator(True):
+                for inputs, labelsCpu in testDataMgr.prefetch(testDataMgr.dataResponseGenerator(True)):
                     inputs, labels = torch.from_numpy(inputs), torch.from_numpy(labelsCpu)
                     inputs, labels = inputs.to(device, dtype=torch.float), labels.to(device, dtype=torch.long)  # return a copy
                     if useDataParallel:
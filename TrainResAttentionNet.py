@@ -14,6 +14,7 @@ from FilesUtilities import *
 from MeasureUtilities import *
 from ResAttentionNet  import ResAttentionNet
 from OCDataTransform import *
+from DataLoaderUtilities import *
 from NetMgr import NetMgr
 
 logNotes = r'''
@@ -144,11 +145,13 @@ def printUsage(argv):
     print("============Train ResAttentionNet for Ovarian Cancer =============")
     print("Usage:")
     print(argv[0],
-          "<netSavedPath> <scratch> <fullPathOfData>  <fullPathOfGroundTruthFile> k  GPUID_List")
+          "<netSavedPath> <scratch> <fullPathOfData>  <fullPathOfGroundTruthFile> k  GPUID_List", getDataLoaderArgsUsage())
     print("where: \n"
           "       scratch =0: continue to train basing on previous training parameters; scratch=1, training from scratch.\n"
           "       k=[0, K), the k-th fold in the K-fold cross validation.\n"
-          "       GPUIDList: 0,1,2,3, the specific GPU ID List, separated by comma\n")
+          "       GPUIDList: 0,1,2,3, the specific GPU ID List, separated by comma\n"
+          "       numWorkers: number of DataLoader worker processes, default 0; prefetchFactor: batches loaded ahead by each worker, default 2;\n"
+          "       pinMemory: 1 collates batches into page-locked memory, default 1.\n")
 
 def printPartNetworkPara(epoch, net): # only support non-parallel
     print(f"Epoch: {epoch}   =================")
@@ -160,7 +163,7 @@ def printPartNetworkPara(epoch, net): # only support non-parallel
 
 
 def main():
-    if len(sys.argv) != 7:
+    if len(sys.argv) < 7:
         print("Error: input parameters error.")
         printUsage(sys.argv)
         return -1
@@ -172,6 +175,7 @@ def main():
     k = int(sys.argv[5])
     GPUIDList = sys.argv[6].split(',')  # choices: 0,1,2,3 for lab server.
     GPUIDList = [int(x) for x in GPUIDList]
+    loaderArgs = parseDataLoaderArgs(sys.argv[7:])
     inputSuffix = ".npy"
 
     curTime = datetime.datetime.now()
@@ -217,9 +221,9 @@ def main():
     trainTransform = OCDataTransform(0.9)
     validationTransform = OCDataTransform(0)
 
-    trainingData = OVDataSet('training', dataPartitions,  transform=trainTransform, logInfoFun=logging.info)
-    validationData = OVDataSet('validation', dataPartitions,  transform=validationTransform, logInfoFun=logging.info)
-    testData = OVDataSet('test', dataPartitions, transform=testTransform, logInfoFun=logging.info)
+    trainingData = OVDataSet('training', dataPartitions,  transform=trainTransform, logInfoFun=logging.info, mmapMode="c")
+    validationData = OVDataSet('validation', dataPartitions,  transform=validationTransform, logInfoFun=logging.info, mmapMode="c")
+    testData = OVDataSet('test', dataPartitions, transform=testTransform, logInfoFun=logging.info, mmapMode="c")
 
     # ===========debug==================
     oneSampleTraining = False  # for debug
@@ -230,7 +234,6 @@ def main():
     # for Regulare Conv:  3 is for 1 GPU, 6 for 2 GPU
     # For Deformable Conv: 4 is for 1 GPU, 8 for 2 GPUs.
 
-    numWorkers = 0
     logging.info(f"Info: batchSize = {batchSize}\n")
 
     net = ResAttentionNet()
@@ -297,6 +300,11 @@ def main():
                  + f"\t\tTeLoss" +  f"\tAccura" + f"\tTPR_r" + f"\tTNR_r" )  # logging.info output head
 
     oldTestLoss = 1000
+    testCadence = 0  # also run test set every testCadence epochs; 0 runs it only when validation improves
+
+    trainingLoader = createDataLoader(trainingData, batchSize, shuffle=True, loaderArgs=loaderArgs)
+    validationLoader = createDataLoader(validationData, batchSize, shuffle=False, loaderArgs=loaderArgs)
+    testLoader = createDataLoader(testData, batchSize, shuffle=False, loaderArgs=loaderArgs)
 
     for epoch in range(0, epochs):
         random.seed()
@@ -316,8 +324,8 @@ def main():
         responseTrainTNR = 0.0
 
 
-        for inputs, responseCpu in data.DataLoader(trainingData, batch_size=batchSize, shuffle=True, num_workers=numWorkers):
-            inputs = inputs.to(device, dtype=torch.float)
+        for inputs, responseCpu in trainingLoader:
+            inputs = inputs.to(device, dtype=torch.float, non_blocking=True)
             gt = responseCpu.to(device, dtype=torch.float)
 
             optimizer.zero_grad()
@@ -370,8 +378,8 @@ def main():
         responseValidationTNR = 0.0
 
         with torch.no_grad():
-            for inputs, responseCpu in data.DataLoader(validationData, batch_size=batchSize, shuffle=False, num_workers=numWorkers):
-                inputs = inputs.to(device, dtype=torch.float)
+            for inputs, responseCpu in validationLoader:
+                inputs = inputs.to(device, dtype=torch.float, non_blocking=True)
                 gt     = responseCpu.to(device, dtype=torch.float)  # return a copy
 
                 xr = net.forward(inputs)
@@ -402,50 +410,57 @@ def main():
                 responseValidationTPR = getTPR(epochPredict, epochResponse)[0]
                 responseValidationTNR = getTNR(epochPredict, epochResponse)[0]
 
+            # test set only runs for a new best net chosen by validation, or every testCadence epochs,
+            # so that a logged test result always belongs to a saved checkpoint.
+            validationImproved = trainingLoss < float('inf') and not math.isnan(trainingLoss) and \
+                                 (responseValidationAccuracy > bestTestPerf or (responseValidationAccuracy == bestTestPerf and validationLoss < oldTestLoss))
+            runTest = validationImproved or (testCadence > 0 and epoch % testCadence == 0)
+
             # ================Independent Test===============
-            net.eval()
+            if runTest:
+                net.eval()
 
-            testLoss = 0.0
-            testBatches = 0
+                testLoss = 0.0
+                testBatches = 0
 
-            epochPredict = None
-            epochResponse = None
-            responseTestAccuracy = 0.0
-            responseTestTPR = 0.0
-            responseTestTNR = 0.0
+                epochPredict = None
+                epochResponse = None
+                responseTestAccuracy = 0.0
+                responseTestTPR = 0.0
+                responseTestTNR = 0.0
 
-            with torch.no_grad():
-                for inputs, responseCpu in data.DataLoader(testData, batch_size=batchSize, shuffle=False, num_workers=numWorkers):
-                    inputs = inputs.to(device, dtype=torch.float)
-                    gt = responseCpu.to(device, dtype=torch.float)  # return a copy
+                with torch.no_grad():
+                    for inputs, responseCpu in testLoader:
+                        inputs = inputs.to(device, dtype=torch.float, non_blocking=True)
+                        gt = responseCpu.to(device, dtype=torch.float)  # return a copy
 
-                    xr = net.forward(inputs)
-                    loss = lossFunc(xr, gt)
+                        xr = net.forward(inputs)
+                        loss = lossFunc(xr, gt)
 
-                    batchLoss = loss.item()
+                        batchLoss = loss.item()
 
-                    # accumulate response and predict value
+                        # accumulate response and predict value
 
-                    batchPredict = (xr>= 0).cpu().detach().numpy().flatten()
-                    epochPredict = np.concatenate(
-                        (epochPredict, batchPredict)) if epochPredict is not None else batchPredict
-                    batchGt = responseCpu.detach().numpy()
-                    epochResponse = np.concatenate(
-                        (epochResponse, batchGt)) if epochResponse is not None else batchGt
+                        batchPredict = (xr>= 0).cpu().detach().numpy().flatten()
+                        epochPredict = np.concatenate(
+                            (epochPredict, batchPredict)) if epochPredict is not None else batchPredict
+                        batchGt = responseCpu.detach().numpy()
+                        epochResponse = np.concatenate(
+                            (epochResponse, batchGt)) if epochResponse is not None else batchGt
 
-                    testLoss += batchLoss
-                    testBatches += 1
+                        testLoss += batchLoss
+                        testBatches += 1
 
-                    if oneSampleTraining:
-                        break
+                        if oneSampleTraining:
+                            break
 
-                if 0 != testBatches:
-                    testLoss /= testBatches
+                    if 0 != testBatches:
+                        testLoss /= testBatches
 
-                if epoch % 5 == 0:
-                    responseTestAccuracy = getAccuracy(epochPredict, epochResponse)
-                    responseTestTPR = getTPR(epochPredict, epochResponse)[0]
-                    responseTestTNR = getTNR(epochPredict, epochResponse)[0]
+                    if epoch % 5 == 0:
+                        responseTestAccuracy = getAccuracy(epochPredict, epochResponse)
+                        responseTestTPR = getTPR(epochPredict, epochResponse)[0]
+                        responseTestTNR = getTNR(epochPredict, epochResponse)[0]
 
 
         # ===========print train and test progress===============
@@ -453,16 +468,21 @@ def main():
         outputString  = f'{epoch}' +f'\t{learningRate:1.4e}'
         outputString += f'\t\t{trainingLoss:.4f}'       + f'\t{responseTrainAccuracy:.4f}'      + f'\t{responseTrainTPR:.4f}'      + f'\t{responseTrainTNR:.4f}'
         outputString += f'\t\t{validationLoss:.4f}'   + f'\t{responseValidationAccuracy:.4f}' + f'\t{responseValidationTPR:.4f}' + f'\t{responseValidationTNR:.4f}'
-        outputString += f'\t\t{testLoss:.4f}'         + f'\t{responseTestAccuracy:.4f}'       + f'\t{responseTestTPR:.4f}'       + f'\t{responseTestTNR:.4f}'
+        if runTest:
+            outputString += f'\t\t{testLoss:.4f}'         + f'\t{responseTestAccuracy:.4f}'       + f'\t{responseTestTPR:.4f}'       + f'\t{responseTestTNR:.4f}'
+        else:
+            outputString += f'\t\t--'  # test set skipped
         logging.info(outputString)
 
         # =============save net parameters==============
         if trainingLoss < float('inf') and not math.isnan(trainingLoss) :
             netMgr.saveNet()
-            if responseValidationAccuracy > bestTestPerf or (responseValidationAccuracy == bestTestPerf and validationLoss < oldTestLoss):
+            if validationImproved:
                 oldTestLoss = validationLoss
                 bestTestPerf = responseValidationAccuracy
                 netMgr.saveBest(bestTestPerf)
+                netMgr.saveTestResult({"epoch": epoch, "validationAccuracy": responseValidationAccuracy, "testLoss": testLoss,
+                                        "testAccuracy": responseTestAccuracy, "testTPR": responseTestTPR, "testTNR": responseTestTNR})
             if trainingLoss <= 0.02: # CrossEntropy use natural logarithm . -ln(0.98) = 0.0202. it means training accuracy  for each sample gets 98% above
                 logging.info(f"\n\n training loss less than 0.02, Program exit.")
                 break
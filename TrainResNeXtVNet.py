@@ -13,6 +13,7 @@ from FilesUtilities import *
 from MeasureUtilities import *
 from ResNeXtVNet import ResNeXtVNet
 from OCDataTransform import *
+from DataLoaderUtilities import *
 from NetMgr import NetMgr
 
 logNotes = r'''
@@ -45,14 +46,16 @@ def printUsage(argv):
     print("============Train ResNeXt VNet for Ovarian Cancer =============")
     print("Usage:")
     print(argv[0],
-          "<netSavedPath> <scratch> <fullPathOfData>  <fullPathOfLabel> <k>  <GPUID_List>")
+          "<netSavedPath> <scratch> <fullPathOfData>  <fullPathOfLabel> <k>  <GPUID_List>", getDataLoaderArgsUsage())
     print("where: \n"
           "       scratch =0: continue to train basing on previous training parameters; scratch=1, training from scratch.\n"
           "       k=[0, K), the k-th fold in the K-fold cross validation.\n"
-          "       GPUIDList: 0,1,2,3, the specific GPU ID List, separated by comma\n")
+          "       GPUIDList: 0,1,2,3, the specific GPU ID List, separated by comma\n"
+          "       numWorkers: number of DataLoader worker processes, default 0; prefetchFactor: batches loaded ahead by each worker, default 2;\n"
+          "       pinMemory: 1 collates batches into page-locked memory, default 1.\n")
 
 def main():
-    if len(sys.argv) != 7:
+    if len(sys.argv) < 7:
         print("Error: input parameters error.")
         printUsage(sys.argv)
         return -1
@@ -64,6 +67,7 @@ def main():
     k = int(sys.argv[5])
     GPUIDList = sys.argv[6].split(',')  # choices: 0,1,2,3 for lab server.
     GPUIDList = [int(x) for x in GPUIDList]
+    loaderArgs = parseDataLoaderArgs(sys.argv[7:])
 
     # ===========debug==================
     oneSampleTraining = False  # for debug
@@ -78,7 +82,6 @@ def main():
     K_fold = 5
     batchSize = 4 * len(GPUIDList)
     print(f"batchSize = {batchSize}")
-    numWorkers = 0
 
     device = torch.device(f"cuda:{GPUIDList[0]}" if torch.cuda.is_available() else "cpu")
 
@@ -131,11 +134,11 @@ def main():
     testTransform = OCDataLabelTransform(0)
 
     trainingData = OVDataSegSet('training', dataPartitions, transform=trainTransform,
-                             logInfoFun=logging.info if scratch > 0 else print)
+                             logInfoFun=logging.info if scratch > 0 else print, mmapMode="c")
     validationData = OVDataSegSet('validation', dataPartitions, transform=validationTransform,
-                               logInfoFun=logging.info if scratch > 0 else print)
+                               logInfoFun=logging.info if scratch > 0 else print, mmapMode="c")
     testData = OVDataSegSet('test', dataPartitions, transform=testTransform,
-                         logInfoFun=logging.info if scratch > 0 else print)
+                         logInfoFun=logging.info if scratch > 0 else print, mmapMode="c")
 
     net = ResNeXtVNet()
     # Important:
@@ -175,6 +178,7 @@ def main():
 
     epochs = 15000000
     oldTestLoss = 100000
+    testCadence = 0  # also run test set every testCadence epochs; 0 runs it only when validation improves
 
     if scratch > 0:
        logging.info(f"\n\n************** Table of Training Log **************")
@@ -183,19 +187,22 @@ def main():
                      + f"\t\tValidationLoss" + f"\tDice" \
                      + f"\t\tTestLoss" +       f"\tDice" )  # logging.info output head
 
+    trainingLoader = createDataLoader(trainingData, batchSize, shuffle=True, loaderArgs=loaderArgs)
+    validationLoader = createDataLoader(validationData, batchSize, shuffle=False, loaderArgs=loaderArgs)
+    testLoader = createDataLoader(testData, batchSize, shuffle=False, loaderArgs=loaderArgs)
+
     for epoch in range(lastEpoch + 1, epochs):
         random.seed()
 
         # ================Training===============
         net.train()
-        nSlice = 0
+        trainingMeasure = SegMeasureAccumulator(2)
 
         trainingLoss = 0.0
         trainingBatches = 0
-        trainingDice = 0.0
 
-        for inputs, labels, patientIDs in data.DataLoader(trainingData, batch_size=batchSize, shuffle=True, num_workers=numWorkers):
-            inputs = inputs.to(device, dtype=torch.float)
+        for inputs, labels, patientIDs in trainingLoader:
+            inputs = inputs.to(device, dtype=torch.float, non_blocking=True)
             gts = labels.to(device, dtype=torch.float)
             gts = (gts > 0).float() # not discriminate all non-zero labels.
 
@@ -210,11 +217,12 @@ def main():
                 nonzeroSlices = torch.nonzero(gt, as_tuple=True)[0]
                 nonzeroSlices = torch.unique(nonzeroSlices, sorted=True)
                 slices = nonzeroSlices.shape[0]
-                nSlice += slices
                 for sPos in range(slices):
                     s = nonzeroSlices[sPos]
                     loss += lossFunc(output[s,], gt[s,])
-                    trainingDice += tensorDice(output[s,], gt[s,])
+            with torch.no_grad():
+                # each slice as a sample, so that only labeled slices are counted in dice.
+                trainingMeasure.update((outputs > 0).view((-1,) + gtsShape[-2:]), gts.view((-1,) + gtsShape[-2:]))
 
             loss.backward()
             optimizer.step()
@@ -225,7 +233,7 @@ def main():
 
             if oneSampleTraining:
                 break
-        trainingDice = trainingDice/nSlice
+        trainingDice = trainingMeasure.getDiceTPRAvgLists()[0][1]  # dice over labeled slices, read back at epoch end
 
 
         if 0 != trainingBatches:
@@ -237,14 +245,13 @@ def main():
 
         # ================Validation===============
         net.eval()
-        nSlice = 0
+        validationMeasure = SegMeasureAccumulator(2)
         validationLoss = 0.0
         validationBatches = 0
-        validationDice = 0.0
 
         with torch.no_grad():
-            for inputs, labels, patientIDs in data.DataLoader(validationData, batch_size=batchSize, shuffle=False, num_workers=numWorkers):
-                inputs = inputs.to(device, dtype=torch.float)
+            for inputs, labels, patientIDs in validationLoader:
+                inputs = inputs.to(device, dtype=torch.float, non_blocking=True)
                 gts = labels.to(device, dtype=torch.float)  # return a copy
                 gts = (gts > 0).float()  # not discriminate all non-zero labels.
 
@@ -258,11 +265,10 @@ def main():
                     nonzeroSlices = torch.nonzero(gt, as_tuple=True)[0]
                     nonzeroSlices = torch.unique(nonzeroSlices, sorted=True)
                     slices = nonzeroSlices.shape[0]
-                    nSlice += slices
                     for sPos in range(slices):
                         s = nonzeroSlices[sPos]
                         loss += lossFunc(output[s,], gt[s,])
-                        validationDice += tensorDice(output[s,], gt[s,])
+                validationMeasure.update((outputs > 0).view((-1,) + gtsShape[-2:]), gts.view((-1,) + gtsShape[-2:]))
 
                 batchLoss = loss.item()
                 validationLoss += batchLoss
@@ -273,65 +279,74 @@ def main():
 
             if 0 != validationBatches:
                 validationLoss /= validationBatches
-            validationDice = validationDice / nSlice
-
-
-        # ================Independent Test===============
-        net.eval()
-        nSlice =0
+            validationDice = validationMeasure.getDiceTPRAvgLists()[0][1]  # dice over labeled slices, read back at epoch end
 
-        testLoss = 0.0
-        testBatches = 0
-        testDice = 0.0
 
-        with torch.no_grad():
-            for inputs, labels, patientIDs in data.DataLoader(testData, batch_size=batchSize, shuffle=False,num_workers=numWorkers):
-                inputs = inputs.to(device, dtype=torch.float)
-                gts = labels.to(device, dtype=torch.float)  # return a copy
-                gts = (gts > 0).float()  # not discriminate all non-zero labels.
+        # test set only runs for a new best net chosen by validation, or every testCadence epochs,
+        # so that a logged test result always belongs to a saved checkpoint.
+        validationImproved = trainingLoss < float('inf') and not math.isnan(trainingLoss) and \
+                             (validationDice > bestTestPerf or (validationDice == bestTestPerf and validationLoss < oldTestLoss))
+        runTest = validationImproved or (testCadence > 0 and epoch % testCadence == 0)
 
-                outputs = net.forward(inputs)
-
-                loss = torch.tensor(0.0).to(device, dtype=torch.float)
-                gtsShape = gts.shape
-                for i in range(gtsShape[0]):
-                    output = outputs[i,]
-                    gt = gts[i,]
-                    nonzeroSlices = torch.nonzero(gt, as_tuple=True)[0]
-                    nonzeroSlices = torch.unique(nonzeroSlices, sorted=True)
-                    slices = nonzeroSlices.shape[0]
-                    nSlice += slices
-                    for sPos in range(slices):
-                        s = nonzeroSlices[sPos]
-                        loss += lossFunc(output[s,], gt[s,])
-                        testDice += tensorDice(output[s,], gt[s,])
-
-                batchLoss = loss.item()
-                testLoss += batchLoss
-                testBatches += 1
-
-                if oneSampleTraining:
-                    break
-
-            if 0 != testBatches:
-                testLoss /= testBatches
-            testDice = testDice / nSlice
+        # ================Independent Test===============
+        if runTest:
+            net.eval()
+            testMeasure = SegMeasureAccumulator(2)
+
+            testLoss = 0.0
+            testBatches = 0
+
+            with torch.no_grad():
+                for inputs, labels, patientIDs in testLoader:
+                    inputs = inputs.to(device, dtype=torch.float, non_blocking=True)
+                    gts = labels.to(device, dtype=torch.float)  # return a copy
+                    gts = (gts > 0).float()  # not discriminate all non-zero labels.
+
+                    outputs = net.forward(inputs)
+
+                    loss = torch.tensor(0.0).to(device, dtype=torch.float)
+                    gtsShape = gts.shape
+                    for i in range(gtsShape[0]):
+                        output = outputs[i,]
+                        gt = gts[i,]
+                        nonzeroSlices = torch.nonzero(gt, as_tuple=True)[0]
+                        nonzeroSlices = torch.unique(nonzeroSlices, sorted=True)
+                        slices = nonzeroSlices.shape[0]
+                        for sPos in range(slices):
+                            s = nonzeroSlices[sPos]
+                            loss += lossFunc(output[s,], gt[s,])
+                    testMeasure.update((outputs > 0).view((-1,) + gtsShape[-2:]), gts.view((-1,) + gtsShape[-2:]))
+
+                    batchLoss = loss.item()
+                    testLoss += batchLoss
+                    testBatches += 1
+
+                    if oneSampleTraining:
+                        break
+
+                if 0 != testBatches:
+                    testLoss /= testBatches
+                testDice = testMeasure.getDiceTPRAvgLists()[0][1]  # dice over labeled slices, read back at epoch end
 
         # ===========print train and test progress===============
         learningRate = lrScheduler.get_lr()[0]
         outputString = f'{epoch}' + f'\t{learningRate:1.4e}'
         outputString += f'\t\t{trainingLoss:.4f}' + f'\t{trainingDice:.5f}'
         outputString += f'\t\t{validationLoss:.4f}' + f'\t{validationDice:.5f}'
-        outputString += f'\t\t{testLoss:.4f}' + f'\t{testDice:.5f}'
+        if runTest:
+            outputString += f'\t\t{testLoss:.4f}' + f'\t{testDice:.5f}'
+        else:
+            outputString += f'\t\t--'  # test set skipped
         logging.info(outputString)
 
         # =============save net parameters==============
         if trainingLoss < float('inf') and not math.isnan(trainingLoss):
             netMgr.saveNet()
-            if validationDice  > bestTestPerf or (validationDice == bestTestPerf and validationLoss < oldTestLoss):
+            if validationImproved:
                 oldTestLoss = validationLoss
                 bestTestPerf = validationDice
                 netMgr.saveBest(bestTestPerf)
+                netMgr.saveTestResult({"epoch": epoch, "validationDice": validationDice, "testLoss": testLoss, "testDice": testDice})
             if trainingLoss <= 10:
                 logging.info(f"\n\n training loss less than 10, Program exit.")
                 break
@@ -14,11 +14,12 @@ sys.path.append(torchSummaryPath)
 from torchsummary import summary
 
 from SegDataMgr import SegDataMgr
+from MeasureUtilities import SegMeasureAccumulator
 from SegV3DModel import SegV3DModel
 from SegV2DModel import SegV2DModel
 from SegV2DModel_78 import SegV2DModel_78
 from NetMgr  import NetMgr
-from CustomizedLoss import FocalCELoss,BoundaryLoss1
+from CustomizedLoss import FocalCELoss,BoundaryLoss1, mixupLoss
 
 import numpy as np
 
@@ -84,6 +85,7 @@ def main():
     if not mergeTrainTestData:
         testDataMgr = SegDataMgr(*trainDataMgr.getTestDirs(), inputSuffix,  logInfoFun=logging.info)
         testDataMgr.setRemainedLabel(3, labelTuple)
+        testDataMgr.setPrefetch(depth=4, readWorkers=4)
 
     # ===========debug==================
     restartTrainAfter100Epochs = True
@@ -101,6 +103,7 @@ def main():
     if mergeTrainTestData:
         trainDataMgr.expandInputsDir(trainDataMgr.getTestDirs()[0])
     trainDataMgr.buildSegSliceTupleList()
+    trainDataMgr.setVolumeCacheSize(8 * 2**30)  # keep 8GB decoded NRRD volumes in memory, shared by train and test dataMgr.
 
 
     if is2DInput:
@@ -122,9 +125,10 @@ def main():
     trainDataMgr.setMaxShift(25, 0.5)             #translation data augmentation and its probability
     trainDataMgr.setFlipProb(0.3)                 #flip data augmentation
     trainDataMgr.setRot90sProb(0.3)               #rotate along 90, 180, 270
-    # trainDataMgr.setJitterNoise(0.3, 1)           #add Jitter noise
+    trainDataMgr.setJitterNoise(0.3, 1)           #add Jitter noise, batched in dataLabelGenerator
     trainDataMgr.setAddedNoise(0.3, 0.0,  0.1)     #add gaussian noise augmentation after data normalization of [0,1]
     trainDataMgr.setMixup(alpha=0.4, prob=0.5)     # set Mixup
+    trainDataMgr.setPrefetch(depth=4, readWorkers=4)  # prepare batches in background while network computes
 
     optimizer = optim.Adam(net.parameters())
     net.setOptimizer(optimizer)
@@ -196,6 +200,9 @@ def main():
                     + f"\tTsLoss\t" + f"\t".join(diceHead2) + f"\t" + f"\t".join(TPRHead2))   # logging.info output head
 
     lastTrainingLoss = 1000
+    trainSliceIndices = list(range(len(trainDataMgr.m_segSliceTupleList)))  # all segmented slices of training set
+    testSliceIndices = [] if mergeTrainTestData else list(range(len(testDataMgr.m_segSliceTupleList)))
+
     for epoch in range(epochs):
 
         #================Update Loss weight==============
@@ -227,10 +234,7 @@ def main():
 
         #================Training===============
         random.seed()
-        trainDiceSumList = [0 for _ in range(K)]
-        trainDiceCountList = [0 for _ in range(K)]
-        trainTPRSumList = [0 for _ in range(K)]
-        trainTPRCountList = [0 for _ in range(K)]
+        trainMeasure = SegMeasureAccumulator(K)
 
         trainingLoss = 0.0
         trainBatches = 0
@@ -238,9 +242,9 @@ def main():
         if useDataParallel:
             lossWeightList = torch.Tensor(net.module.m_lossWeightList).to(device)
 
-        for (inputs1, labels1Cpu), (inputs2, labels2Cpu) in zip(trainDataMgr.dataLabelGenerator(True), trainDataMgr.dataLabelGenerator(True)):
-            lambdaInBeta = trainDataMgr.getLambdaInBeta()
-            inputs = inputs1* lambdaInBeta + inputs2*(1-lambdaInBeta)
+        # shuffle slices within windows of files, so that the volume cache holds the working set while batches mix volumes
+        trainGenerator = trainDataMgr.dataLabelGenerator(trainSliceIndices, shuffle=True, groupByFile=True)
+        for inputs, labels1Cpu, labels2Cpu, lambdaInBeta in trainDataMgr.prefetch(trainDataMgr.mixupGenerator(trainGenerator)):
             inputs = torch.from_numpy(inputs).to(device, dtype=torch.float)
             labels1= torch.from_numpy(labels1Cpu).to(device, dtype=torch.long)
             labels2 = torch.from_numpy(labels2Cpu).to(device, dtype=torch.long)
@@ -252,10 +256,7 @@ def main():
                 for lossFunc, weight in zip(net.module.m_lossFuncList, lossWeightList):
                     if weight == 0:
                         continue
-                    if lambdaInBeta != 0:
-                        loss += lossFunc(outputs, labels1) * weight*lambdaInBeta
-                    if 1-lambdaInBeta != 0:
-                        loss += lossFunc(outputs, labels2) * weight * (1-lambdaInBeta)
+                    loss += mixupLoss(lossFunc, outputs, labels1, labels2, lambdaInBeta) * weight  # log-probabilities of outputs evaluated once
                 loss.backward()
                 optimizer.step()
                 batchLoss = loss.item()
@@ -263,11 +264,9 @@ def main():
                 batchLoss = net.batchTrainMixup(inputs, labels1, labels2, lambdaInBeta)
 
             if lambdaInBeta == 1 and outputTrainDice and epoch % 5 == 0:
-                trainDiceSumList, trainDiceCountList, trainTPRSumList, trainTPRCountList \
-                    = trainDataMgr.updateDiceTPRSumList(outputs, labels1Cpu, K, trainDiceSumList, trainDiceCountList, trainTPRSumList, trainTPRCountList)
+                trainMeasure.updateWithOutputs(outputs.detach(), labels1)
             if lambdaInBeta == 0 and outputTrainDice and epoch % 5 == 0:
-                trainDiceSumList, trainDiceCountList, trainTPRSumList, trainTPRCountList \
-                    = trainDataMgr.updateDiceTPRSumList(outputs, labels2Cpu, K, trainDiceSumList, trainDiceCountList, trainTPRSumList, trainTPRCountList)
+                trainMeasure.updateWithOutputs(outputs.detach(), labels2)
 
             trainingLoss += batchLoss
             trainBatches += 1
@@ -275,20 +274,16 @@ def main():
         if 0 != trainBatches:
             trainingLoss /= trainBatches
 
-        trainDiceAvgList = [x / (y + 1e-8) for x, y in zip(trainDiceSumList, trainDiceCountList)]
-        trainTPRAvgList = [x / (y + 1e-8) for x, y in zip(trainTPRSumList, trainTPRCountList)]
+        trainDiceAvgList, trainTPRAvgList = trainMeasure.getDiceTPRAvgLists()  # read back at epoch end
 
         # ================Test===============
-        testDiceSumList = [0 for _ in range(K)]
-        testDiceCountList = [0 for _ in range(K)]
-        testTPRSumList = [0 for _ in range(K)]
-        testTPRCountList = [0 for _ in range(K)]
+        testMeasure = SegMeasureAccumulator(K)
         testLoss = 0.0
         testBatches = 0
         if not mergeTrainTestData:
             net.eval()
             with torch.no_grad():
-                for inputs, labelsCpu in testDataMgr.dataLabelGenerator(True):
+                for inputs, labelsCpu in testDataMgr.prefetch(testDataMgr.dataLabelGenerator(testSliceIndices, shuffle=False)):
                     inputs, labels = torch.from_numpy(inputs), torch.from_numpy(labelsCpu)
                     inputs, labels = inputs.to(device, dtype=torch.float), labels.to(device, dtype=torch.long)  # return a copy
 
@@ -302,8 +297,7 @@ def main():
                     else:
                         batchLoss, outputs = net.batchTest(inputs, labels)
 
-                    testDiceSumList, testDiceCountList, testTPRSumList, testTPRCountList \
-                        = testDataMgr.updateDiceTPRSumList(outputs, labelsCpu, K, testDiceSumList, testDiceCountList, testTPRSumList, testTPRCountList)
+                    testMeasure.updateWithOutputs(outputs, labels)
 
                     testLoss += batchLoss
                     testBatches += 1
@@ -316,11 +310,13 @@ def main():
         else:
             lrScheduler.step(trainingLoss)
 
-        testDiceAvgList = [x/(y+1e-8) for x,y in zip(testDiceSumList, testDiceCountList)]
-        testTPRAvgList  = [x/(y+1e-8) for x, y in zip(testTPRSumList, testTPRCountList)]
+        testDiceAvgList, testTPRAvgList = testMeasure.getDiceTPRAvgLists()  # read back at epoch end
 
         logging.info(f'{epoch}\t{trainingLoss:.4f}\t'+ f'\t'.join((f'{x:.3f}' for x in trainDiceAvgList))+f'\t'+ f'\t'.join( (f'{x:.3f}' for x in trainTPRAvgList))\
                               + f'\t{testLoss:.4f}\t'+ f'\t'.join((f'{x:.3f}' for x in testDiceAvgList))+ f'\t'+ f'\t'.join( (f'{x:.3f}' for x in testTPRAvgList)))
+        lossTimingInfo = net.module.lossTimingInfo() if useDataParallel else net.lossTimingInfo()
+        if lossTimingInfo:
+            logging.info(lossTimingInfo)  # e.g. level set time of BoundaryLoss2
 
         # =============save net parameters==============
         if trainingLoss != float('inf') and trainingLoss != float('nan'):
@@ -340,6 +336,7 @@ def main():
             sys.exit()
 
     torch.cuda.empty_cache()
+    logging.info(trainDataMgr.getVolumeCacheInfo())
     logging.info(f"=============END of Training of Ovarian Cancer Segmentation V Model =================")
     print(f'Program ID {os.getpid()}  exits.\n')
 
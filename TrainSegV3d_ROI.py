@@ -13,6 +13,7 @@ from FilesUtilities import *
 from MeasureUtilities import *
 from SegV3DModel import SegV3DModel
 from OCDataTransform import *
+from DataLoaderUtilities import *
 from NetMgr import NetMgr
 from CustomizedLoss import *
 
@@ -71,14 +72,16 @@ def printUsage(argv):
     print("============Train Seg 3D  VNet for ROI around primary Cancer =============")
     print("Usage:")
     print(argv[0],
-          "<netSavedPath> <scratch> <fullPathOfData>  <fullPathOfLabel> <k>  <GPUID_List>")
+          "<netSavedPath> <scratch> <fullPathOfData>  <fullPathOfLabel> <k>  <GPUID_List>", getDataLoaderArgsUsage())
     print("where: \n"
           "       scratch =0: continue to train basing on previous training parameters; scratch=1, training from scratch.\n"
           "       k=[0, K), the k-th fold in the K-fold cross validation.\n"
-          "       GPUIDList: 0,1,2,3, the specific GPU ID List, separated by comma\n")
+          "       GPUIDList: 0,1,2,3, the specific GPU ID List, separated by comma\n"
+          "       numWorkers: number of DataLoader worker processes, default 0; prefetchFactor: batches loaded ahead by each worker, default 2;\n"
+          "       pinMemory: 1 collates batches into page-locked memory, default 1.\n")
 
 def main():
-    if len(sys.argv) != 7:
+    if len(sys.argv) < 7:
         print("Error: input parameters error.")
         printUsage(sys.argv)
         return -1
@@ -90,6 +93,7 @@ def main():
     k = int(sys.argv[5])
     GPUIDList = sys.argv[6].split(',')  # choices: 0,1,2,3 for lab server.
     GPUIDList = [int(x) for x in GPUIDList]
+    loaderArgs = parseDataLoaderArgs(sys.argv[7:])
 
     # addBoundaryLoss = True
 
@@ -106,7 +110,6 @@ def main():
     K_fold = 6
     batchSize = 2 * len(GPUIDList)
     print(f"batchSize = {batchSize}")
-    numWorkers = 0
 
     device = torch.device(f"cuda:{GPUIDList[0]}" if torch.cuda.is_available() else "cpu")
 
@@ -154,16 +157,17 @@ def main():
     dataPartitions = OVDataSegPartition(dataInputsPath, groundTruthPath, inputSuffix, K_fold, k,
                                      logInfoFun=logging.info if scratch > 0 else print)
 
+    dataPartitions.prepareDistanceMaps()  # for DistanceCrossEntropyLoss, computed once per label file
     trainTransform = OCDataLabelTransform(0.6)
     validationTransform = OCDataLabelTransform(0)
     testTransform = OCDataLabelTransform(0)
 
     trainingData = OVDataSegSet('training', dataPartitions, transform=trainTransform,
-                             logInfoFun=logging.info if scratch > 0 else print)
+                             logInfoFun=logging.info if scratch > 0 else print, mmapMode="c", withDistanceMaps=True)
     validationData = OVDataSegSet('validation', dataPartitions, transform=validationTransform,
-                               logInfoFun=logging.info if scratch > 0 else print)
+                               logInfoFun=logging.info if scratch > 0 else print, mmapMode="c", withDistanceMaps=True)
     testData = OVDataSegSet('test', dataPartitions, transform=testTransform,
-                         logInfoFun=logging.info if scratch > 0 else print)
+                         logInfoFun=logging.info if scratch > 0 else print, mmapMode="c", withDistanceMaps=True)
 
     net = SegV3DModel()
     # Important:
@@ -211,6 +215,7 @@ def main():
 
     epochs = 15000000
     oldTestLoss = 100000
+    testCadence = 0  # also run test set every testCadence epochs; 0 runs it only when validation improves
 
     if scratch > 0:
        logging.info(f"\n\n************** Table of Training Log **************")
@@ -219,6 +224,10 @@ def main():
                      + f"\t\tValidationLoss" + f"\tDice" \
                      + f"\t\tTestLoss" +       f"\tDice" )  # logging.info output head
 
+    trainingLoader = createDataLoader(trainingData, batchSize, shuffle=True, loaderArgs=loaderArgs)
+    validationLoader = createDataLoader(validationData, batchSize, shuffle=False, loaderArgs=loaderArgs)
+    testLoader = createDataLoader(testData, batchSize, shuffle=False, loaderArgs=loaderArgs)
+
     for epoch in range(lastEpoch + 1, epochs):
         random.seed()
 
@@ -240,18 +249,18 @@ def main():
 
         # ================Training===============
         net.train()
-        nSample = 0
+        trainingMeasure = SegMeasureAccumulator(2)
 
         trainingLoss = 0.0
         trainingBatches = 0
-        trainingDice = 0.0
 
-        for inputs, labels, patientIDs in data.DataLoader(trainingData, batch_size=batchSize, shuffle=True, num_workers=numWorkers):
-            inputs = inputs.to(device, dtype=torch.float)
+        for inputs, labels, distances, patientIDs in trainingLoader:
+            inputs = inputs.to(device, dtype=torch.float, non_blocking=True)
+            distances = distances.to(device, dtype=torch.float, non_blocking=True)
             gts = labels.to(device, dtype=torch.float)
             gts = (gts > 0).long() # not discriminate all non-zero labels.
 
-            outputs, loss = net.forward(inputs, gts)
+            outputs, loss = net.forward(inputs, gts, distances)
             loss = loss.sum()  # gather loss on different GPUs.
             optimizer.zero_grad()
             loss.backward()
@@ -260,19 +269,14 @@ def main():
 
             # compute dice
             with torch.no_grad():
-                gtsShape = gts.shape
-                for i in range(gtsShape[0]):
-                    output = outputs[i,]
-                    gt = gts[i,]
-                    trainingDice += tensorDice(torch.argmax(output, dim=0), gt)
-                nSample += gtsShape[0]
+                trainingMeasure.updateWithOutputs(outputs, gts)
 
             trainingLoss += batchLoss
             trainingBatches += 1
 
             if oneSampleTraining:
                 break
-        trainingDice = trainingDice / nSample
+        trainingDice = trainingMeasure.getDiceTPRAvgLists()[0][1]  # read back at epoch end
 
 
         if 0 != trainingBatches:
@@ -283,28 +287,23 @@ def main():
 
         # ================Validation===============
         net.eval()
-        nSample = 0
+        validationMeasure = SegMeasureAccumulator(2)
         validationLoss = 0.0
         validationBatches = 0
-        validationDice = 0.0
 
         with torch.no_grad():
-            for inputs, labels, patientIDs in data.DataLoader(validationData, batch_size=batchSize, shuffle=False, num_workers=numWorkers):
-                inputs = inputs.to(device, dtype=torch.float)
+            for inputs, labels, distances, patientIDs in validationLoader:
+                inputs = inputs.to(device, dtype=torch.float, non_blocking=True)
+                distances = distances.to(device, dtype=torch.float, non_blocking=True)
                 gts = labels.to(device, dtype=torch.float)  # return a copy
                 gts = (gts > 0).long()  # not discriminate all non-zero labels.
 
-                outputs, loss = net.forward(inputs,gts)
+                outputs, loss = net.forward(inputs, gts, distances)
                 loss = loss.sum()  # gather loss on different GPUs.
                 batchLoss = loss.item()
 
                 # compute dice
-                gtsShape = gts.shape
-                for i in range(gtsShape[0]):
-                    output = outputs[i,]
-                    gt = gts[i,]
-                    validationDice += tensorDice(torch.argmax(output, dim=0), gt)
-                nSample += gtsShape[0]
+                validationMeasure.updateWithOutputs(outputs, gts)
 
                 validationLoss += batchLoss
                 validationBatches += 1
@@ -315,60 +314,69 @@ def main():
             if 0 != validationBatches:
                 validationLoss /= validationBatches
             lrScheduler.step(validationLoss)
-            validationDice = validationDice / nSample
+            validationDice = validationMeasure.getDiceTPRAvgLists()[0][1]
+
 
+        # test set only runs for a new best net chosen by validation, or every testCadence epochs,
+        # so that a logged test result always belongs to a saved checkpoint.
+        validationImproved = trainingLoss < float('inf') and not math.isnan(trainingLoss) and \
+                             (validationDice > bestTestPerf or (validationDice == bestTestPerf and validationLoss < oldTestLoss))
+        runTest = validationImproved or (testCadence > 0 and epoch % testCadence == 0)
 
         # ================Independent Test===============
-        net.eval()
-        nSample =0
+        if runTest:
+            net.eval()
+            testMeasure = SegMeasureAccumulator(2)
 
-        testLoss = 0.0
-        testBatches = 0
-        testDice = 0.0
+            testLoss = 0.0
+            testBatches = 0
 
-        with torch.no_grad():
-            for inputs, labels, patientIDs in data.DataLoader(testData, batch_size=batchSize, shuffle=False,num_workers=numWorkers):
-                inputs = inputs.to(device, dtype=torch.float)
-                gts = labels.to(device, dtype=torch.float)  # return a copy
-                gts = (gts > 0).long()  # not discriminate all non-zero labels.
+            with torch.no_grad():
+                for inputs, labels, distances, patientIDs in testLoader:
+                    inputs = inputs.to(device, dtype=torch.float, non_blocking=True)
+                    distances = distances.to(device, dtype=torch.float, non_blocking=True)
+                    gts = labels.to(device, dtype=torch.float)  # return a copy
+                    gts = (gts > 0).long()  # not discriminate all non-zero labels.
 
-                outputs, loss = net.forward(inputs, gts)
-                loss = loss.sum()  # gather loss on different GPUs.
-                batchLoss = loss.item()
+                    outputs, loss = net.forward(inputs, gts, distances)
+                    loss = loss.sum()  # gather loss on different GPUs.
+                    batchLoss = loss.item()
 
-                # compute dice
-                gtsShape = gts.shape
-                for i in range(gtsShape[0]):
-                    output = outputs[i,]
-                    gt = gts[i,]
-                    testDice += tensorDice(torch.argmax(output, dim=0), gt)
-                nSample += gtsShape[0]
+                    # compute dice
+                    testMeasure.updateWithOutputs(outputs, gts)
 
-                testLoss += batchLoss
-                testBatches += 1
+                    testLoss += batchLoss
+                    testBatches += 1
 
-                if oneSampleTraining:
-                    break
+                    if oneSampleTraining:
+                        break
 
-            if 0 != testBatches:
-                testLoss /= testBatches
-            testDice = testDice / nSample
+                if 0 != testBatches:
+                    testLoss /= testBatches
+                testDice = testMeasure.getDiceTPRAvgLists()[0][1]
 
         # ===========print train and test progress===============
         learningRate = net.module.getLR() if useDataParallel else net.getLR()
         outputString = f'{epoch}' + f'\t{learningRate:1.4e}'
         outputString += f'\t\t{trainingLoss:.4f}' + f'\t\t{trainingDice:.5f}'
         outputString += f'\t\t{validationLoss:.4f}' + f'\t\t{validationDice:.5f}'
-        outputString += f'\t\t{testLoss:.4f}' + f'\t\t{testDice:.5f}'
+        if runTest:
+            outputString += f'\t\t{testLoss:.4f}' + f'\t\t{testDice:.5f}'
+        else:
+            outputString += f'\t\t--'  # test set skipped
         logging.info(outputString)
+        lossTimingInfo = net.module.lossTimingInfo() if useDataParallel else net.lossTimingInfo()
+        if lossTimingInfo:
+            logging.info(lossTimingInfo)  # e.g. level set time of BoundaryLoss2
 
         # =============save net parameters==============
         if trainingLoss < float('inf') and not math.isnan(trainingLoss):
             netMgr.saveNet()
-            if validationDice  > bestTestPerf or (validationDice == bestTestPerf and validationLoss < oldTestLoss):
+            if validationImproved:
                 oldTestLoss = validationLoss
                 bestTestPerf = validationDice
                 netMgr.saveBest(bestTestPerf)
+                netMgr.saveTestResult({"epoch": epoch, "validationDice": validationDice, "testLoss": testLoss, "testDice": testDice})
 
     torch.cuda.empty_cache()
     logging.info(f"\n\n=============END of Training of ResNeXt V Model =================")
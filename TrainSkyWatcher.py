@@ -12,9 +12,11 @@ import numpy as np
 import math
 
 from Image3dResponseDataMgr import Image3dResponseDataMgr
+from MeasureUtilities import SegMeasureAccumulator
 from SkyWatcherModel2 import SkyWatcherModel2
 from NetMgr import NetMgr
-from CustomizedLoss import FocalCELoss, BoundaryLoss1
+from FeatureBank import FeatureBank
+from CustomizedLoss import FocalCELoss, BoundaryLoss1, mixupLoss
 
 logNotes = r'''
 Major program changes: 
@@ -122,6 +124,7 @@ def main():
     dataMgr.setRot90sProb(0.3)  # rotate along 90, 180, 270
     dataMgr.setAddedNoise(0.3, 0.0, 0.1)  # add gaussian noise augmentation after data normalization of [0,1]
     dataMgr.setMixup(alpha=0.4, prob=0.5)  # set Mixup parameters
+    dataMgr.setPrefetch(depth=4, readWorkers=4)  # prepare batches in background while network computes
 
     # ===========debug==================
     dataMgr.setOneSampleTraining(False)  # for debug
@@ -206,6 +209,9 @@ def main():
     lrScheduler.patience = 300  # change learning patience
 
     pivotEpoch = 1000
+    featureCacheDraws = 10  # augmentation draws of training set encoded once into featureBank after pivotEpoch; 0 runs full forward in each step
+    featureBank = FeatureBank(maxBytes=4 * 2**30)  # crossing-point features of frozen encoder for training response branch
+    entriesPerEpoch = None  # bank entries trained per epoch, set to the size of first encoded pass
     logging.info(f"when epoch < {pivotEpoch}, only train segmentation, which means response accuracy are meaningless at these epoch.")
     logging.info(f"when epoch >= {pivotEpoch}, only training response branch, which means segmentation accuracy should keep unchange.")
 
@@ -238,12 +244,12 @@ def main():
             if useDataParallel:
                 net.module.freezeResponseBranch(requires_grad=True)
                 net.module.freezeEncoder(requires_grad=False)
-                net.module.freezeDecoder(requires_grad=False)
+                logging.info(net.module.freezeDecoder(requires_grad=False))  # optimizer re-grouped onto response branch
 
             else:
                 net.freezeResponseBranch(requires_grad=True)
                 net.freezeEncoder(requires_grad=False)
-                net.freezeDecoder(requires_grad=False)
+                logging.info(net.freezeDecoder(requires_grad=False))  # optimizer re-grouped onto response branch
 
             # restore learning rate to initial value
             for param_group in optimizer.param_groups:
@@ -263,10 +269,7 @@ def main():
         responseTrainTPR = 0.0
         responseTrainTNR = 0.0
 
-        trainDiceSumList = [0 for _ in range(Kup)]
-        trainDiceCountList = [0 for _ in range(Kup)]
-        trainTPRSumList = [0 for _ in range(Kup)]
-        trainTPRCountList = [0 for _ in range(Kup)]
+        trainMeasure = SegMeasureAccumulator(Kup)
 
 
         if useDataParallel:
@@ -274,64 +277,101 @@ def main():
         else:
             lossWeightList = torch.Tensor(net.m_lossWeightList).to(device)
 
-        for (inputs1, seg1Cpu, response1Cpu), (inputs2, seg2Cpu, response2Cpu) in zip(dataMgr.dataSegResponseGenerator(dataMgr.m_trainingSetIndices, shuffle=True, dataAugment=True, reSample=True),
-                                                                                      dataMgr.dataSegResponseGenerator(dataMgr.m_trainingSetIndices, shuffle=True, dataAugment=True, reSample=True)):
-            if epoch % 5 == 0:
-                lambdaInBeta = 1                          # this will make the comparison in the segmention per 5 epochs meaningful.
-            else:
-                lambdaInBeta = dataMgr.getLambdaInBeta()
-
-            inputs = inputs1 * lambdaInBeta + inputs2 * (1 - lambdaInBeta)
-            inputs = torch.from_numpy(inputs).to(device, dtype=torch.float)
-            seg1 = torch.from_numpy(seg1Cpu).to(device, dtype=torch.long)
-            seg2 = torch.from_numpy(seg2Cpu).to(device, dtype=torch.long)
-            response1 = torch.from_numpy(response1Cpu).to(device, dtype=torch.long)
-            response2 = torch.from_numpy(response2Cpu).to(device, dtype=torch.long)
+        useFeatureBank = epoch >= pivotEpoch and featureCacheDraws > 0  # segmentation is not measured on training set then
+        if useFeatureBank:
+            # encoder and decoder are frozen in the response phase, so each (sample, augmentation draw) is encoded once
+            # into featureBank, and the response branch trains from the bank without encoder and decoder in each step.
+            model = net.module if useDataParallel else net
+            if epoch - pivotEpoch < featureCacheDraws:
+                model.eval()  # frozen encoder uses its running statistics
+                with torch.no_grad():
+                    for inputs, segCpu, responseCpu in dataMgr.prefetch(dataMgr.dataSegResponseGenerator(dataMgr.m_trainingSetIndices, shuffle=True, dataAugment=True, reSample=True)):
+                        inputs = torch.from_numpy(inputs).to(device, dtype=torch.float)
+                        featureBank.add(model.encoderForward(inputs), responseCpu)
+                model.train()
+                if epoch == pivotEpoch:
+                    entriesPerEpoch = len(featureBank)  # one pass of training set
+                if epoch - pivotEpoch == featureCacheDraws - 1:
+                    logging.info(featureBank.getInfo())
+
+            responseLossFunc = model.m_lossFuncList[0]
+            # each epoch draws one training-set-sized subset of the bank, keeping the steps per epoch of lrScheduler patience.
+            for features, response1Cpu, response2Cpu, lambdaInBeta in dataMgr.mixupGenerator(featureBank.batchGenerator(batchSize, numEntries=entriesPerEpoch), mixup=(epoch % 5 != 0)):
+                features = torch.from_numpy(features).to(device, dtype=torch.float)
+                response1 = torch.from_numpy(response1Cpu).to(device, dtype=torch.long)
+                response2 = torch.from_numpy(response2Cpu).to(device, dtype=torch.long)
+
+                optimizer.zero_grad()
+                xr = model.responseForward(features)
+                loss = mixupLoss(responseLossFunc, xr, response1, response2, lambdaInBeta) * lossWeightList[0]
+                loss.backward()
+                optimizer.step()
+                batchLoss = loss.item()
 
+                # accumulate response and predict value
+                if epoch % 5 == 0:
+                    batchPredict = torch.argmax(xr, dim=1).cpu().detach().numpy().flatten()
+                    epochPredict = np.concatenate((epochPredict, batchPredict)) if epochPredict is not None else batchPredict
+                    epochResponse = np.concatenate((epochResponse, response1Cpu)) if epochResponse is not None else response1Cpu
 
-            optimizer.zero_grad()
-            xr, xup = net.forward(inputs)
-            loss = torch.tensor(0.0).to(device)
+                trainingLoss += batchLoss
+                trainBatches += 1
 
-            for i, (lossFunc, weight) in enumerate(zip(net.module.m_lossFuncList if useDataParallel else net.m_lossFuncList,
-                                                       lossWeightList)):
-                if weight == 0:
-                    continue
+        else:
+            # mixup = False at epoch % 5 == 0 will make the comparison in the segmention per 5 epochs meaningful.
+            for inputs, seg1Cpu, response1Cpu, seg2Cpu, response2Cpu, lambdaInBeta in dataMgr.prefetch(dataMgr.mixupGenerator(
+                    dataMgr.dataSegResponseGenerator(dataMgr.m_trainingSetIndices, shuffle=True, dataAugment=True, reSample=True), mixup=(epoch % 5 != 0))):
+                inputs = torch.from_numpy(inputs).to(device, dtype=torch.float)
+                seg1 = torch.from_numpy(seg1Cpu).to(device, dtype=torch.long)
+                seg2 = torch.from_numpy(seg2Cpu).to(device, dtype=torch.long)
+                response1 = torch.from_numpy(response1Cpu).to(device, dtype=torch.long)
+                response2 = torch.from_numpy(response2Cpu).to(device, dtype=torch.long)
+
+
+                # only run the head trained in this phase, except both heads are measured per 5 epochs.
+                activeHeads = {"response"} if epoch >= pivotEpoch else {"segmentation"}
+                if epoch % 5 == 0:
+                    activeHeads = {"response", "segmentation"}
+
+                optimizer.zero_grad()
+                xr, xup = net.forward(inputs, activeHeads=activeHeads)
+                loss = torch.tensor(0.0).to(device)
 
-                if i ==0:
-                    if epoch >= pivotEpoch:   #only train treatment reponse branch after epoch 1000.
-                        outputs = xr
-                        gt1, gt2 = (response1, response2)
-                    else:
+                for i, (lossFunc, weight) in enumerate(zip(net.module.m_lossFuncList if useDataParallel else net.m_lossFuncList,
+                                                           lossWeightList)):
+                    if weight == 0:
                         continue
-                else:
-                    # only train seg path before pivotEpoch
-                    if epoch >=pivotEpoch:
-                         continue
+
+                    if i ==0:
+                        if epoch >= pivotEpoch:   #only train treatment reponse branch after epoch 1000.
+                            outputs = xr
+                            gt1, gt2 = (response1, response2)
+                        else:
+                            continue
                     else:
-                         outputs = xup
-                         gt1, gt2 = (seg1, seg2)
+                        # only train seg path before pivotEpoch
+                        if epoch >=pivotEpoch:
+                             continue
+                        else:
+                             outputs = xup
+                             gt1, gt2 = (seg1, seg2)
 
-                if lambdaInBeta != 0:
-                    loss += lossFunc(outputs, gt1) * weight * lambdaInBeta
-                if 1 - lambdaInBeta != 0:
-                    loss += lossFunc(outputs, gt2) * weight * (1 - lambdaInBeta)
-            loss.backward()
-            optimizer.step()
-            batchLoss = loss.item()
+                    loss += mixupLoss(lossFunc, outputs, gt1, gt2, lambdaInBeta) * weight  # log-probabilities of outputs evaluated once
+                loss.backward()
+                optimizer.step()
+                batchLoss = loss.item()
 
 
-            # accumulate response and predict value
-            if epoch % 5 == 0:
-                batchPredict = torch.argmax(xr, dim=1).cpu().detach().numpy().flatten()
-                epochPredict = np.concatenate((epochPredict, batchPredict)) if epochPredict is not None else batchPredict
-                epochResponse = np.concatenate((epochResponse, response1Cpu)) if epochResponse is not None else response1Cpu
-                trainDiceSumList, trainDiceCountList, trainTPRSumList, trainTPRCountList \
-                                         = dataMgr.updateDiceTPRSumList(xup, seg1Cpu, Kup, trainDiceSumList, trainDiceCountList,
-                                                                                           trainTPRSumList, trainTPRCountList)
+                # accumulate response and predict value
+                if epoch % 5 == 0:
+                    batchPredict = torch.argmax(xr, dim=1).cpu().detach().numpy().flatten()
+                    epochPredict = np.concatenate((epochPredict, batchPredict)) if epochPredict is not None else batchPredict
+                    epochResponse = np.concatenate((epochResponse, response1Cpu)) if epochResponse is not None else response1Cpu
+                    trainMeasure.updateWithOutputs(xup.detach(), seg1)
+
+                trainingLoss += batchLoss
+                trainBatches += 1
 
-            trainingLoss += batchLoss
-            trainBatches += 1
 
         if 0 != trainBatches:
             trainingLoss /= trainBatches
@@ -341,8 +381,7 @@ def main():
             responseTrainAccuracy = dataMgr.getAccuracy(epochPredict, epochResponse)
             responseTrainTPR = dataMgr.getTPR(epochPredict, epochResponse)[0]
             responseTrainTNR = dataMgr.getTNR(epochPredict, epochResponse)[0]
-            trainDiceAvgList = [x / (y + 1e-8) for x, y in zip(trainDiceSumList, trainDiceCountList)]
-            trainTPRAvgList = [x / (y + 1e-8) for x, y in zip(trainTPRSumList, trainTPRCountList)]
+            trainDiceAvgList, trainTPRAvgList = trainMeasure.getDiceTPRAvgLists()  # read back at epoch end
         else:
             continue  # only epoch %5 ==0, run validation set.
 
@@ -358,13 +397,10 @@ def main():
         responseTestTPR = 0.0
         responseTestTNR = 0.0
 
-        testDiceSumList = [0 for _ in range(Kup)]
-        testDiceCountList = [0 for _ in range(Kup)]
-        testTPRSumList = [0 for _ in range(Kup)]
-        testTPRCountList = [0 for _ in range(Kup)]
+        testMeasure = SegMeasureAccumulator(Kup)
 
         with torch.no_grad():
-            for inputs, segCpu, responseCpu in dataMgr.dataSegResponseGenerator(dataMgr.m_validationSetIndices, shuffle=False, dataAugment=False, reSample=False):
+            for inputs, segCpu, responseCpu in dataMgr.prefetch(dataMgr.dataSegResponseGenerator(dataMgr.m_validationSetIndices, shuffle=False, dataAugment=False, reSample=False)):
                 inputs, seg, response = torch.from_numpy(inputs), torch.from_numpy(segCpu), torch.from_numpy(responseCpu)
                 inputs, seg, response = inputs.to(device, dtype=torch.float), seg.to(device, dtype=torch.long), response.to(device, dtype=torch.long)  # return a copy
 
@@ -399,8 +435,7 @@ def main():
                 epochPredict = np.concatenate((epochPredict, batchPredict)) if epochPredict is not None else batchPredict
                 epochResponse = np.concatenate((epochResponse, responseCpu)) if epochResponse is not None else responseCpu
 
-                testDiceSumList, testDiceCountList, testTPRSumList, testTPRCountList \
-                    = dataMgr.updateDiceTPRSumList(xup, segCpu, Kup, testDiceSumList, testDiceCountList, testTPRSumList, testTPRCountList)
+                testMeasure.updateWithOutputs(xup, seg)
 
                 testLoss += batchLoss
                 testBatches += 1
@@ -414,10 +449,13 @@ def main():
                 responseTestTPR = dataMgr.getTPR(epochPredict, epochResponse)[0]
                 responseTestTNR = dataMgr.getTNR(epochPredict, epochResponse)[0]
 
-        testDiceAvgList = [x / (y + 1e-8) for x, y in zip(testDiceSumList, testDiceCountList)]
-        testTPRAvgList  = [x / (y + 1e-8) for x, y in zip(testTPRSumList, testTPRCountList)]
+        testDiceAvgList, testTPRAvgList = testMeasure.getDiceTPRAvgLists()  # read back at epoch end
 
-        outputString =  f'{epoch}\t{trainingLoss:.4f}\t' + f'\t'.join((f'{x:.3f}' for x in trainDiceAvgList)) + f'\t' + f'\t'.join((f'{x:.3f}' for x in trainTPRAvgList)) + f'\t{responseTrainAccuracy:.4f}' + f'\t{responseTrainTPR:.4f}' + f'\t{responseTrainTNR:.4f}'
+        if useFeatureBank:
+            outputString = f'{epoch}\t{trainingLoss:.4f}\t' + f'\t'.join(['--'] * (2 * Kup))  # segmentation skipped in training
+        else:
+            outputString = f'{epoch}\t{trainingLoss:.4f}\t' + f'\t'.join((f'{x:.3f}' for x in trainDiceAvgList)) + f'\t' + f'\t'.join((f'{x:.3f}' for x in trainTPRAvgList))
+        outputString += f'\t{responseTrainAccuracy:.4f}' + f'\t{responseTrainTPR:.4f}' + f'\t{responseTrainTNR:.4f}'
         outputString += f'\t\t{testLoss:.4f}\t' + f'\t'.join((f'{x:.3f}' for x in testDiceAvgList)) + f'\t' + f'\t'.join((f'{x:.3f}' for x in testTPRAvgList)) + f'\t{responseTestAccuracy:.4f}'+f'\t{responseTestTPR:.4f}'+ f'\t{responseTestTNR:.4f}'
         logging.info(outputString)
 
@@ -13,7 +13,7 @@ import numpy as np
 from Image3dResponseDataMgr import Image3dResponseDataMgr
 from SkyWatcherModel2 import SkyWatcherModel2
 from NetMgr import NetMgr
-from CustomizedLoss import FocalCELoss
+from CustomizedLoss import FocalCELoss, mixupLoss
 
 # you may need to change the file name and log Notes below for every training.
 trainLogFile = r'''/home/hxie1/Projects/OvarianCancer/trainLog/log_SkyWatcher_PurePrediction_20190624.txt'''
@@ -190,15 +190,9 @@ def main():
         else:
             lossWeightList = torch.Tensor(net.m_lossWeightList).to(device)
 
-        for (inputs1, response1Cpu), (inputs2, response2Cpu) in zip(
-                                            dataMgr.dataResponseGenerator(dataMgr.m_trainingSetIndices, shuffle=True, dataAugment=True, reSample=True),
-                                            dataMgr.dataResponseGenerator(dataMgr.m_trainingSetIndices, shuffle=True, dataAugment=True, reSample=True)):
-            if epoch % 5 == 0:
-                lambdaInBeta = 1  # this will make the comparison in the segmention per 5 epochs meaningful.
-            else:
-                lambdaInBeta = dataMgr.getLambdaInBeta()
-
-            inputs = inputs1 * lambdaInBeta + inputs2 * (1 - lambdaInBeta)
+        # mixup = False at epoch % 5 == 0 will make the comparison in the segmention per 5 epochs meaningful.
+        for inputs, response1Cpu, response2Cpu, lambdaInBeta in dataMgr.mixupGenerator(
+                dataMgr.dataResponseGenerator(dataMgr.m_trainingSetIndices, shuffle=True, dataAugment=True, reSample=True), mixup=(epoch % 5 != 0)):
             inputs = torch.from_numpy(inputs).to(device, dtype=torch.float)
             response1 = torch.from_numpy(response1Cpu).to(device, dtype=torch.long)
             response2 = torch.from_numpy(response2Cpu).to(device, dtype=torch.long)
@@ -215,10 +209,7 @@ def main():
 
                 if weight == 0:
                     continue
-                if lambdaInBeta != 0:
-                    loss += lossFunc(outputs, gt1) * weight * lambdaInBeta
-                if 1 - lambdaInBeta != 0:
-                    loss += lossFunc(outputs, gt2) * weight * (1 - lambdaInBeta)
+                loss += mixupLoss(lossFunc, outputs, gt1, gt2, lambdaInBeta) * weight  # log-probabilities of outputs evaluated once
             loss.backward()
             optimizer.step()
             batchLoss = loss.item()
@@ -13,6 +13,7 @@ from FilesUtilities import *
 from MeasureUtilities import *
 from ResAttentionNet import ResAttentionNet
 from OCDataTransform import *
+from DataLoaderUtilities import *
 from NetMgr import NetMgr
 
 logNotes = r'''
@@ -45,11 +46,13 @@ def printUsage(argv):
     print("============Train ResAttentionNet for Ovarian Cancer =============")
     print("Usage:")
     print(argv[0],
-          "<netSavedPath> <scratch> <fullPathOfData>  <fullPathOfGroundTruthFile> k  GPUID_List")
+          "<netSavedPath> <scratch> <fullPathOfData>  <fullPathOfGroundTruthFile> k  GPUID_List", getDataLoaderArgsUsage())
     print("where: \n"
           "       scratch =0: continue to train basing on previous training parameters; scratch=1, training from scratch.\n"
           "       k=[0, K), the k-th fold in the K-fold cross validation.\n"
-          "       GPUIDList: 0,1,2,3, the specific GPU ID List, separated by comma\n")
+          "       GPUIDList: 0,1,2,3, the specific GPU ID List, separated by comma\n"
+          "       numWorkers: number of DataLoader worker processes, default 0; prefetchFactor: batches loaded ahead by each worker, default 2;\n"
+          "       pinMemory: 1 collates batches into page-locked memory, default 1.\n")
 
 
 def printPartNetworkPara(epoch, net):  # only support non-parallel
@@ -62,7 +65,7 @@ def printPartNetworkPara(epoch, net):  # only support non-parallel
 
 
 def main():
-    if len(sys.argv) != 7:
+    if len(sys.argv) < 7:
         print("Error: input parameters error.")
         printUsage(sys.argv)
         return -1
@@ -74,6 +77,7 @@ def main():
     k = int(sys.argv[5])
     GPUIDList = sys.argv[6].split(',')  # choices: 0,1,2,3 for lab server.
     GPUIDList = [int(x) for x in GPUIDList]
+    loaderArgs = parseDataLoaderArgs(sys.argv[7:])
 
     print(f'Program ID of Predictive Network training:  {os.getpid()}\n')
     print(f'Program commands: {sys.argv}')
@@ -85,7 +89,6 @@ def main():
     print(f"batchSize = {batchSize}")
     # for Regulare Conv:  3 is for 1 GPU, 6 for 2 GPU
     # For Deformable Conv: 4 is for 1 GPU, 8 for 2 GPUs.
-    numWorkers = 0
 
     device = torch.device(f"cuda:{GPUIDList[0]}" if torch.cuda.is_available() else "cpu")
 
@@ -158,9 +161,9 @@ def main():
     trainTransform = OCDataTransform(0.9)
     validationTransform = OCDataTransform(0)
 
-    trainingData = OVDataSet('training', dataPartitions, transform=trainTransform, logInfoFun=logging.info if scratch >0 else print)
-    validationData = OVDataSet('validation', dataPartitions, transform=validationTransform, logInfoFun=logging.info if scratch >0 else print)
-    testData = OVDataSet('test', dataPartitions, transform=testTransform, logInfoFun=logging.info if scratch >0 else print)
+    trainingData = OVDataSet('training', dataPartitions, transform=trainTransform, logInfoFun=logging.info if scratch >0 else print, mmapMode="c")
+    validationData = OVDataSet('validation', dataPartitions, transform=validationTransform, logInfoFun=logging.info if scratch >0 else print, mmapMode="c")
+    testData = OVDataSet('test', dataPartitions, transform=testTransform, logInfoFun=logging.info if scratch >0 else print, mmapMode="c")
 
     net = ResAttentionNet()
     # Important:
@@ -205,6 +208,7 @@ def main():
 
     epochs = 15000000
     oldTestLoss = 1000
+    testCadence = 0  # also run test set every testCadence epochs; 0 runs it only when validation improves
 
     if scratch >0:
         logging.info(f"\nHints: Optimal_Result = Yes = 1,  Optimal_Result = No = 0 \n")
@@ -215,6 +219,10 @@ def main():
                      + f"\t\tTeLoss" + f"\tAccura" + f"\tTPR_r" + f"\tTNR_r")  # logging.info output head
 
 
+    trainingLoader = createDataLoader(trainingData, batchSize, shuffle=True, loaderArgs=loaderArgs)
+    validationLoader = createDataLoader(validationData, batchSize, shuffle=False, loaderArgs=loaderArgs)
+    testLoader = createDataLoader(testData, batchSize, shuffle=False, loaderArgs=loaderArgs)
+
     for epoch in range(lastEpoch+1, epochs):
         random.seed()
         if useDataParallel:
@@ -232,9 +240,8 @@ def main():
         responseTrainTPR = 0.0
         responseTrainTNR = 0.0
 
-        for inputs, responseCpu, patientIDs in data.DataLoader(trainingData, batch_size=batchSize, shuffle=True,
-                                                   num_workers=numWorkers):
-            inputs = inputs.to(device, dtype=torch.float)
+        for inputs, responseCpu, patientIDs in trainingLoader:
+            inputs = inputs.to(device, dtype=torch.float, non_blocking=True)
             gt = responseCpu.to(device, dtype=torch.float)
 
             optimizer.zero_grad()
@@ -288,9 +295,8 @@ def main():
         responseValidationTNR = 0.0
 
         with torch.no_grad():
-            for inputs, responseCpu, patientIDs in data.DataLoader(validationData, batch_size=batchSize, shuffle=False,
-                                                       num_workers=numWorkers):
-                inputs = inputs.to(device, dtype=torch.float)
+            for inputs, responseCpu, patientIDs in validationLoader:
+                inputs = inputs.to(device, dtype=torch.float, non_blocking=True)
                 gt = responseCpu.to(device, dtype=torch.float)  # return a copy
 
                 xr = net.forward(inputs)
@@ -321,69 +327,79 @@ def main():
                 responseValidationTPR = getTPR(epochPredict, epochResponse)[0]
                 responseValidationTNR = getTNR(epochPredict, epochResponse)[0]
 
+        # test set only runs for a new best net chosen by validation, or every testCadence epochs,
+        # so that a logged test result always belongs to a saved checkpoint.
+        validationImproved = trainingLoss < float('inf') and not math.isnan(trainingLoss) and \
+                             (responseValidationAccuracy > bestTestPerf or (responseValidationAccuracy == bestTestPerf and validationLoss < oldTestLoss))
+        runTest = validationImproved or (testCadence > 0 and epoch % testCadence == 0)
+
         # ================Independent Test===============
-        net.eval()
+        if runTest:
+            net.eval()
 
-        testLoss = 0.0
-        testBatches = 0
+            testLoss = 0.0
+            testBatches = 0
 
-        epochPredict = None
-        epochResponse = None
-        responseTestAccuracy = 0.0
-        responseTestTPR = 0.0
-        responseTestTNR = 0.0
+            epochPredict = None
+            epochResponse = None
+            responseTestAccuracy = 0.0
+            responseTestTPR = 0.0
+            responseTestTNR = 0.0
 
-        with torch.no_grad():
-            for inputs, responseCpu,patientIDs in data.DataLoader(testData, batch_size=batchSize, shuffle=False,
-                                                       num_workers=numWorkers):
-                inputs = inputs.to(device, dtype=torch.float)
-                gt = responseCpu.to(device, dtype=torch.float)  # return a copy
+            with torch.no_grad():
+                for inputs, responseCpu,patientIDs in testLoader:
+                    inputs = inputs.to(device, dtype=torch.float, non_blocking=True)
+                    gt = responseCpu.to(device, dtype=torch.float)  # return a copy
 
-                xr = net.forward(inputs)
-                loss = lossFunc(xr, gt)
+                    xr = net.forward(inputs)
+                    loss = lossFunc(xr, gt)
 
-                batchLoss = loss.item()
+                    batchLoss = loss.item()
 
-                # accumulate response and predict value
-                xr = torch.prod(xr, dim=1)
-                batchPredict = (xr >= 0).cpu().detach().numpy().flatten()
-                epochPredict = np.concatenate(
-                    (epochPredict, batchPredict)) if epochPredict is not None else batchPredict
-                batchGt = responseCpu.detach().numpy()
-                batchGt = np.prod(batchGt, axis=1)
-                epochResponse = np.concatenate(
-                    (epochResponse, batchGt)) if epochResponse is not None else batchGt
+                    # accumulate response and predict value
+                    xr = torch.prod(xr, dim=1)
+                    batchPredict = (xr >= 0).cpu().detach().numpy().flatten()
+                    epochPredict = np.concatenate(
+                        (epochPredict, batchPredict)) if epochPredict is not None else batchPredict
+                    batchGt = responseCpu.detach().numpy()
+                    batchGt = np.prod(batchGt, axis=1)
+                    epochResponse = np.concatenate(
+                        (epochResponse, batchGt)) if epochResponse is not None else batchGt
 
-                testLoss += batchLoss
-                testBatches += 1
+                    testLoss += batchLoss
+                    testBatches += 1
 
-                if oneSampleTraining:
-                    break
+                    if oneSampleTraining:
+                        break
 
-            if 0 != testBatches:
-                testLoss /= testBatches
+                if 0 != testBatches:
+                    testLoss /= testBatches
 
-            if epoch % 5 == 0:
-                responseTestAccuracy = getAccuracy(epochPredict, epochResponse)
-                responseTestTPR = getTPR(epochPredict, epochResponse)[0]
-                responseTestTNR = getTNR(epochPredict, epochResponse)[0]
+                if epoch % 5 == 0:
+                    responseTestAccuracy = getAccuracy(epochPredict, epochResponse)
+                    responseTestTPR = getTPR(epochPredict, epochResponse)[0]
+                    responseTestTNR = getTNR(epochPredict, epochResponse)[0]
 
         # ===========print train and test progress===============
         learningRate = lrScheduler.get_lr()[0]
         outputString = f'{epoch}' + f'\t{learningRate:1.4e}'
         outputString += f'\t\t{trainingLoss:.4f}' + f'\t{responseTrainAccuracy:.4f}' + f'\t{responseTrainTPR:.4f}' + f'\t{responseTrainTNR:.4f}'
         outputString += f'\t\t{validationLoss:.4f}' + f'\t{responseValidationAccuracy:.4f}' + f'\t{responseValidationTPR:.4f}' + f'\t{responseValidationTNR:.4f}'
-        outputString += f'\t\t{testLoss:.4f}' + f'\t{responseTestAccuracy:.4f}' + f'\t{responseTestTPR:.4f}' + f'\t{responseTestTNR:.4f}'
+        if runTest:
+            outputString += f'\t\t{testLoss:.4f}' + f'\t{responseTestAccuracy:.4f}' + f'\t{responseTestTPR:.4f}' + f'\t{responseTestTNR:.4f}'
+        else:
+            outputString += f'\t\t--'  # test set skipped
         logging.info(outputString)
 
         # =============save net parameters==============
         if trainingLoss < float('inf') and not math.isnan(trainingLoss):
             netMgr.saveNet()
-            if responseValidationAccuracy > bestTestPerf or (
-                    responseValidationAccuracy == bestTestPerf and validationLoss < oldTestLoss):
+            if validationImproved:
                 oldTestLoss = validationLoss
                 bestTestPerf = responseValidationAccuracy
                 netMgr.saveBest(bestTestPerf)
+                netMgr.saveTestResult({"epoch": epoch, "validationAccuracy": responseValidationAccuracy, "testLoss": testLoss,
+                                        "testAccuracy": responseTestAccuracy, "testTPR": responseTestTPR, "testTNR": responseTestTNR})
             if trainingLoss <= 0.02:  # CrossEntropy use natural logarithm . -ln(0.98) = 0.0202. it means training accuracy  for each sample gets 98% above
                 logging.info(f"\n\n training loss less than 0.02, Program exit.")
                 break
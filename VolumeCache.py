@@ -0,0 +1,92 @@
+# byte-budgeted LRU cache of decoded image volumes
+
+from collections import OrderedDict
+from concurrent.futures import Future
+import threading
+
+
+class VolumeCache:
+    """
+    keep recently decoded volumes in memory, keyed by filename, evicting the least recently used volume
+    when the total bytes exceed the budget.
+    Cached arrays are set read-only as they are shared by all callers; callers must copy before modifying.
+    """
+    def __init__(self, maxBytes=0):
+        self.m_maxBytes = maxBytes  # 0 disables cache
+        self.m_usedBytes = 0
+        self.m_volumes = OrderedDict()  # filename -> numpy array, from least to most recently used
+        self.m_loading = {}  # filename -> Future of the volume being decoded by the first caller that missed it
+        self.m_hits = 0
+        self.m_misses = 0
+        self.m_lock = threading.Lock()
+
+    def setMaxBytes(self, maxBytes):
+        with self.m_lock:
+            self.m_maxBytes = maxBytes
+            self.evict()
+
+    def get(self, filename, loadFun):
+        """
+        :param filename:
+        :param loadFun: loadFun(filename) decodes the volume when it is not in cache.
+        :return: numpy array
+        """
+        with self.m_lock:
+            if filename in self.m_volumes:
+                self.m_volumes.move_to_end(filename)
+                self.m_hits += 1
+                return self.m_volumes[filename]
+            future = self.m_loading.get(filename)
+            if future is None:
+                self.m_misses += 1
+                future = Future()
+                self.m_loading[filename] = future
+                loading = True
+            else:
+                self.m_hits += 1  # concurrent readers of a same file wait for its one decode, e.g. slices read ahead
+                loading = False
+
+        if not loading:
+            return future.result()
+
+        try:
+            array = loadFun(filename)  # decode outside lock, so that concurrent readers of different files do not wait.
+        except BaseException as e:
+            with self.m_lock:
+                del self.m_loading[filename]
+            future.set_exception(e)
+            raise
+
+        with self.m_lock:
+            del self.m_loading[filename]
+            if array.nbytes <= self.m_maxBytes:
+                array.flags.writeable = False
+                self.m_volumes[filename] = array
+                self.m_usedBytes += array.nbytes
+                self.evict()
+        future.set_result(array)
+        return array
+
+    def evict(self):
+        # caller should hold m_lock
+        while self.m_usedBytes > self.m_maxBytes and len(self.m_volumes) > 0:
+            _, array = self.m_volumes.popitem(last=False)
+            self.m_usedBytes -= array.nbytes
+
+    def clear(self):
+        with self.m_lock:
+            self.m_volumes.clear()
+            self.m_usedBytes = 0
+
+    def resetCounters(self):
+        with self.m_lock:
+            self.m_hits = 0
+            self.m_misses = 0
+
+    def getHitRate(self):
+        total = self.m_hits + self.m_misses
+        return self.m_hits / total if total > 0 else 0.0
+
+    def getInfo(self):
+        return f"Volume cache: {len(self.m_volumes)} volumes, {self.m_usedBytes / 2**20:.1f} of {self.m_maxBytes / 2**20:.1f} MB used, " \
+               f"hits={self.m_hits}, misses={self.m_misses}, hit rate={self.getHitRate():.3f}"